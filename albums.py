@@ -1,9 +1,14 @@
+import argparse
 import requests
-import sqlite3
+from crawler import OwnToneCrawler, OWNTONE_URL, DEFAULT_CONCURRENCY
+from migrations import run_migrations
+from instrument import connect, print_report
+from db_writer import DbWriter, QueueWriter
+from checkpoints import CrawlCheckpoint
 
 # Function to create the 'albums' table in the SQLite database
 def create_albums_table():
-    conn = sqlite3.connect('owntone.db')
+    conn = connect('owntone.db')
     cursor = conn.cursor()
     
     # Create the 'albums' table if it doesn't already exist
@@ -32,70 +37,36 @@ def create_albums_table():
     conn.commit()
     conn.close()
 
-# Function to insert album data into the 'albums' table
-def insert_album(album):
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
-    
-    # Insert album data into the albums table
-    cursor.execute('''
-        INSERT OR REPLACE INTO albums (
-            id, name, name_sort, artist, artist_id, track_count, length_ms, time_added, 
-            in_progress, media_kind, data_kind, date_released, year, uri, artwork_url
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        album.get('id'),
-        album.get('name'),
-        album.get('name_sort'),
-        album.get('artist'),
-        album.get('artist_id'),
-        album.get('track_count'),
-        album.get('length_ms'),
-        album.get('time_added'),
-        album.get('in_progress'),
-        album.get('media_kind'),
-        album.get('data_kind'),
-        album.get('date_released'),
-        album.get('year'),
-        album.get('uri'),
-        album.get('artwork_url')
-    ))
-    
-    # Commit and close the connection
-    conn.commit()
-    conn.close()
+# Columns of the albums table, in the order they are written
+ALBUM_COLUMNS = (
+    'id', 'name', 'name_sort', 'artist', 'artist_id', 'track_count', 'length_ms', 'time_added',
+    'in_progress', 'media_kind', 'data_kind', 'date_released', 'year', 'uri', 'artwork_url'
+)
+
+# Function to create a batched writer for the albums table
+def create_album_writer(writer=None):
+    writer = writer or QueueWriter('owntone.db')
+    writer.add_table('albums', ALBUM_COLUMNS)
+    return writer
 
 # Function to fetch albums for a specific artist
-def fetch_albums_for_artist(artist_id):
-    # The URL for fetching albums for a specific artist by their ID
-    url = f'http://192.168.1.13:3689/api/library/artists/{artist_id}/albums'
+def fetch_albums_for_artist(artist_id, crawler=None):
+    crawler = crawler or OwnToneCrawler()
     
     try:
-        # Make a GET request to the URL
-        response = requests.get(url)
-        
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Parse the JSON response
-            data = response.json()
-            
-            # Iterate through the 'items' array
-            if 'items' in data:
-                for album in data['items']:
-                    # Insert each album into the database
-                    insert_album(album)
-                print(f"Inserted {len(data['items'])} albums for artist {artist_id} into the database.")
-            else:
-                print(f"No 'items' found in the response for artist {artist_id}")
-        else:
-            print(f"Failed to fetch albums for artist {artist_id}. Status code: {response.status_code}")
+        # Fetch the albums for the artist and write them into the database
+        albums = crawler.fetch_items(f'/api/library/artists/{artist_id}/albums')
+        with create_album_writer(DbWriter('owntone.db')) as writer:
+            for album in albums:
+                writer.write('albums', album)
+        print(f"Inserted {len(albums)} albums for artist {artist_id} into the database.")
     
-    except requests.RequestException as e:
+    except (requests.RequestException, KeyError, ValueError) as e:
         print(f"An error occurred while fetching albums for artist {artist_id}: {e}")
 
 # Function to fetch all artists from the database
 def fetch_all_artists():
-    conn = sqlite3.connect('owntone.db')
+    conn = connect('owntone.db')
     cursor = conn.cursor()
     
     # Fetch all artists from the artists table
@@ -105,19 +76,53 @@ def fetch_all_artists():
     conn.close()
     return artists
 
-# Main function to fetch albums for all artists and insert them into the database
-def fetch_and_store_albums():
-    # Fetch all artists from the database
-    artists = fetch_all_artists()
+# Main function to fetch albums for all artists and insert them into the database.
+# Every artist is checkpointed, so with resume only the artists not done yet are
+# fetched, and with retry_failed only the ones that failed.
+def fetch_and_store_albums(crawler=None, resume=False, retry_failed=False):
+    crawler = crawler or OwnToneCrawler()
+
+    # Fetch all artists from the database, leaving out the ones already done
+    checkpoint = CrawlCheckpoint('albums', 'artists')
+    artists = checkpoint.start([artist[0] for artist in fetch_all_artists()], resume, retry_failed)
+    paths = {artist_id: f'/api/library/artists/{artist_id}/albums' for artist_id in artists}
     
-    # Fetch albums for each artist
-    for artist in artists:
-        artist_id = artist[0]  # Extract the artist ID from the tuple
-        fetch_albums_for_artist(artist_id)
+    # Fetch albums for all artists concurrently, queueing them for the writer thread
+    # as each response arrives
+    with create_album_writer() as writer:
+        checkpoint.attach(writer)
+        for artist_id, albums, error in crawler.fetch_all(paths):
+            if error is not None:
+                print(f"An error occurred while fetching albums for artist {artist_id}: {error}")
+                checkpoint.mark_failed(artist_id, error)
+                continue
+            for album in albums:
+                writer.write('albums', album)
+            checkpoint.mark_done(artist_id)
+            print(f"Inserted {len(albums)} albums for artist {artist_id} into the database.")
+
+    checkpoint.report()
 
 if __name__ == "__main__":
-    # Create the albums table if it doesn't exist
+    parser = argparse.ArgumentParser(description='Fetch albums for every artist from OwnTone.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight at once')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last crawl, skipping the artists already done')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Only retry the artists that failed in the last crawl')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the queries and requests that took the most time')
+    args = parser.parse_args()
+
+    # Create the albums table if it doesn't exist, and bring the schema up to date
     create_albums_table()
+    run_migrations()
     
     # Fetch and store albums for all artists in the database
-    fetch_and_store_albums()
+    with OwnToneCrawler(args.url, args.concurrency) as crawler:
+        fetch_and_store_albums(crawler, args.resume, args.retry_failed)
+
+    if args.timings:
+        print_report()
@@ -1,16 +1,146 @@
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, Response, g, render_template, request, redirect, url_for, jsonify
+import json
 import sqlite3
-import requests
-from metadata import find_incorrect_tracks, mark_track_as_fixed  # Import the function from your metadata script
 import time
+import requests
+from metadata import create_fixed_tracks_table, create_track_keys_table, find_incorrect_tracks, mark_track_as_fixed  # Import the function from your metadata script
+from db import ConnectionPool, connect, enable_wal, get_db, init_app
+from migrations import migrate
+from crawler import OWNTONE_URL, OwnToneCrawler
+from cache import TTLCache
+from outbox import RatingOutbox, queue_ratings
+from candidates import create_itunes_track_keys_table, find_unmatched_candidates
+from search import create_search_indexes, match_filter, search_tracks as search_library
+from instrument import APP_DURATION, SLOW_QUERIES, render_metrics, set_slow_query_threshold
 
 app = Flask(__name__)
 DATABASE = 'owntone.db'
 
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Queries taking at least this many seconds are logged, and listed on /slow-queries
+SLOW_QUERY_THRESHOLD = 0.25
+set_slow_query_threshold(SLOW_QUERY_THRESHOLD)
+
+# The unrated-track search is cached for UNRATED_TTL seconds, then served stale
+# for up to UNRATED_STALE_TTL more while it is refreshed in the background.
+# OwnTone gets UNRATED_TIMEOUT seconds to answer, without retries. If it can't be
+# reached, it isn't asked again for UNRATED_ERROR_TTL seconds, so the pages served
+# from the local fallback meanwhile don't wait for the timeout.
+UNRATED_TTL = 60
+UNRATED_STALE_TTL = 3600
+UNRATED_TIMEOUT = 2
+UNRATED_ERROR_TTL = 30
+unrated_cache = TTLCache(UNRATED_TTL, UNRATED_STALE_TTL, UNRATED_ERROR_TTL)
+unrated_crawler = OwnToneCrawler(OWNTONE_URL, concurrency=1, retries=0, timeout=UNRATED_TIMEOUT)
+
+def create_app(db_path=DATABASE, owntone_url=OWNTONE_URL):
+    """
+    Sets the app up to serve a database. Importing this module neither touches the
+    database nor starts anything; run the app with `python app.py` or
+    `flask --app "app:create_app()" run`.
+
+    Requests share connections from a small pool (see db.get_db). The database is
+    switched to WAL so pages keep loading while a crawl writes, its schema brought
+    up to date and its full-text search indexes built if it doesn't have them yet.
+    Ratings saved on /unrated are pushed to OwnTone by a background worker; once
+    they are, the cached search is refreshed.
+
+    Calling it again (e.g. once per benchmark library) swaps the pool, the worker
+    and the cached search for the new database's.
+
+    Returns:
+        Flask: The app.
+    """
+    global unrated_cache, unrated_crawler
+
+    if 'db_pool' in app.extensions:
+        app.extensions['rating_outbox'].stop()
+        app.extensions['db_pool'].close()
+        app.extensions['db_pool'] = ConnectionPool(db_path)
+    else:
+        init_app(app, db_path)
+
+    conn = connect(db_path)
+    enable_wal(conn)
+    create_fixed_tracks_table(conn)
+    create_track_keys_table(conn)
+    create_itunes_track_keys_table(conn)
+    migrate(conn)
+    create_search_indexes(conn)
+    conn.commit()
+    conn.close()
+
+    unrated_cache = TTLCache(UNRATED_TTL, UNRATED_STALE_TTL, UNRATED_ERROR_TTL)
+    unrated_crawler = OwnToneCrawler(owntone_url, concurrency=1, retries=0, timeout=UNRATED_TIMEOUT)
+    rating_outbox = RatingOutbox(db_path, owntone_url, on_push=lambda track_ids: unrated_cache.invalidate('unrated'))
+    rating_outbox.start()
+    app.extensions['rating_outbox'] = rating_outbox
+    return app
+
+# Number of rows shown per page on the paginated views
+PAGE_SIZE = 100
+
+# Function to fetch one page of a query using a keyset cursor. Rows are ordered by
+# key_column and the page starts after the given key, so every page costs the
+# same no matter how deep it is. The query must select key_column AS page_key.
+# Returns the rows and the key to continue after (None on the last page).
+def fetch_page(cursor, query, filters, params, key_column, after=None, page_size=PAGE_SIZE):
+    filters = list(filters)
+    params = list(params)
+    if after is not None:
+        filters.append(f'{key_column} > ?')
+        params.append(after)
+
+    if filters:
+        query += ' WHERE ' + ' AND '.join(filters)
+    query += f' ORDER BY {key_column} LIMIT ?'
+    params.append(page_size + 1)
+
+    cursor.execute(query, params)
+    rows = cursor.fetchall()
+    if len(rows) > page_size:
+        return rows[:page_size], rows[page_size - 1]['page_key']
+    return rows, None
+
+# Function to count the rows a paginated view would show. Without filters the
+# count is estimated from the statistics gathered by ANALYZE (or, before ANALYZE
+# has run, from the largest key), which avoids scanning the table.
+def count_rows(cursor, query, filters, params, table, key_column, estimate=True):
+    if estimate and not filters:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'")
+        if cursor.fetchone():
+            cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1', (table,))
+            row = cursor.fetchone()
+            if row and row[0]:
+                return int(row[0].split()[0])
+        cursor.execute(f'SELECT MAX({key_column}) FROM {table}')
+        return cursor.fetchone()[0] or 0
+
+    if filters:
+        query += ' WHERE ' + ' AND '.join(filters)
+    cursor.execute(f'SELECT COUNT(*) FROM ({query})', params)
+    return cursor.fetchone()[0]
+
+# Every request is timed, by endpoint, for /metrics
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request_duration(response):
+    if 'request_start' in g:
+        APP_DURATION.observe(time.perf_counter() - g.request_start, request.method,
+                             request.endpoint or 'unknown', str(response.status_code))
+    return response
+
+# Route exposing the query, OwnTone request and page timings in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+# Route listing the most recent slow queries, see SLOW_QUERY_THRESHOLD
+@app.route('/slow-queries', methods=['GET'])
+def slow_queries():
+    return jsonify(list(reversed(SLOW_QUERIES)))
 
 # Custom filter to use zip in Jinja2 templates
 @app.template_filter('zip')
@@ -20,7 +150,7 @@ def zip_filter(*args):
 # Home route to display matches and allow filtering by artist and album
 @app.route('/', methods=['GET', 'POST'])
 def index():
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     
     # Get list of unique artists and albums that have matches in the track_links table
@@ -42,7 +172,8 @@ def index():
     
     # Default query to fetch all matched tracks
     query = '''
-        SELECT it.Name AS itunes_track_name, it.Artist AS itunes_artist, it.Album AS itunes_album, it.Rating as itunes_rating,
+        SELECT tl.id AS page_key,
+               it.Name AS itunes_track_name, it.Artist AS itunes_artist, it.Album AS itunes_album, it.Rating as itunes_rating,
                ot.title AS owntone_track_name, ot.artist AS owntone_artist, ot.album AS owntone_album, ot.rating as owntone_rating
         FROM track_links tl
         JOIN itunes_tracks it ON it.track_id = tl.itunes_track_id
@@ -53,8 +184,8 @@ def index():
     params = []
     
     # Check if the user applied filters
-    selected_artist = request.form.get('artist')
-    selected_album = request.form.get('album')
+    selected_artist = request.values.get('artist')
+    selected_album = request.values.get('album')
     
     if selected_artist:
         filters.append('it.Artist = ?')
@@ -64,16 +195,19 @@ def index():
         filters.append('ot.album = ?')
         params.append(selected_album)
     
-    if filters:
-        query += ' WHERE ' + ' AND '.join(filters)
-    
-    # Fetch the matched records based on the filters
-    cursor.execute(query, params)
-    matches = cursor.fetchall()
+    # Fetch one page of the matched records based on the filters
+    after = request.values.get('after', type=int)
+    matches, next_after = fetch_page(cursor, query, filters, params, 'tl.id', after)
+
+    # Filtered views are only counted on request; unfiltered ones get an estimate
+    exact = bool(request.values.get('count'))
+    total = None
+    if exact or not filters:
+        total = count_rows(cursor, query, filters, params, 'track_links', 'id', estimate=not exact)
     
-    conn.close()
     
-    return render_template('index.html', matches=matches, artists=artists, albums=albums, selected_artist=selected_artist, selected_album=selected_album)
+    return render_template('index.html', matches=matches, artists=artists, albums=albums, selected_artist=selected_artist, selected_album=selected_album,
+                           after=after, next_after=next_after, total=total, exact=exact)
 
 @app.route('/incorrect-tracks', methods=['GET', 'POST', 'PATCH'])
 def incorrect_tracks():
@@ -84,7 +218,7 @@ def incorrect_tracks():
         updated_album = request.form['updated_album']
         updated_title = request.form['updated_title']
         
-        conn = get_db_connection()
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             UPDATE tracks
@@ -93,15 +227,14 @@ def incorrect_tracks():
         ''', (updated_artist, updated_album, updated_title, track_id))
 
         conn.commit()
-        conn.close()
 
         # Mark the track as fixed
-        mark_track_as_fixed(track_id)
+        mark_track_as_fixed(track_id, conn)
         
         return redirect(url_for('incorrect_tracks'))
 
     # Fetch incorrect tracks
-    incorrect_tracks = find_incorrect_tracks()
+    incorrect_tracks = find_incorrect_tracks(get_db())
     
     return render_template('incorrect_tracks.html', incorrect_tracks=incorrect_tracks)
 
@@ -110,13 +243,12 @@ def mark_track_fixed():
     track_id = request.form['track_id']
     
     # Mark the track as fixed
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO fixed_tracks (track_id) VALUES (?)
     ''', (track_id,))
     conn.commit()
-    conn.close()
     
     return redirect(url_for('incorrect_tracks'))
 
@@ -125,7 +257,7 @@ def mark_album_fixed():
     track_id = request.form['track_id']
     
     # Mark the track as fixed
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO fixed_tracks (track_id)
@@ -138,23 +270,33 @@ def mark_album_fixed():
         ) AND id NOT IN (SELECT track_id FROM fixed_tracks)
     ''', (track_id,))
     conn.commit()
-    conn.close()
     
     return redirect(url_for('incorrect_tracks'))
 
-# Function to sort the array by artist_sort and title_sort
-def sort_tracks_by_artist_and_title(tracks):
-    return sorted(tracks, key=lambda x: (x['artist_sort'].lower(), x['album_sort'].lower(), x['title_sort']))
+# Function to fetch the unrated tracks from OwnTone, sorted once as they are cached.
+# They are sorted in SQL, by the same keys (and collation) as the local fallback.
+def fetch_unrated_tracks():
+    data = unrated_crawler.fetch_json('/api/search', {
+        'type': 'tracks', 'expression': 'rating=0', 'media_kind': 'music',
+    })
+    items = data.get('tracks', {}).get('items', [])
+
+    conn = sqlite3.connect(':memory:')
+    rows = conn.execute('''
+        SELECT value
+        FROM json_each(?)
+        ORDER BY LOWER(json_extract(value, '$.artist_sort')), LOWER(json_extract(value, '$.album_sort')),
+                 json_extract(value, '$.title_sort')
+    ''', (json.dumps(items),)).fetchall()
+    conn.close()
+    return [json.loads(value) for value, in rows]
 
 @app.route('/unrated', methods=['GET', 'POST'])
 def unrated():
     if request.method == 'POST':
-        # Iterate through the submitted form data
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        track_updates = []
+        ratings = []
 
+        # Iterate through the submitted form data
         for key, value in request.form.items():
             # Check if the key corresponds to a track rating
             if key.startswith('updated_rating_'):
@@ -162,156 +304,80 @@ def unrated():
                 updated_rating = int(value) if value.isdigit() else 0  # Get the selected rating
 
                 # Only update if the rating is greater than zero
-                if int(updated_rating) > 0:
-                    cursor.execute('''
-                        UPDATE tracks
-                        SET rating = ?
-                        WHERE id = ?
-                    ''', (updated_rating, track_id))
-
-                    # Prepare the update for the API request
-                    track_updates.append({
-                        "id": track_id,
-                        "rating": updated_rating
-                    })
-
-                    # Mark the track as fixed
-                    cursor.execute('''
-                        INSERT OR IGNORE INTO fixed_tracks (track_id)
-                        VALUES (?)
-                    ''', (track_id,))
-
-        conn.commit()
-
-        # Make a PUT request to update all ratings via the API
-        if track_updates:
-            api_url = "http://192.168.1.13:3689/api/library/tracks"
-            payload = {"tracks": track_updates}
-            
-            # Send the PUT request
-            try:
-                response = requests.put(api_url, json=payload)
-                response.raise_for_status()  # Raise an error for bad responses
-            except requests.exceptions.RequestException as e:
-                print(f"API request failed: {e}")
-
-            time.sleep(1)
-
-        conn.close()
+                if updated_rating > 0:
+                    ratings.append((track_id, updated_rating))
+
+        # Save the ratings locally in one go; the outbox pushes them to OwnTone in
+        # the background, see /sync-status
+        if ratings:
+            queue_ratings(get_db(), ratings)
+            app.extensions['rating_outbox'].wake()
+
+            # The rated tracks disappear from the page straight away
+            rated = {track_id for track_id, _ in ratings}
+            unrated_cache.update('unrated', lambda tracks: [track for track in tracks if track['id'] not in rated])
         
         return redirect(url_for('unrated'))
 
-    # GET request handling
-    # GET request handling
-    unrated = []
-    response = requests.get("http://192.168.1.13:3689/api/search?type=tracks&expression=rating=0&media_kind=music")
-    
-    if response.status_code == 200:
-        data = response.json()  # Parse JSON response
-        unrated = data.get("tracks", {}).get("items", [])  # Get items from the response
-        unrated = sort_tracks_by_artist_and_title(unrated)
-    else:
-        conn = get_db_connection()
-        cursor = conn.cursor()
+    # GET request handling: served from the cache (refreshed in the background once
+    # it goes stale), or from the local tracks table if OwnTone can't be reached
+    try:
+        unrated = unrated_cache.get('unrated', fetch_unrated_tracks)
+    except (requests.RequestException, ValueError) as e:
+        print(f"Falling back to the local unrated tracks: {e}")
+        cursor = get_db().cursor()
         cursor.execute('''
             SELECT t.id, t.title, t.artist, t.album
             FROM tracks t
             WHERE t.rating = 0
-            ORDER BY t.artist, t.album
+            ORDER BY LOWER(t.artist_sort), LOWER(t.album_sort), t.title_sort
         ''')
         unrated = cursor.fetchall()
-        conn.close()
 
     return render_template('unrated.html', unrated=unrated)
 
+# Route reporting how far the ratings saved on /unrated are from being pushed to OwnTone
+@app.route('/sync-status', methods=['GET'])
+def sync_status():
+    return jsonify(app.extensions['rating_outbox'].status(get_db()))
+
 # Function to search tracks by song name and artist
 def search_tracks(song_name, artist_name):
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-        SELECT t.id, t.title, t.artist, t.album
-        FROM tracks t
-        WHERE t.title LIKE ? AND t.artist LIKE ?
-    ''', (f'%{song_name}%', f'%{artist_name}%'))
-    results = cursor.fetchall()
-    conn.close()
+    conn = get_db()
+    results = search_library(conn, title=song_name, artist=artist_name)
     return results
 
 @app.route('/unmatched_tracks', methods=['GET', 'POST'])
 def unmatched_tracks():
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
+    conn = get_db()
 
-    # Query to find unmatched tracks and join them with the tracks table
-    cursor.execute('''
-        SELECT it.track_id, it.Name, it.Artist, it.Album,
-            GROUP_CONCAT(t.id) AS owntone_track_ids,
-            GROUP_CONCAT(t.title) AS titles,
-            GROUP_CONCAT(t.artist) AS artists,
-            GROUP_CONCAT(t.album) AS albums
-        FROM itunes_tracks it
-        LEFT JOIN tracks t ON LOWER(it.Name) = LOWER(t.title) AND LOWER(it.Artist) = LOWER(t.artist)
-        WHERE it.track_id NOT IN (SELECT itunes_track_id FROM track_links)
-        AND t.id NOT IN (SELECT owntone_track_id FROM track_links)
-        GROUP BY it.track_id
-    ''')
+    # Unmatched tracks with more than one candidate, each with its candidates as a
+    # list of dictionaries
+    unmatched_tracks = find_unmatched_candidates(conn, min_matches=2, workers=1)
 
-    # Fetch all rows from the query result and convert to a list of dictionaries
-    unmatched_tracks = []
-    for row in cursor.fetchall():
-        unmatched_tracks.append({
-            'track_id': row[0],
-            'title': row[1],
-            'artist': row[2],
-            'album': row[3],
-            'matches': []  # Prepare to store the matches in the expected structure
-        })
-        
-        # Add the matches directly as a list of dictionaries
-        if row[4] and row[5] and row[6] and row[7]:  # Ensure titles and artists are not None
-            owntone_track_ids = row[4].split(',')
-            titles = row[5].split(',')
-            artists = row[6].split(',')
-            albums = row[7].split(',')
-            for id, title, artist, album in zip(owntone_track_ids, titles, artists, albums):
-                unmatched_tracks[-1]['matches'].append({
-                    'id': id,
-                    'title': title,
-                    'artist': artist,
-                    'album': album
-                })
-
-    conn.close()
-
-    # Filter to exclude unmatched tracks with empty matches
-    filtered_unmatched_tracks = [track for track in unmatched_tracks if len(track['matches']) > 1]
     
-    return render_template('unmatched_tracks.html', unmatched_tracks=filtered_unmatched_tracks)
-
-
-
+    return render_template('unmatched_tracks.html', unmatched_tracks=unmatched_tracks)
 
-# Function to link tracks
+# Function to link tracks. Links made by hand are marked as manual so relinking
+# never replaces them.
 def link_tracks(itunes_track_ids, owntone_track_ids):
-    conn = sqlite3.connect('owntone.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     # If we're linking multiple tracks, zip them together
     if isinstance(itunes_track_ids, list) and isinstance(owntone_track_ids, list):
-        for itunes_track_id, owntone_track_id in zip(itunes_track_ids, owntone_track_ids):
-            cursor.execute('''
-                INSERT INTO track_links (itunes_track_id, owntone_track_id) 
-                VALUES (?, ?)
-            ''', (itunes_track_id, owntone_track_id))
+        pairs = list(zip(itunes_track_ids, owntone_track_ids))
     else:
         # For a single track
-        cursor.execute('''
-            INSERT INTO track_links (itunes_track_id, owntone_track_id) 
-            VALUES (?, ?)
-        ''', (itunes_track_ids, owntone_track_ids))
+        pairs = [(itunes_track_ids, owntone_track_ids)]
+
+    cursor.executemany('''
+        INSERT INTO track_links (itunes_track_id, owntone_track_id, manual) 
+        VALUES (?, ?, 1)
+        ON CONFLICT(itunes_track_id, owntone_track_id) DO UPDATE SET manual = 1
+    ''', pairs)
 
     conn.commit()
-    conn.close()
 
 # Route to handle linking the selected tracks
 @app.route('/link_tracks', methods=['POST'])
@@ -348,8 +414,8 @@ def play_track():
 
     # Make the PUT request to the OwnTone API
     try:
-        # Make the POST request with URL parameters
-        response = requests.post(base_url, params=params)
+        # Make the POST request with URL parameters, over a session that times it
+        response = unrated_crawler.session.post(base_url, params=params)
 
         # Check if the request was successful
         if response.status_code == 200:
@@ -362,35 +428,41 @@ def play_track():
 
 @app.route('/itunes_tracks', methods=['GET', 'POST'])
 def itunes_tracks():
-    conn = get_db_connection()
+    conn = get_db()
     cursor = conn.cursor()
 
-    # Initial query
-    query = 'SELECT * FROM itunes_tracks WHERE 1=1'
+    # Initial query, selecting only the columns the page shows
+    query = '''
+        SELECT track_id AS page_key, track_id, "Name", "Artist", "Album", "Genre", "Play Count", "Rating"
+        FROM itunes_tracks
+    '''
+    filters = []
     params = []
 
     # Filtering based on user input
-    if request.method == 'POST':
-        artist = request.form.get('artist')
-        album = request.form.get('album')
-        genre = request.form.get('genre')
-
-        if artist:
-            query += ' AND "Artist" LIKE ?'
-            params.append(f'%{artist}%')
-        if album:
-            query += ' AND "Album" LIKE ?'
-            params.append(f'%{album}%')
-        if genre:
-            query += ' AND "Genre" LIKE ?'
-            params.append(f'%{genre}%')
-
-    # Execute the query
-    cursor.execute(query, params)
-    tracks = cursor.fetchall()
-    conn.close()
-
-    return render_template('itunes_tracks.html', tracks=tracks)
+    artist = request.values.get('artist')
+    album = request.values.get('album')
+    genre = request.values.get('genre')
+
+    # Words are looked up in the full-text index and match as prefixes
+    search_filter, search_params = match_filter('itunes_tracks_fts', 'track_id',
+                                                Artist=artist, Album=album, Genre=genre)
+    if search_filter:
+        filters.append(search_filter)
+        params.extend(search_params)
+
+    # Execute the query for one page of tracks
+    after = request.values.get('after', type=int)
+    tracks, next_after = fetch_page(cursor, query, filters, params, 'track_id', after)
+
+    # Filtered views are only counted on request; unfiltered ones get an estimate
+    exact = bool(request.values.get('count'))
+    total = None
+    if exact or not filters:
+        total = count_rows(cursor, query, filters, params, 'itunes_tracks', 'track_id', estimate=not exact)
+
+    return render_template('itunes_tracks.html', tracks=tracks, artist=artist, album=album, genre=genre,
+                           after=after, next_after=next_after, total=total, exact=exact)
 
 if __name__ == '__main__':
-    app.run(port=8000, debug=True)
+    create_app().run(port=8000, debug=True)
@@ -1,11 +1,15 @@
+import argparse
 import requests
-import sqlite3
 import json
+from crawler import OwnToneCrawler, OWNTONE_URL
+from migrations import run_migrations
+from instrument import connect, print_report
+from db_writer import DbWriter
 
 # Function to create SQLite database and artists table
 def create_database():
     # Create a new SQLite database called 'owntone'
-    conn = sqlite3.connect('owntone.db')
+    conn = connect('owntone.db')
     cursor = conn.cursor()
     
     # Create an 'artists' table if it doesn't already exist
@@ -30,67 +34,47 @@ def create_database():
     conn.commit()
     conn.close()
 
-# Function to insert artist data into the database
-def insert_artist(artist):
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
-    
-    # Insert artist data into the artists table
-    cursor.execute('''
-        INSERT OR REPLACE INTO artists (
-            id, name, name_sort, album_count, track_count, length_ms, time_added, 
-            in_progress, media_kind, data_kind, uri, artwork_url
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        artist.get('id'),
-        artist.get('name'),
-        artist.get('name_sort'),
-        artist.get('album_count'),
-        artist.get('track_count'),
-        artist.get('length_ms'),
-        artist.get('time_added'),
-        artist.get('in_progress'),
-        artist.get('media_kind'),
-        artist.get('data_kind'),
-        artist.get('uri'),
-        artist.get('artwork_url')
-    ))
-    
-    # Commit and close the connection
-    conn.commit()
-    conn.close()
+# Columns of the artists table, in the order they are written
+ARTIST_COLUMNS = (
+    'id', 'name', 'name_sort', 'album_count', 'track_count', 'length_ms', 'time_added',
+    'in_progress', 'media_kind', 'data_kind', 'uri', 'artwork_url'
+)
+
+# Function to create a batched writer for the artists table
+def create_artist_writer(writer=None):
+    writer = writer or DbWriter('owntone.db')
+    writer.add_table('artists', ARTIST_COLUMNS)
+    return writer
 
 # Function to fetch and process artist data from the API
-def fetch_and_store_artists():
-    # The URL for the GET request
-    url = 'http://192.168.1.13:3689/api/library/artists'
+def fetch_and_store_artists(crawler=None):
+    crawler = crawler or OwnToneCrawler()
     
     try:
-        # Make a GET request to the URL
-        response = requests.get(url)
-        
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Parse the JSON response
-            data = response.json()
-            
-            # Iterate through the 'items' array
-            if 'items' in data:
-                for artist in data['items']:
-                    # Insert each artist into the database
-                    insert_artist(artist)
-                print(f"Inserted {len(data['items'])} artists into the database.")
-            else:
-                print("'items' key not found in the response")
-        else:
-            print(f"Failed to fetch data. Status code: {response.status_code}")
+        # Fetch the artists and write them into the database in batches
+        artists = crawler.fetch_items('/api/library/artists')
+        with create_artist_writer() as writer:
+            for artist in artists:
+                writer.write('artists', artist)
+        print(f"Inserted {len(artists)} artists into the database.")
     
-    except requests.RequestException as e:
+    except (requests.RequestException, KeyError, ValueError) as e:
         print(f"An error occurred: {e}")
 
 if __name__ == "__main__":
-    # Create the database and the artists table
+    parser = argparse.ArgumentParser(description='Fetch all artists from OwnTone.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the queries and requests that took the most time')
+    args = parser.parse_args()
+
+    # Create the database and the artists table, and bring the schema up to date
     create_database()
+    run_migrations()
     
     # Fetch and store artist data
-    fetch_and_store_artists()
+    with OwnToneCrawler(args.url) as crawler:
+        fetch_and_store_artists(crawler)
+
+    if args.timings:
+        print_report()
@@ -0,0 +1,525 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+from stub_owntone import StubOwnToneHandler, start_stub_server
+
+# Library sizes benchmarked by default, see parse_size
+DEFAULT_SIZES = ['1k', '10k']
+
+# Scenarios, in the order they run. Each one works on what the previous ones left
+# in the benchmark's database, like the real scripts do.
+SCENARIOS = ['import', 'crawl', 'resync', 'link', 'relink', 'validate', 'render']
+
+# Shape of the synthetic library
+TRACKS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 4
+
+# Every track is in both libraries, except one in ITUNES_ONLY_EVERY (only in
+# iTunes) and one in OWNTONE_ONLY_EVERY (only in OwnTone). One track in
+# VARIANT_EVERY has slightly different tags in iTunes, and one in MISTAGGED_EVERY
+# has OwnTone tags that disagree with its path.
+ITUNES_ONLY_EVERY = 20
+OWNTONE_ONLY_EVERY = 23
+VARIANT_EVERY = 10
+MISTAGGED_EVERY = 33
+
+WORDS = [
+    'love', 'night', 'blue', 'fire', 'river', 'dream', 'heart', 'city', 'rain', 'light',
+    'road', 'ghost', 'gold', 'summer', 'shadow', 'wild', 'stone', 'silver', 'ocean', 'storm',
+    'echo', 'velvet', 'neon', 'paper', 'glass', 'winter', 'midnight', 'sun', 'moon', 'desert',
+    'highway', 'electric', 'honey', 'iron', 'crystal', 'thunder', 'golden', 'broken', 'lonely', 'sweet',
+]
+GENRES = ['Rock', 'Pop', 'Jazz', 'Punk', 'Electronic', 'Folk', 'Hip-Hop', 'Classical', 'Ska', 'Metal']
+
+# Pages rendered by the 'render' scenario. {after} is replaced with a key halfway
+# through the matches, to show the cost of a deep page.
+RENDER_PAGES = [
+    '/',
+    '/?after={after}',
+    '/?count=1',
+    '/itunes_tracks',
+    '/itunes_tracks?artist=river',
+    '/incorrect-tracks',
+    '/unmatched_tracks',
+]
+
+def parse_size(size):
+    """
+    Parses a library size such as '10k', '1m' or '2500'.
+    """
+    match = re.fullmatch(r'(\d+)([km]?)', size.strip().lower())
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    return int(match.group(1)) * {'': 1, 'k': 1000, 'm': 1000000}[match.group(2)]
+
+def artist_name(index):
+    words = len(WORDS)
+    name = f'{WORDS[index % words]} {WORDS[(index // words) % words]}'.title()
+    if index >= words * words:
+        name += f' {index // (words * words)}'
+    return name
+
+def iter_catalog(size, seed):
+    """
+    Yields the tracks of a synthetic library as dicts. The same size and seed
+    always give the same tracks, without holding the library in memory.
+    """
+    rng = random.Random(seed)
+    for index in range(size):
+        album_index = index // TRACKS_PER_ALBUM
+        artist_index = album_index // ALBUMS_PER_ARTIST
+        yield {
+            'index': index,
+            'id': index + 1,
+            'artist_id': str(artist_index + 1),
+            'artist': artist_name(artist_index),
+            'album_id': str(album_index + 1),
+            'album': ' '.join(rng.choice(WORDS) for _ in range(2)).title(),
+            'title': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(),
+            'track_number': index % TRACKS_PER_ALBUM + 1,
+            'duration': rng.randint(90000, 420000),
+            'genre': GENRES[artist_index % len(GENRES)],
+            'year': 1960 + artist_index % 60,
+            'play_count': rng.randint(0, 50),
+            'rating': rng.choice([0, 0, 20, 40, 60, 80, 100]),
+        }
+
+def in_itunes(track):
+    return track['index'] % OWNTONE_ONLY_EVERY != OWNTONE_ONLY_EVERY - 1
+
+def in_owntone(track):
+    return track['index'] % ITUNES_ONLY_EVERY != ITUNES_ONLY_EVERY - 1
+
+def write_itunes_xml(path, size, seed):
+    """
+    Writes the iTunes side of a synthetic library as an iTunes Library XML file.
+
+    Returns:
+        int: The number of tracks written.
+    """
+    written = 0
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n<plist version="1.0">\n<dict>\n')
+        out.write('<key>Major Version</key><integer>1</integer>\n<key>Tracks</key>\n<dict>\n')
+        for track in iter_catalog(size, seed):
+            if not in_itunes(track):
+                continue
+
+            title, duration = track['title'], track['duration']
+            if track['index'] % VARIANT_EVERY == VARIANT_EVERY - 1:
+                # Same track, slightly different tags
+                title, duration = f'{title.upper()}!', duration + 1500
+
+            fields = [
+                ('Track ID', 'integer', track['id']),
+                ('Name', 'string', title),
+                ('Artist', 'string', track['artist']),
+                ('Album', 'string', track['album']),
+                ('Genre', 'string', track['genre']),
+                ('Total Time', 'integer', duration),
+                ('Track Number', 'integer', track['track_number']),
+                ('Year', 'integer', track['year']),
+                ('Date Added', 'date', '2012-05-01T10:00:00Z'),
+                ('Play Count', 'integer', track['play_count']),
+                ('Rating', 'integer', track['rating']),
+            ]
+            out.write(f"<key>{track['id']}</key>\n<dict>\n")
+            for key, kind, value in fields:
+                out.write(f'<key>{key}</key><{kind}>{escape(str(value))}</{kind}>\n')
+            out.write('</dict>\n')
+            written += 1
+        out.write('</dict>\n<key>Playlists</key>\n<array>\n</array>\n</dict>\n</plist>\n')
+    return written
+
+def build_owntone_library(db_path, size, seed):
+    """
+    Writes the OwnTone side of a synthetic library into a database with the same
+    tables the crawl creates. It is what the stub server serves.
+
+    Returns:
+        int: The number of tracks written.
+    """
+    from artists import create_database, ARTIST_COLUMNS
+    from albums import create_albums_table, ALBUM_COLUMNS
+    from tracks import create_tracks_table, TRACK_COLUMNS
+
+    # The table creation functions work on ./owntone.db
+    directory = os.path.dirname(os.path.abspath(db_path))
+    with working_directory(directory):
+        create_database()
+        create_albums_table()
+        create_tracks_table()
+    if os.path.basename(db_path) != 'owntone.db':
+        os.replace(os.path.join(directory, 'owntone.db'), db_path)
+
+    conn = sqlite3.connect(db_path)
+    artists = {}
+    albums = {}
+    rows = []
+    written = 0
+
+    def flush():
+        conn.executemany(f"INSERT INTO tracks ({', '.join(TRACK_COLUMNS)}) VALUES "
+                         f"({', '.join(['?' for _ in TRACK_COLUMNS])})", rows)
+        rows.clear()
+
+    for track in iter_catalog(size, seed):
+        if not in_owntone(track):
+            continue
+
+        title = track['title']
+        path_title = f"{track['track_number']:02d} {title}.mp3"
+        if track['index'] % MISTAGGED_EVERY == MISTAGGED_EVERY - 1:
+            # Tags that disagree with the path
+            title = f'Track {track["track_number"]}'
+
+        artist = artists.setdefault(track['artist_id'], {
+            'id': track['artist_id'], 'name': track['artist'], 'name_sort': track['artist'],
+            'album_count': 0, 'track_count': 0, 'length_ms': 0, 'time_added': '2012-05-01T10:00:00Z',
+            'media_kind': 'music', 'data_kind': 'file',
+        })
+        album = albums.setdefault(track['album_id'], {
+            'id': track['album_id'], 'name': track['album'], 'name_sort': track['album'],
+            'artist': track['artist'], 'artist_id': track['artist_id'], 'track_count': 0, 'length_ms': 0,
+            'time_added': '2012-05-01T10:00:00Z', 'media_kind': 'music', 'data_kind': 'file',
+            'year': track['year'],
+        })
+        if album['track_count'] == 0:
+            artist['album_count'] += 1
+        for counts in (artist, album):
+            counts['track_count'] += 1
+            counts['length_ms'] += track['duration']
+
+        values = {
+            'id': track['id'], 'title': title, 'title_sort': title, 'artist': track['artist'],
+            'artist_sort': track['artist'], 'album': track['album'], 'album_sort': track['album'],
+            'album_id': track['album_id'], 'album_artist': track['artist'],
+            'album_artist_sort': track['artist'], 'album_artist_id': track['artist_id'],
+            'genre': track['genre'], 'year': track['year'], 'track_number': track['track_number'],
+            'disc_number': 1, 'length_ms': track['duration'], 'rating': track['rating'],
+            'play_count': track['play_count'], 'skip_count': 0, 'time_added': '2012-05-01T10:00:00Z',
+            'type': 'mp3', 'media_kind': 'music', 'data_kind': 'file',
+            'path': f"/music/Music/{track['artist']}/{track['album']}/{path_title}",
+        }
+        rows.append(tuple(values.get(column) for column in TRACK_COLUMNS))
+        written += 1
+        if len(rows) >= 5000:
+            flush()
+    flush()
+
+    conn.executemany(f"INSERT INTO artists ({', '.join(ARTIST_COLUMNS)}) VALUES "
+                     f"({', '.join(['?' for _ in ARTIST_COLUMNS])})",
+                     [tuple(artist.get(column) for column in ARTIST_COLUMNS) for artist in artists.values()])
+    conn.executemany(f"INSERT INTO albums ({', '.join(ALBUM_COLUMNS)}) VALUES "
+                     f"({', '.join(['?' for _ in ALBUM_COLUMNS])})",
+                     [tuple(album.get(column) for column in ALBUM_COLUMNS) for album in albums.values()])
+
+    # Indexes for the lookups the stub server makes
+    conn.execute('CREATE INDEX idx_source_tracks_album_id ON tracks (album_id)')
+    conn.execute('CREATE INDEX idx_source_albums_artist_id ON albums (artist_id)')
+    conn.commit()
+    conn.close()
+    return written
+
+class LibraryStubHandler(StubOwnToneHandler):
+    """
+    Answers the OwnTone API requests the crawl scripts and the app make, from a
+    synthetic library database (see build_owntone_library) rather than canned
+    responses.
+    """
+
+    def query(self, sql, *params):
+        with self.server.lock:
+            return [dict(row) for row in self.server.conn.execute(sql, params)]
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        path = url.path
+        params = parse_qs(url.query)
+        self.server.requests += 1
+
+        if path == '/api/library':
+            songs = self.query('SELECT COUNT(*) AS songs FROM tracks')[0]['songs']
+            return self.send_json({'songs': songs, 'updated_at': self.server.updated_at})
+        if path == '/api/library/artists':
+            return self.send_json({'items': self.query('SELECT * FROM artists')})
+        if path == '/api/library/albums':
+            return self.send_json({'items': self.query('SELECT * FROM albums')})
+
+        match = re.fullmatch(r'/api/library/artists/([^/]+)/albums', path)
+        if match:
+            return self.send_json({'items': self.query('SELECT * FROM albums WHERE artist_id = ?', match[1])})
+        match = re.fullmatch(r'/api/library/albums/([^/]+)/tracks', path)
+        if match:
+            return self.send_json({'items': self.query('SELECT * FROM tracks WHERE album_id = ?', match[1])})
+
+        if path == '/api/search':
+            offset = int(params.get('offset', ['0'])[0])
+            limit = int(params.get('limit', ['-1'])[0])
+            total = self.query('SELECT COUNT(*) AS total FROM tracks')[0]['total']
+            items = self.query('SELECT * FROM tracks ORDER BY id LIMIT ? OFFSET ?', limit, offset)
+            return self.send_json({'tracks': {'items': items, 'total': total, 'offset': offset, 'limit': limit}})
+
+        self.send_json({}, 404)
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.requests += 1
+        self.send_json(None, 204)
+
+def start_library_server(db_path):
+    """
+    Serves a synthetic library on a free local port from a background thread.
+
+    Returns:
+        tuple: (server, base URL). Stop the server with server.shutdown().
+    """
+    server, url = start_stub_server(handler=LibraryStubHandler)
+    server.conn = sqlite3.connect(db_path, check_same_thread=False)
+    server.conn.row_factory = sqlite3.Row
+    server.updated_at = '2024-10-01T00:00:00Z'
+    return server, url
+
+@contextlib.contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def timed(function, *args, **kwargs):
+    """
+    Runs a function with its printed output discarded.
+
+    Returns:
+        tuple: (result, elapsed seconds).
+    """
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def result(seconds, items, **extra):
+    entry = {
+        'seconds': round(seconds, 4),
+        'items': items,
+        'per_second': round(items / seconds, 1) if seconds > 0 else None,
+    }
+    entry.update(extra)
+    return entry
+
+def count_rows(table):
+    conn = sqlite3.connect('owntone.db')
+    count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+    conn.close()
+    return count
+
+def run_import(context):
+    from parse import stream_tracks_into_db, IMPORT_PRAGMAS
+    (inserted, _), elapsed = timed(stream_tracks_into_db, 'itunes.xml', 'owntone.db', pragmas=IMPORT_PRAGMAS)
+    return result(elapsed, inserted)
+
+def run_crawl(context):
+    from artists import create_database
+    from albums import create_albums_table
+    from tracks import create_tracks_table
+    from sync import create_sync_state_table, sync_library
+    from crawler import OwnToneCrawler
+    from migrations import run_migrations
+
+    create_database()
+    create_albums_table()
+    create_tracks_table()
+    create_sync_state_table()
+    run_migrations()
+
+    server = context['server']
+    requests_before = server.requests
+    with OwnToneCrawler(context['url']) as crawler:
+        _, elapsed = timed(sync_library, crawler, True)
+    return result(elapsed, count_rows('tracks'), requests=server.requests - requests_before)
+
+def run_resync(context):
+    from sync import sync_library
+    from crawler import OwnToneCrawler
+
+    server = context['server']
+    requests_before = server.requests
+    with OwnToneCrawler(context['url']) as crawler:
+        _, elapsed = timed(sync_library, crawler)
+    return result(elapsed, count_rows('tracks'), requests=server.requests - requests_before)
+
+def run_link(context):
+    from link import create_links_for_matching_tracks
+    _, elapsed = timed(create_links_for_matching_tracks, True)
+    return result(elapsed, count_rows('itunes_tracks'), links=count_rows('track_links'))
+
+def run_relink(context):
+    from link import create_links_for_matching_tracks
+    _, elapsed = timed(create_links_for_matching_tracks)
+    return result(elapsed, count_rows('itunes_tracks'), links=count_rows('track_links'))
+
+def run_validate(context):
+    from validate import iter_tracks, validate_tracks
+
+    def validate():
+        conn = sqlite3.connect('owntone.db')
+        checked = incorrect = 0
+        for keys in validate_tracks(iter_tracks(conn)):
+            checked += 1
+            incorrect += bool(keys['issues'])
+        conn.close()
+        return checked, incorrect
+
+    (checked, incorrect), elapsed = timed(validate)
+    return result(elapsed, checked, incorrect=incorrect)
+
+def run_render(context):
+    import app
+
+    # Point the app at this run's database and stub server
+    client = app.create_app(os.path.abspath('owntone.db'), context['url']).test_client()
+
+    conn = sqlite3.connect('owntone.db')
+    halfway = conn.execute('SELECT id FROM track_links ORDER BY id LIMIT 1 OFFSET '
+                           '(SELECT COUNT(*) / 2 FROM track_links)').fetchone()
+    conn.close()
+
+    pages = {}
+    total = 0.0
+    for page in RENDER_PAGES:
+        url = page.format(after=halfway[0] if halfway else 0)
+        # The first request fills the app's caches, the second shows a warm page
+        first, cold = timed(client.get, url)
+        second, warm = timed(client.get, url)
+        if first.status_code != 200 or second.status_code != 200:
+            raise RuntimeError(f"GET {url} returned {first.status_code}")
+        pages[url] = {'cold_seconds': round(cold, 4), 'warm_seconds': round(warm, 4),
+                      'bytes': len(second.data)}
+        total += cold + warm
+
+    return result(total, len(pages) * 2, pages=pages)
+
+SCENARIO_FUNCTIONS = {
+    'import': run_import,
+    'crawl': run_crawl,
+    'resync': run_resync,
+    'link': run_link,
+    'relink': run_relink,
+    'validate': run_validate,
+    'render': run_render,
+}
+
+def run_size(size, seed, scenarios, directory):
+    """
+    Generates a library of the given size in directory and runs the scenarios on it.
+
+    Returns:
+        dict: The size, the time taken to generate the library and a result per scenario.
+    """
+    with working_directory(directory):
+        start = time.perf_counter()
+        itunes_tracks = write_itunes_xml('itunes.xml', size, seed)
+        os.makedirs('source', exist_ok=True)
+        owntone_tracks = build_owntone_library(os.path.join('source', 'library.db'), size, seed)
+        generated = time.perf_counter() - start
+
+        server, url = start_library_server(os.path.join('source', 'library.db'))
+        context = {'server': server, 'url': url}
+        results = {}
+        try:
+            for name in scenarios:
+                results[name] = SCENARIO_FUNCTIONS[name](context)
+                print(f"  {name}: {results[name]['seconds']:.3f}s ({results[name]['items']} items)")
+        finally:
+            server.shutdown()
+            server.conn.close()
+
+    return {
+        'size': size,
+        'seed': seed,
+        'itunes_tracks': itunes_tracks,
+        'owntone_tracks': owntone_tracks,
+        'generate_seconds': round(generated, 4),
+        'scenarios': results,
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+def compare_results(previous, current):
+    """
+    Prints how much slower (+) or faster (-) every scenario got since a previous run.
+    """
+    before = {(run['size'], name): scenario['seconds']
+              for run in previous['runs'] for name, scenario in run['scenarios'].items()}
+    print(f"Compared with {previous.get('commit') or 'the previous run'}:")
+    for run in current['runs']:
+        for name, scenario in run['scenarios'].items():
+            old = before.get((run['size'], name))
+            if old:
+                change = (scenario['seconds'] - old) / old * 100
+                print(f"  {run['size']:>8} {name:<9} {old:8.3f}s -> {scenario['seconds']:8.3f}s ({change:+.0f}%)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the import, crawl, link, validation and '
+                                                 'page rendering on synthetic libraries.')
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        help='Comma-separated library sizes, e.g. 1k,10k,100k,1m')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"Comma-separated scenarios to run, out of {', '.join(SCENARIOS)}")
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the synthetic libraries')
+    parser.add_argument('--out', default='bench-results.json', help='File the results are written to (JSON)')
+    parser.add_argument('--compare', help='Results of a previous run to compare with')
+    parser.add_argument('--keep', action='store_true', help="Keep the generated libraries")
+    args = parser.parse_args()
+
+    sizes = [parse_size(size) for size in args.sizes.split(',')]
+    scenarios = [name for name in SCENARIOS if name in args.scenarios.split(',')]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    results = environment()
+    results['runs'] = []
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix=f'bench-{size}-')
+        print(f"{size} tracks ({directory}):")
+        try:
+            results['runs'].append(run_size(size, args.seed, scenarios, directory))
+        finally:
+            if not args.keep:
+                shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare_results(json.load(f), results)
@@ -0,0 +1,101 @@
+import threading
+import time
+
+class TTLCache:
+    """
+    Caches values by key for ttl seconds. After that a value goes stale: it is
+    still served for up to stale_ttl more seconds, while a single background
+    thread reloads it. Only values older than ttl + stale_ttl (or never loaded)
+    are loaded in the caller's thread.
+
+    A load that fails is remembered for error_ttl seconds: meanwhile get() raises
+    the same error straight away instead of trying again.
+    """
+
+    def __init__(self, ttl, stale_ttl=0, error_ttl=0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.error_ttl = error_ttl
+        self.entries = {}
+        self.failures = {}
+        self.refreshing = set()
+        self.lock = threading.Lock()
+
+    def get(self, key, loader):
+        """
+        Returns the value cached for key, loading it with loader() if needed.
+
+        Raises:
+            Whatever loader() raises, if there is no value that can be served.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            failure = self.failures.get(key)
+
+        if entry is not None:
+            value, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self.ttl:
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self._refresh_in_background(key, loader)
+                return value
+
+        if failure is not None:
+            error, failed_at = failure
+            if time.monotonic() - failed_at < self.error_ttl:
+                raise error.with_traceback(None)
+
+        try:
+            value = loader()
+        except Exception as e:
+            with self.lock:
+                self.failures[key] = (e, time.monotonic())
+            raise
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic())
+            self.failures.pop(key, None)
+
+    def update(self, key, function):
+        """
+        Replaces the value cached for key (if any) by function(value), without
+        making it any fresher.
+        """
+        with self.lock:
+            if key in self.entries:
+                value, loaded_at = self.entries[key]
+                self.entries[key] = (function(value), loaded_at)
+
+    def invalidate(self, key):
+        """
+        Marks the value cached for key as stale, so the next get() reloads it in the
+        background (and serves the current value meanwhile). A remembered failure
+        is forgotten, so the next get() tries again.
+        """
+        with self.lock:
+            self.failures.pop(key, None)
+            if key in self.entries:
+                value, _ = self.entries[key]
+                self.entries[key] = (value, time.monotonic() - self.ttl)
+
+    def _refresh_in_background(self, key, loader):
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+
+        def refresh():
+            try:
+                self.set(key, loader())
+            except Exception as e:
+                # Keep serving the stale value; the next get() tries again
+                print(f"Background refresh of {key} failed: {e}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
@@ -0,0 +1,155 @@
+import argparse
+import json
+import sqlite3
+import time
+from migrations import migrate
+from metadata import create_track_keys_table, normalize_string, refresh_track_keys
+
+# Query returning every unlinked iTunes track with the unlinked OwnTone tracks whose
+# normalized title and artist are the same, as a JSON array per iTunes track. Both
+# sides are joined on the precomputed keys (see 'itunes_track_keys' and
+# 'track_keys'), and linked tracks are excluded with anti-joins on the
+# 'track_links' indexes.
+CANDIDATES_QUERY = '''
+    SELECT it.track_id, it.Name, it.Artist, it.Album,
+           json_group_array(json_object(
+               'id', t.id, 'title', t.title, 'artist', t.artist, 'album', t.album
+           )) AS matches
+    FROM itunes_track_keys ik
+    JOIN itunes_tracks it ON it.track_id = ik.track_id
+    JOIN track_keys tk ON tk.title_key = ik.title_key AND tk.artist_key = ik.artist_key
+    JOIN tracks t ON t.id = tk.track_id
+    WHERE ik.title_key != ''
+    AND NOT EXISTS (SELECT 1 FROM track_links l WHERE l.itunes_track_id = ik.track_id)
+    AND NOT EXISTS (SELECT 1 FROM track_links l WHERE l.owntone_track_id = tk.track_id)
+    GROUP BY ik.track_id
+    HAVING COUNT(*) >= ?
+    ORDER BY ik.track_id
+'''
+
+def create_itunes_track_keys_table(conn):
+    """
+    Creates the 'itunes_track_keys' table, which holds the normalized title and
+    artist of every iTunes track.
+
+    Rows are removed by triggers whenever an iTunes track is inserted (which
+    includes rows replaced by the import) or deleted, and recomputed by
+    refresh_itunes_track_keys.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itunes_track_keys (
+            track_id INTEGER PRIMARY KEY,
+            title_key TEXT,
+            artist_key TEXT
+        )
+    ''')
+
+    # The triggers can only be created once the import has created 'itunes_tracks'
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'itunes_tracks'")
+    if cursor.fetchone():
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS itunes_track_keys_after_insert AFTER INSERT ON itunes_tracks
+            BEGIN
+                DELETE FROM itunes_track_keys WHERE track_id = NEW.track_id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS itunes_track_keys_after_update
+            AFTER UPDATE OF Name, Artist ON itunes_tracks
+            BEGIN
+                DELETE FROM itunes_track_keys WHERE track_id = OLD.track_id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS itunes_track_keys_after_delete AFTER DELETE ON itunes_tracks
+            BEGIN
+                DELETE FROM itunes_track_keys WHERE track_id = OLD.track_id;
+            END
+        ''')
+
+def refresh_itunes_track_keys(conn, full=False):
+    """
+    Computes the 'itunes_track_keys' rows of every iTunes track that doesn't have
+    one yet, and drops the rows of tracks that no longer exist.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        full (bool): Recompute every row, e.g. after an import that recreated the
+            'itunes_tracks' table (and so bypassed the triggers).
+
+    Returns:
+        int: The number of tracks that were (re)computed.
+    """
+    create_itunes_track_keys_table(conn)
+    if full:
+        conn.execute('DELETE FROM itunes_track_keys')
+
+    cursor = conn.execute('''
+        SELECT it.track_id, it.Name, it.Artist
+        FROM itunes_tracks it
+        WHERE NOT EXISTS (SELECT 1 FROM itunes_track_keys k WHERE k.track_id = it.track_id)
+    ''')
+    rows = [(track_id, normalize_string(name), normalize_string(artist))
+            for track_id, name, artist in cursor.fetchall()]
+
+    conn.executemany('''
+        INSERT OR REPLACE INTO itunes_track_keys (track_id, title_key, artist_key) VALUES (?, ?, ?)
+    ''', rows)
+    conn.execute('''
+        DELETE FROM itunes_track_keys
+        WHERE NOT EXISTS (SELECT 1 FROM itunes_tracks it WHERE it.track_id = itunes_track_keys.track_id)
+    ''')
+    conn.commit()
+    return len(rows)
+
+def find_unmatched_candidates(conn, min_matches=2, workers=None):
+    """
+    Finds the unlinked iTunes tracks that have at least min_matches unlinked OwnTone
+    tracks with the same normalized title and artist.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        min_matches (int): Minimum number of candidates for a track to be listed.
+        workers (int): Number of worker processes computing missing track keys,
+            see metadata.refresh_track_keys.
+
+    Returns:
+        list: Dicts with the iTunes track's 'track_id', 'title', 'artist' and
+        'album', and its candidates in 'matches' (dicts with 'id', 'title',
+        'artist' and 'album'), ordered by iTunes track id.
+    """
+    refresh_itunes_track_keys(conn)
+    refresh_track_keys(conn, workers)
+
+    cursor = conn.execute(CANDIDATES_QUERY, (min_matches,))
+    return [
+        {
+            'track_id': track_id,
+            'title': title,
+            'artist': artist,
+            'album': album,
+            'matches': json.loads(matches),
+        }
+        for track_id, title, artist, album, matches in cursor.fetchall()
+    ]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='List unlinked iTunes tracks with their OwnTone candidates.')
+    parser.add_argument('--db', default='owntone.db', help='Path to the SQLite database file')
+    parser.add_argument('--min-matches', type=int, default=2,
+                        help='Minimum number of candidates for a track to be listed')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    create_track_keys_table(conn)
+    create_itunes_track_keys_table(conn)
+    migrate(conn)
+    start = time.perf_counter()
+
+    unmatched = find_unmatched_candidates(conn, args.min_matches)
+    conn.close()
+
+    for track in unmatched:
+        print(f"{track['track_id']} {track['title']} by {track['artist']}: {len(track['matches'])} candidates")
+    print(f"{len(unmatched)} unmatched tracks found in {time.perf_counter() - start:.2f}s.")
@@ -0,0 +1,126 @@
+import argparse
+import sqlite3
+import time
+
+# Columns of the crawl_checkpoints table, in the order they are written
+CHECKPOINT_COLUMNS = ('crawl', 'unit', 'status', 'error', 'attempts', 'updated_at')
+
+# Function to create the 'crawl_checkpoints' table, holding the outcome of every
+# unit of a crawl (an artist whose albums, or an album whose tracks, were fetched)
+def create_crawl_checkpoints_table():
+    conn = sqlite3.connect('owntone.db')
+    cursor = conn.cursor()
+
+    # Create the 'crawl_checkpoints' table if it doesn't already exist
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS crawl_checkpoints (
+            crawl TEXT,
+            unit TEXT,
+            status TEXT,
+            error TEXT,
+            attempts INTEGER DEFAULT 0,
+            updated_at REAL,
+            PRIMARY KEY (crawl, unit)
+        )
+    ''')
+
+    # Commit and close the connection
+    conn.commit()
+    conn.close()
+
+class CrawlCheckpoint:
+    """
+    Tracks which units of a crawl are done and which failed, so an interrupted
+    crawl can be resumed and failed units retried on their own.
+
+    Outcomes are written through the crawl's writer, in the same transaction as
+    the rows fetched for the unit, so a unit is never recorded as done without its
+    rows (or the other way round, if the crawl dies before they are flushed).
+    """
+
+    def __init__(self, crawl, units='units'):
+        self.crawl = crawl
+        self.units = units
+        self.done = 0
+        self.failed = 0
+
+        create_crawl_checkpoints_table()
+        conn = sqlite3.connect('owntone.db')
+        self.previous = {
+            unit: (status, attempts)
+            for unit, status, attempts in conn.execute(
+                'SELECT unit, status, attempts FROM crawl_checkpoints WHERE crawl = ?', (crawl,))
+        }
+        conn.close()
+
+    def start(self, units, resume=False, retry_failed=False):
+        """
+        Picks the units to crawl: all of them for a new crawl (forgetting the
+        previous one), the ones not done yet with resume, or only the failed ones
+        with retry_failed.
+
+        Returns:
+            list: The units to crawl, in their original order.
+        """
+        if retry_failed:
+            return [unit for unit in units if self.previous.get(str(unit), (None,))[0] == 'failed']
+        if resume:
+            return [unit for unit in units if self.previous.get(str(unit), (None,))[0] != 'done']
+
+        conn = sqlite3.connect('owntone.db')
+        with conn:
+            conn.execute('DELETE FROM crawl_checkpoints WHERE crawl = ?', (self.crawl,))
+        conn.close()
+        self.previous = {}
+        return list(units)
+
+    def attach(self, writer):
+        """
+        Lets the writer (a DbWriter or QueueWriter) write checkpoints.
+        """
+        writer.add_table('crawl_checkpoints', CHECKPOINT_COLUMNS, key=('crawl', 'unit'))
+        self.writer = writer
+
+    def mark_done(self, unit):
+        self.done += 1
+        self._write(unit, 'done', None)
+
+    def mark_failed(self, unit, error):
+        self.failed += 1
+        self._write(unit, 'failed', f'{type(error).__name__}: {error}')
+
+    def _write(self, unit, status, error):
+        _, attempts = self.previous.get(str(unit), (None, 0))
+        self.writer.write('crawl_checkpoints', {
+            'crawl': self.crawl,
+            'unit': str(unit),
+            'status': status,
+            'error': error,
+            'attempts': (attempts or 0) + 1,
+            'updated_at': time.time(),
+        })
+
+    def report(self):
+        print(f"{self.done} {self.units} done, {self.failed} failed.")
+        if self.failed:
+            print("Run again with --retry-failed to retry the failed ones.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the progress of the checkpointed crawls.')
+    parser.add_argument('--failed', action='store_true', help='List the failed units and their errors')
+    args = parser.parse_args()
+
+    create_crawl_checkpoints_table()
+    conn = sqlite3.connect('owntone.db')
+    for crawl, status, count in conn.execute('''
+        SELECT crawl, status, COUNT(*) FROM crawl_checkpoints GROUP BY crawl, status ORDER BY crawl, status
+    '''):
+        print(f"{crawl}: {count} {status}")
+
+    if args.failed:
+        for crawl, unit, attempts, error in conn.execute('''
+            SELECT crawl, unit, attempts, error FROM crawl_checkpoints
+            WHERE status = 'failed' ORDER BY crawl, unit
+        '''):
+            print(f"  {crawl} {unit} ({attempts} attempts): {error}")
+    conn.close()
@@ -0,0 +1,108 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrument import InstrumentedSession
+
+# Base URL of the OwnTone server
+OWNTONE_URL = 'http://192.168.1.13:3689'
+
+# Default number of requests in flight at once
+DEFAULT_CONCURRENCY = 8
+
+# HTTP status codes that are worth retrying
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def create_session(pool_size=DEFAULT_CONCURRENCY, retries=3, backoff_factor=0.5):
+    """
+    Create a requests session with a keep-alive connection pool and retry/backoff
+    on transient failures (connection errors and 429/5xx responses). The latency
+    of every request is recorded, see instrument.py.
+
+    Args:
+        pool_size (int): Number of connections kept alive per host.
+        retries (int): Number of retries for a failed request.
+        backoff_factor (float): Base delay for exponential backoff between retries.
+
+    Returns:
+        requests.Session: The configured session.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+    session = InstrumentedSession()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class OwnToneCrawler:
+    """
+    Fetches OwnTone library listings over a shared keep-alive session, fanning
+    requests out over a bounded pool of worker threads.
+    """
+
+    def __init__(self, base_url=OWNTONE_URL, concurrency=DEFAULT_CONCURRENCY, retries=3,
+                 backoff_factor=0.5, timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session = create_session(concurrency, retries, backoff_factor)
+
+    def fetch_json(self, path, params=None):
+        """
+        GET a path on the OwnTone server and return the parsed JSON response.
+
+        Raises:
+            requests.RequestException: If the request fails or returns an error status.
+        """
+        response = self.session.get(f'{self.base_url}{path}', params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_items(self, path, params=None):
+        """
+        GET a library listing and return its 'items' array.
+
+        Raises:
+            requests.RequestException: If the request fails or returns an error status.
+            KeyError: If the response has no 'items' key.
+        """
+        data = self.fetch_json(path, params)
+        if 'items' not in data:
+            raise KeyError(f"No 'items' found in the response for {path}")
+        return data['items']
+
+    def fetch_all(self, paths):
+        """
+        Fetch many library listings concurrently.
+
+        Args:
+            paths (dict): Mapping of key (e.g. an artist or album ID) to API path.
+
+        Yields:
+            tuple: (key, items, error) as each request completes. Exactly one of
+            items and error is None.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = {executor.submit(self.fetch_items, path): key for key, path in paths.items()}
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    yield key, future.result(), None
+                except (requests.RequestException, KeyError, ValueError) as e:
+                    yield key, None, e
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
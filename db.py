@@ -0,0 +1,104 @@
+import queue
+import sqlite3
+import threading
+from flask import current_app, g
+import instrument
+
+DATABASE = 'owntone.db'
+
+# How long (in ms) a connection waits for another writer, e.g. a crawl, to finish
+BUSY_TIMEOUT_MS = 5000
+
+# Number of prepared statements each connection keeps
+CACHED_STATEMENTS = 256
+
+# Maximum number of idle connections kept for reuse
+POOL_SIZE = 4
+
+def connect(db_path=DATABASE):
+    """
+    Opens a connection with rows accessible by column name, a busy timeout and a
+    larger prepared-statement cache. Its queries are timed, see instrument.py.
+
+    In WAL mode, commits are made durable at checkpoints rather than at every
+    commit (synchronous = NORMAL), which is safe in that mode. The setting only
+    lasts as long as the connection, so every connection applies it.
+
+    The connection may be handed between threads (as the pool does), but must
+    only be used by one thread at a time.
+    """
+    conn = instrument.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, cached_statements=CACHED_STATEMENTS,
+                           check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    if conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+        conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+def enable_wal(conn):
+    """
+    Switches the database to write-ahead logging, so readers don't block on a
+    writer (and the other way round). The mode is stored in the database file,
+    so it sticks for every later connection, including the crawl scripts'.
+    Connections opened with connect() afterwards use synchronous = NORMAL.
+    """
+    return conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+
+class ConnectionPool:
+    """
+    Keeps up to size idle connections to one database for reuse, so a request
+    doesn't pay for opening (and configuring) a new connection. Connections are
+    created on demand, so a threaded server can have more in use at once; the
+    surplus is closed when they are returned.
+    """
+
+    def __init__(self, db_path=DATABASE, size=POOL_SIZE):
+        self.db_path = db_path
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def get(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            return connect(self.db_path)
+
+    def put(self, conn):
+        # Never hand out a connection in the middle of a transaction
+        conn.rollback()
+        with self.lock:
+            if not self.closed:
+                try:
+                    self.idle.put_nowait(conn)
+                    return
+                except queue.Full:
+                    pass
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            while not self.idle.empty():
+                self.idle.get_nowait().close()
+
+def get_db():
+    """
+    Returns the connection of the current request, taking one from the app's pool
+    the first time it is needed. It goes back to the pool when the request ends.
+    """
+    if 'db' not in g:
+        g.db = current_app.extensions['db_pool'].get()
+    return g.db
+
+def release_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        current_app.extensions['db_pool'].put(conn)
+
+def init_app(app, db_path=DATABASE, pool_size=POOL_SIZE):
+    """
+    Gives the app a connection pool and returns request connections to it.
+    """
+    app.extensions['db_pool'] = ConnectionPool(db_path, pool_size)
+    app.teardown_appcontext(release_db)
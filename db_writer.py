@@ -0,0 +1,156 @@
+import queue
+import sqlite3
+import threading
+from instrument import connect
+
+# Default number of rows buffered per table before they are flushed
+DEFAULT_BATCH_SIZE = 500
+
+class DbWriter:
+    """
+    Holds a single connection and writes rows in batches.
+
+    Rows are buffered per table and flushed with executemany, one transaction per
+    flush, instead of opening a connection and committing for every row. Rows are
+    upserted on the table's key, so existing rows are updated in place.
+    """
+
+    def __init__(self, db_path='owntone.db', batch_size=DEFAULT_BATCH_SIZE):
+        self.conn = connect(db_path, check_same_thread=False)
+        self.batch_size = batch_size
+        self.tables = {}
+        self.buffers = {}
+        self.rows_written = 0
+
+    def add_table(self, table, columns, key='id'):
+        """
+        Register a table the writer can write to.
+
+        Rows that are already stored with the same values are left untouched, so
+        recrawling an unchanged library doesn't fire the tables' update triggers.
+
+        Args:
+            table (str): Table name.
+            columns (tuple): Columns to write, in order. Items are mapped onto these.
+            key (str or tuple): Column, or columns, rows are upserted on.
+        """
+        keys = (key,) if isinstance(key, str) else tuple(key)
+        updated = [column for column in columns if column not in keys]
+        updates = ', '.join([f'{column} = excluded.{column}' for column in updated])
+        changed = ' OR '.join([f'{table}.{column} IS NOT excluded.{column}' for column in updated])
+        statement = f'''
+            INSERT INTO {table} ({', '.join(columns)})
+            VALUES ({', '.join(['?' for _ in columns])})
+            ON CONFLICT({', '.join(keys)}) DO UPDATE SET {updates}
+            WHERE {changed}
+        '''
+        self.tables[table] = (columns, statement)
+        self.buffers[table] = []
+
+    def write(self, table, item):
+        """
+        Buffer an item (a dict as returned by the OwnTone API) for writing.
+        Missing fields are written as NULL.
+        """
+        columns, _ = self.tables[table]
+        buffer = self.buffers[table]
+        buffer.append(tuple(item.get(column) for column in columns))
+        if len(buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write all buffered rows in a single transaction.
+        """
+        pending = [(table, rows) for table, rows in self.buffers.items() if rows]
+        if not pending:
+            return
+
+        with self.conn:
+            for table, rows in pending:
+                _, statement = self.tables[table]
+                self.conn.executemany(statement, rows)
+                self.rows_written += len(rows)
+                self.buffers[table] = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class QueueWriter:
+    """
+    Runs a DbWriter on a background thread, fed through a queue.
+
+    Any number of fetcher threads can call write() concurrently; the rows are
+    written by the single writer thread, so HTTP fetching and database writes
+    overlap. Buffered rows are flushed once a batch fills up or the queue has been
+    idle for flush_interval seconds. close() drains the queue, flushes and
+    re-raises any error the writer thread hit.
+    """
+
+    _STOP = object()
+
+    def __init__(self, db_path='owntone.db', batch_size=DEFAULT_BATCH_SIZE, max_queued=10000,
+                 flush_interval=0.5):
+        self.writer = DbWriter(db_path, batch_size)
+        self.queue = queue.Queue(maxsize=max_queued)
+        self.flush_interval = flush_interval
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def add_table(self, table, columns, key='id'):
+        self.writer.add_table(table, columns, key)
+
+    def write(self, table, item):
+        self.queue.put((table, item))
+
+    def _run(self):
+        while True:
+            try:
+                entry = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                entry = None
+
+            if entry is self._STOP:
+                break
+            if self.error is not None:
+                continue
+
+            try:
+                if entry is None:
+                    # The queue has been idle, so don't leave rows sitting in the buffer
+                    self.writer.flush()
+                else:
+                    self.writer.write(*entry)
+            except sqlite3.Error as e:
+                self.error = e
+
+    @property
+    def rows_written(self):
+        return self.writer.rows_written
+
+    def close(self):
+        self.queue.put(self._STOP)
+        self.thread.join()
+
+        try:
+            if self.error is None:
+                self.writer.flush()
+        finally:
+            self.writer.conn.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
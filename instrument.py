@@ -0,0 +1,281 @@
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+from urllib.parse import urlsplit
+import requests
+
+# Upper bounds of the duration histogram buckets, in seconds
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds of the row count histogram buckets
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+
+# Queries taking at least this many seconds are printed and kept in SLOW_QUERIES
+SLOW_QUERY_THRESHOLD = 0.25
+
+# Number of slow queries kept
+SLOW_QUERIES_KEPT = 100
+
+# Patterns used to reduce a query to its fingerprint
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r'(?<![\w."`])-?\d+(?:\.\d+)?\b')
+PLACEHOLDER_LIST = re.compile(r'\?(?:\s*,\s*\?)+')
+WHITESPACE = re.compile(r'\s+')
+
+# Path segments that are ids, replaced in the HTTP metrics so every artist or
+# album shares one series
+ID_SEGMENT = re.compile(r'/(?:\d+|[0-9a-f]{8,})(?=/|$)')
+
+class Histogram:
+    """
+    A Prometheus-style histogram: counts of observations per bucket, their sum and
+    their count, kept separately for every combination of label values.
+    """
+
+    def __init__(self, name, help, buckets, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.labels = labels
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            counts = series[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def totals(self):
+        """
+        Returns:
+            list: (label values, sum, count) tuples, the largest sum first.
+        """
+        with self.lock:
+            totals = [(labels, series[1], series[2]) for labels, series in self.series.items()]
+        return sorted(totals, key=lambda total: total[1], reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.series.clear()
+
+    def render(self):
+        """
+        Returns the histogram in the Prometheus text exposition format.
+        """
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self.series.items()]
+
+        for label_values, counts, total, count in sorted(series):
+            labels = ','.join(f'{name}="{escape_label(value)}"' for name, value in zip(self.labels, label_values))
+            prefix = f'{labels},' if labels else ''
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {count}')
+            suffix = f'{{{labels}}}' if labels else ''
+            lines.append(f'{self.name}_sum{suffix} {total}')
+            lines.append(f'{self.name}_count{suffix} {count}')
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+QUERY_DURATION = Histogram('sqlite_query_duration_seconds', 'Time spent executing and fetching SQLite queries.',
+                           DURATION_BUCKETS, ('query',))
+QUERY_ROWS = Histogram('sqlite_query_rows', 'Rows returned (or changed) by SQLite queries.',
+                       ROW_BUCKETS, ('query',))
+HTTP_DURATION = Histogram('owntone_http_request_duration_seconds', 'Latency of the requests made to OwnTone.',
+                          DURATION_BUCKETS, ('method', 'path', 'status'))
+APP_DURATION = Histogram('app_request_duration_seconds', 'Time taken to answer the requests made to the app.',
+                         DURATION_BUCKETS, ('method', 'endpoint', 'status'))
+HISTOGRAMS = [QUERY_DURATION, QUERY_ROWS, HTTP_DURATION, APP_DURATION]
+
+slow_query_threshold = SLOW_QUERY_THRESHOLD
+SLOW_QUERIES = deque(maxlen=SLOW_QUERIES_KEPT)
+
+def set_slow_query_threshold(seconds):
+    """
+    Sets how long a query may take before it is logged as slow. None turns the
+    slow-query log off.
+    """
+    global slow_query_threshold
+    slow_query_threshold = seconds
+
+@lru_cache(maxsize=2048)
+def fingerprint(sql):
+    """
+    Reduces a query to its shape: literals become ?, lists of placeholders (as
+    built for IN (...)) become ?+, and whitespace is collapsed. Queries that only
+    differ in their values share a fingerprint.
+    """
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER_LITERAL.sub('?', sql)
+    sql = PLACEHOLDER_LIST.sub('?+', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+def record_query(sql, seconds, rows):
+    query = fingerprint(sql)
+    QUERY_DURATION.observe(seconds, query)
+    QUERY_ROWS.observe(rows, query)
+
+    if slow_query_threshold is not None and seconds >= slow_query_threshold:
+        SLOW_QUERIES.append({'query': query, 'seconds': round(seconds, 4), 'rows': rows, 'at': time.time()})
+        print(f"Slow query ({seconds:.3f}s, {rows} rows): {query}")
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    A cursor recording the duration and row count of every query it runs. A
+    query's time includes fetching its rows, since SQLite does most of the work
+    as rows are stepped through; it is recorded once the rows run out, or when
+    the cursor runs another query or is closed.
+    """
+
+    _query = None
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            super().execute(sql, parameters)
+        finally:
+            self._query = [sql, time.perf_counter() - start, 0]
+            if self.description is None:
+                # No rows to fetch (DDL, INSERT, UPDATE, ...)
+                self._query[2] = max(self.rowcount, 0)
+                self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            record_query(sql, time.perf_counter() - start, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(start, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        self._finish()
+
+    def _fetched(self, start, rows, done):
+        query = self._query
+        if query is not None:
+            query[1] += time.perf_counter() - start
+            query[2] += rows
+            if done:
+                self._finish()
+
+    def _finish(self):
+        query = self._query
+        if query is not None:
+            self._query = None
+            record_query(*query)
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    A connection whose cursors (including the ones execute() creates) are
+    InstrumentedCursors.
+    """
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def connect(db_path, **kwargs):
+    """
+    Opens an instrumented SQLite connection. Takes the same arguments as sqlite3.connect.
+    """
+    return sqlite3.connect(db_path, factory=InstrumentedConnection, **kwargs)
+
+def path_template(url):
+    return ID_SEGMENT.sub('/:id', urlsplit(url).path)
+
+class InstrumentedSession(requests.Session):
+    """
+    A requests session recording the latency of every request it makes, failed
+    ones included (with the status 'error').
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            response = super().request(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            HTTP_DURATION.observe(time.perf_counter() - start, method.upper(), path_template(url), status)
+
+def render_metrics():
+    """
+    Returns every histogram in the Prometheus text exposition format.
+    """
+    return ''.join(histogram.render() for histogram in HISTOGRAMS)
+
+def reset_metrics():
+    for histogram in HISTOGRAMS:
+        histogram.reset()
+    SLOW_QUERIES.clear()
+
+def print_report(limit=5):
+    """
+    Prints the queries and OwnTone requests that took the most time in total.
+    """
+    for title, histogram in (('Queries', QUERY_DURATION), ('OwnTone requests', HTTP_DURATION)):
+        totals = histogram.totals()[:limit]
+        if not totals:
+            continue
+        print(f"{title} taking the most time:")
+        for labels, total, count in totals:
+            print(f"  {total:8.3f}s {count:7d}x  {' '.join(labels)[:120]}")
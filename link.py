@@ -1,62 +1,295 @@
+import argparse
+import hashlib
 import sqlite3
+from migrations import run_migrations
+from metadata import TRACK_CHANGES_KEPT, create_itunes_track_changes_table, create_track_changes_table
+from matcher import (
+    ArtistIndex, BlockIndex, artist_key, assign_links, load_itunes_records, load_owntone_records,
+    rank_candidates,
+)
+
+# Columns whose values decide a track's links. If none of them change, the track
+# doesn't need to be matched again.
+ITUNES_LINK_COLUMNS = 'track_id, Name, Artist, Album, "Total Time", "Track Number"'
+OWNTONE_LINK_COLUMNS = 'id, title, artist, album, length_ms, track_number'
+
+# Sources of tracks: (table, id column, link columns, change log filled by triggers)
+LINK_SOURCES = {
+    'itunes': ('itunes_tracks', 'track_id', ITUNES_LINK_COLUMNS, 'itunes_track_changes'),
+    'owntone': ('tracks', 'id', OWNTONE_LINK_COLUMNS, 'track_changes'),
+}
 
 # Function to create the 'track_links' table
 def create_track_links_table():
     conn = sqlite3.connect('owntone.db')
     cursor = conn.cursor()
-    
+
     # Create the 'track_links' table if it doesn't already exist
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS track_links (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             itunes_track_id INTEGER,
             owntone_track_id INTEGER,
+            score REAL,
+            manual INTEGER DEFAULT 0,
             FOREIGN KEY(itunes_track_id) REFERENCES itunes_tracks(id),
             FOREIGN KEY(owntone_track_id) REFERENCES tracks(id)
         )
     ''')
-    
+
+    # Create the 'link_state' table holding the fingerprint each track was last matched with
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS link_state (
+            source TEXT,
+            track_id INTEGER,
+            fingerprint TEXT,
+            artist_key TEXT,
+            PRIMARY KEY (source, track_id)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_link_state_artist_key
+        ON link_state (source, artist_key)
+    ''')
+
+    # Create the 'link_log_state' table holding how far each change log was read
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS link_log_state (
+            source TEXT PRIMARY KEY,
+            seq INTEGER
+        )
+    ''')
+
+    # Make sure the changes to both sides are logged
+    create_itunes_track_changes_table(conn)
+    create_track_changes_table(conn)
+
     # Commit and close the connection
     conn.commit()
     conn.close()
 
-# Function to find and insert matching tracks into the 'track_links' table
-def find_and_insert_matches():
+# Function to fingerprint the current link-relevant values of the tracks of a
+# source (every track if ids is None). Returns {track_id: (fingerprint, artist)}.
+def current_fingerprints(conn, source, ids=None):
+    table, key, columns, _ = LINK_SOURCES[source]
+    fingerprints = {}
+    for row in select_for_ids(conn, f'SELECT {columns} FROM {table}', key, ids):
+        fingerprint = hashlib.sha1(repr(row[1:]).encode('utf-8')).hexdigest()
+        fingerprints[row[0]] = (fingerprint, row[2])
+    return fingerprints
+
+# Function to compare the current fingerprints of the given tracks (every track if
+# ids is None) with the stored ones.
+# Returns the ids that were added or changed, and the ids that disappeared.
+def diff_fingerprints(conn, source, current, ids=None, full=False):
+    stored = dict(select_for_ids(
+        conn, 'SELECT track_id, fingerprint FROM link_state WHERE source = ?', 'track_id', ids, (source,)
+    ))
+    changed = [id for id, (fingerprint, _) in current.items() if full or stored.get(id) != fingerprint]
+    removed = [id for id in stored if id not in current]
+    return changed, removed
+
+# Function to find the tracks of a source that were added, changed or removed since
+# the last run. Only the tracks in its change log since then are compared, unless
+# this is the first run, the log was pruned past it, or full is set.
+# Returns the current fingerprints of the compared tracks, the changed ids, the
+# removed ids, and the position in the log to resume from next time.
+def find_changed_tracks(conn, source, full=False):
+    log = LINK_SOURCES[source][3]
+    last_seq, first_seq = conn.execute(f'SELECT MAX(seq), MIN(seq) FROM {log}').fetchone()
+    last_seq = last_seq or 0
+    row = conn.execute('SELECT seq FROM link_log_state WHERE source = ?', (source,)).fetchone()
+
+    ids = None
+    if not full and row is not None and (first_seq is None or first_seq <= row[0] + 1):
+        ids = [id for id, in conn.execute(f'SELECT DISTINCT track_id FROM {log} WHERE seq > ? AND seq <= ?',
+                                          (row[0], last_seq))]
+
+    current = current_fingerprints(conn, source, ids)
+    changed, removed = diff_fingerprints(conn, source, current, ids, full)
+    return current, changed, removed, last_seq
+
+# Function to record how far a change log was read, and prune what is no longer needed
+def save_log_position(conn, source, seq):
+    conn.execute('INSERT OR REPLACE INTO link_log_state (source, seq) VALUES (?, ?)', (source, seq))
+    if source == 'itunes':
+        # 'track_changes' is pruned by the incorrect-tracks cache, which reads it too
+        conn.execute('DELETE FROM itunes_track_changes WHERE seq <= ?', (seq - TRACK_CHANGES_KEPT,))
+
+# Function to load the stored artist keys of the given tracks of a source
+def stored_artist_keys(conn, source, ids):
+    return {key for _, key in select_for_ids(
+        conn, 'SELECT track_id, artist_key FROM link_state WHERE source = ?', 'track_id', ids, (source,)
+    )}
+
+# Function to record the fingerprints of changed tracks and forget removed ones
+def save_fingerprints(conn, source, current, changed, removed):
+    conn.executemany('''
+        INSERT INTO link_state (source, track_id, fingerprint, artist_key) VALUES (?, ?, ?, ?)
+        ON CONFLICT(source, track_id) DO UPDATE SET
+            fingerprint = excluded.fingerprint, artist_key = excluded.artist_key
+    ''', [(source, id, current[id][0], artist_key(current[id][1])) for id in changed])
+    conn.executemany('DELETE FROM link_state WHERE source = ? AND track_id = ?',
+                     [(source, id) for id in removed])
+
+# Function to run a statement once per chunk of ids, staying under SQLite's parameter
+# limit. Returns the rows it returned (e.g. with RETURNING).
+def execute_for_ids(conn, statement, ids):
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows += conn.execute(statement.format(ids=', '.join(['?' for _ in chunk])), chunk).fetchall()
+    return rows
+
+# Function to run a query for the given ids (every row if ids is None), in chunks
+def select_for_ids(conn, query, key, ids, params=()):
+    if ids is None:
+        return conn.execute(query, params).fetchall()
+    where = 'AND' if ' WHERE ' in query else 'WHERE'
+    ids = list(ids)
+    rows = []
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        placeholders = ', '.join(['?' for _ in chunk])
+        rows += conn.execute(f'{query} {where} {key} IN ({placeholders})', tuple(params) + tuple(chunk)).fetchall()
+    return rows
+
+# Function to load the artist keys stored for a source, as {artist_key: [track_id, ...]}
+def load_artist_blocks(conn, source):
+    blocks = {}
+    for track_id, key in conn.execute(
+        'SELECT track_id, artist_key FROM link_state WHERE source = ?', (source,)
+    ):
+        blocks.setdefault(key, []).append(track_id)
+    return blocks
+
+# Function to bring 'track_links' up to date, rematching only the tracks that were
+# added, changed or removed since the last run, as logged by triggers. Manual links
+# are never replaced by automatic ones; they are only removed when one of their
+# tracks disappears. With a snapshot (see snapshot.py), the pairs that can only
+# match each other perfectly are found over whole columns, and only the rest are
+# scored one by one.
+def find_and_insert_matches(full=False, snapshot=None):
+    if snapshot is not None:
+        snapshot.refresh()
+
     conn = sqlite3.connect('owntone.db')
     cursor = conn.cursor()
-    
-    cursor.execute('''
-        DELETE FROM track_links
-    ''')
-    conn.commit()
 
-    # Join the itunes_tracks and tracks tables based on track title and artist
-    cursor.execute('''
-        INSERT INTO track_links (itunes_track_id, owntone_track_id)
-        SELECT it.track_id AS itunes_track_id, ot.id AS owntone_track_id
-        FROM itunes_tracks it
-        JOIN tracks ot
-        ON it.Name = ot.title
-        AND it.Artist = ot.artist
-    ''')
-    
-    # Commit the insert operation
+    # Work out which tracks changed since they were last matched
+    itunes_current, itunes_changed, itunes_removed, itunes_seq = find_changed_tracks(conn, 'itunes', full)
+    owntone_current, owntone_changed, owntone_removed, owntone_seq = find_changed_tracks(conn, 'owntone', full)
+
+    # The blocks the changed OwnTone tracks were in before, as well as the ones they are in now
+    owntone_keys = stored_artist_keys(conn, 'owntone', owntone_changed + owntone_removed)
+    owntone_keys.update(artist_key(owntone_current[id][1]) for id in owntone_changed)
+
+    # Drop the automatic links of changed or removed tracks, and any link to a removed
+    # track, keeping the tracks on the other side of them
+    freed = execute_for_ids(conn, '''
+        DELETE FROM track_links WHERE manual = 0 AND itunes_track_id IN ({ids})
+        RETURNING itunes_track_id, owntone_track_id
+    ''', itunes_changed)
+    freed += execute_for_ids(conn, '''
+        DELETE FROM track_links WHERE manual = 0 AND owntone_track_id IN ({ids})
+        RETURNING itunes_track_id, owntone_track_id
+    ''', owntone_changed)
+    freed += execute_for_ids(conn, '''
+        DELETE FROM track_links WHERE itunes_track_id IN ({ids})
+        RETURNING itunes_track_id, owntone_track_id
+    ''', itunes_removed)
+    freed += execute_for_ids(conn, '''
+        DELETE FROM track_links WHERE owntone_track_id IN ({ids})
+        RETURNING itunes_track_id, owntone_track_id
+    ''', owntone_removed)
+    freed_itunes = {itunes_id for itunes_id, _ in freed} - set(itunes_removed)
+    freed_owntone = {owntone_id for _, owntone_id in freed} - set(owntone_removed)
+
+    save_fingerprints(conn, 'itunes', itunes_current, itunes_changed, itunes_removed)
+    save_fingerprints(conn, 'owntone', owntone_current, owntone_changed, owntone_removed)
+    owntone_keys |= stored_artist_keys(conn, 'owntone', freed_owntone)
+
+    linked_itunes = {row[0] for row in conn.execute('SELECT itunes_track_id FROM track_links')}
+    linked_owntone = {row[0] for row in conn.execute('SELECT owntone_track_id FROM track_links')}
+    itunes_blocks = load_artist_blocks(conn, 'itunes')
+    owntone_blocks = load_artist_blocks(conn, 'owntone')
+
+    # Unlinked iTunes tracks that need matching: the changed ones, the ones whose link
+    # was dropped, plus those sharing a block with an OwnTone track that changed or
+    # lost its link (which may now be their best match). A full run already has them all.
+    to_match = {id for id in set(itunes_changed) | freed_itunes if id not in linked_itunes}
+    if not full:
+        itunes_artists = ArtistIndex(itunes_blocks)
+        for key in owntone_keys:
+            for itunes_key, _ in itunes_artists.similar(key):
+                # Same rule as BlockIndex: an exact artist block wins over similar ones
+                if itunes_key == key or itunes_key not in owntone_blocks:
+                    to_match.update(id for id in itunes_blocks[itunes_key] if id not in linked_itunes)
+
+    links = []
+    if to_match:
+        perfect = []
+        if snapshot is not None:
+            unlinked_owntone = [id for ids in owntone_blocks.values() for id in ids if id not in linked_owntone]
+            perfect = snapshot.perfect_pairs(to_match, unlinked_owntone)
+        perfect_itunes = {itunes_id for itunes_id, _ in perfect}
+        perfect_owntone = {owntone_id for _, owntone_id in perfect}
+
+        itunes_records = load_itunes_records(conn, to_match - perfect_itunes)
+
+        # Only the OwnTone blocks those tracks can match against are loaded
+        owntone_ids = set()
+        owntone_artists = ArtistIndex(owntone_blocks)
+        for key in {record['artist_key'] for record in itunes_records}:
+            for owntone_key, _ in owntone_artists.blocks_for(key):
+                owntone_ids.update(owntone_blocks[owntone_key])
+        index = BlockIndex(load_owntone_records(conn, owntone_ids - linked_owntone - perfect_owntone))
+
+        ranked = rank_candidates(itunes_records, index)
+        links = [(itunes_id, owntone_id, 1.0) for itunes_id, owntone_id in perfect]
+        links += assign_links(ranked, linked_itunes | perfect_itunes, linked_owntone | perfect_owntone)
+
+    cursor.executemany('''
+        INSERT INTO track_links (itunes_track_id, owntone_track_id, score)
+        VALUES (?, ?, ?)
+        ON CONFLICT(itunes_track_id, owntone_track_id) DO UPDATE SET score = excluded.score
+    ''', links)
+
+    save_log_position(conn, 'itunes', itunes_seq)
+    save_log_position(conn, 'owntone', owntone_seq)
+
+    # Commit the changes
     conn.commit()
-    
-    # Get the count of matches found and inserted
-    rows_inserted = cursor.rowcount
-    print(f"{rows_inserted} matches found and inserted into track_links.")
-    
+
+    # Report how much work was needed
+    print(f"{len(itunes_changed)} iTunes and {len(owntone_changed)} OwnTone tracks changed, "
+          f"{len(itunes_removed) + len(owntone_removed)} removed.")
+    print(f"{len(links)} matches found for {len(to_match)} unlinked tracks and inserted into track_links.")
+
     # Close the connection
     conn.close()
 
 # Main function to create the table and find matches
-def create_links_for_matching_tracks():
-    # Create the 'track_links' table
+def create_links_for_matching_tracks(full=False, snapshot=None):
+    # Create the 'track_links' table and bring its columns and indexes up to date
     create_track_links_table()
-    
+    run_migrations()
+
     # Find and insert matches between the 'itunes_tracks' and 'tracks' tables
-    find_and_insert_matches()
+    find_and_insert_matches(full, snapshot)
 
 if __name__ == "__main__":
-    create_links_for_matching_tracks()
+    parser = argparse.ArgumentParser(description='Link iTunes tracks to OwnTone tracks.')
+    parser.add_argument('--full', action='store_true',
+                        help='Rematch every track instead of only those changed since the last run')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Find the perfect matches over an in-memory columnar snapshot first')
+    args = parser.parse_args()
+
+    snapshot = None
+    if args.snapshot:
+        from snapshot import LibrarySnapshot
+        snapshot = LibrarySnapshot('owntone.db')
+
+    create_links_for_matching_tracks(args.full, snapshot)
@@ -0,0 +1,307 @@
+import re
+from collections import defaultdict
+from difflib import SequenceMatcher
+from metadata import normalize_string
+
+# Minimum score for a pair to be linked
+MIN_SCORE = 0.75
+
+# Weights of the individual similarities in a pair's score
+WEIGHTS = {
+    'title': 0.5,
+    'album': 0.15,
+    'duration': 0.25,
+    'track_number': 0.1,
+}
+
+# Durations closer than this (in ms) count as identical; at DURATION_MAX_DELTA
+# and beyond they count as completely different
+DURATION_TOLERANCE = 2000
+DURATION_MAX_DELTA = 30000
+
+# Minimum trigram similarity for two different artist keys to share a block
+ARTIST_SIMILARITY = 0.6
+
+# Titles sharing fewer trigrams than this (Jaccard) are not compared any further
+MIN_TITLE_OVERLAP = 0.3
+
+# Blocks larger than this are narrowed down by title trigrams before scoring
+MAX_BLOCK_SCAN = 200
+
+# Leading article dropped from artist keys ('The Beatles' and 'Beatles' block together)
+ARTICLE_PATTERN = re.compile(r'^the\s+')
+
+def artist_key(artist):
+    """
+    Normalize an artist name into the key tracks are blocked on.
+    """
+    return ARTICLE_PATTERN.sub('', normalize_string(artist))
+
+def trigrams(s):
+    """
+    Return the set of character trigrams of a normalized string.
+    """
+    padded = f'  {s} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def to_int(value):
+    """
+    Convert a numeric column value to an int, or None if it is missing or not a number.
+    Tables imported before itunes_tracks was typed still hold numbers as text.
+    """
+    try:
+        return int(value) or None
+    except (TypeError, ValueError):
+        return None
+
+def make_record(id, title, artist, album, duration, track_number):
+    """
+    Build a match record, normalizing every field once.
+    """
+    title_key = normalize_string(title)
+    return {
+        'id': id,
+        'title_key': title_key,
+        'artist_key': artist_key(artist),
+        'album_key': normalize_string(album),
+        'duration': to_int(duration),
+        'track_number': to_int(track_number),
+        'trigrams': trigrams(title_key),
+    }
+
+def load_itunes_records(conn, track_ids=None):
+    """
+    Load match records for iTunes tracks (all of them, or only the given ids).
+    """
+    query = '''
+        SELECT track_id, Name, Artist, Album, "Total Time", "Track Number"
+        FROM itunes_tracks
+    '''
+    return [make_record(*row) for row in _select(conn, query, 'track_id', track_ids)]
+
+def load_owntone_records(conn, track_ids=None):
+    """
+    Load match records for OwnTone tracks (all of them, or only the given ids).
+    """
+    query = '''
+        SELECT id, title, artist, album, length_ms, track_number
+        FROM tracks
+    '''
+    return [make_record(*row) for row in _select(conn, query, 'id', track_ids)]
+
+def _select(conn, query, id_column, track_ids):
+    if track_ids is None:
+        return conn.execute(query).fetchall()
+
+    # Fetch in chunks to stay under SQLite's parameter limit
+    track_ids = list(track_ids)
+    rows = []
+    for i in range(0, len(track_ids), 500):
+        chunk = track_ids[i:i + 500]
+        placeholders = ', '.join(['?' for _ in chunk])
+        rows.extend(conn.execute(f'{query} WHERE {id_column} IN ({placeholders})', chunk).fetchall())
+    return rows
+
+class ArtistIndex:
+    """
+    Indexes artist keys by trigram, so the keys similar to a given one are found
+    through the keys sharing a trigram with it instead of by comparing it with
+    every key.
+    """
+
+    def __init__(self, keys):
+        self.artist_trigrams = {}
+        self.artists_by_trigram = defaultdict(set)
+        for key in keys:
+            grams = trigrams(key)
+            self.artist_trigrams[key] = grams
+            for gram in grams:
+                self.artists_by_trigram[gram].add(key)
+        self.cache = {}
+
+    def similar(self, key):
+        """
+        Return [(artist_key, similarity)] for every indexed key whose trigram
+        similarity with key reaches ARTIST_SIMILARITY (key itself included).
+        """
+        grams = trigrams(key)
+        counts = defaultdict(int)
+        for gram in grams:
+            for other in self.artists_by_trigram.get(gram, ()):
+                counts[other] += 1
+
+        result = []
+        for other, shared in counts.items():
+            similarity = shared / (len(grams) + len(self.artist_trigrams[other]) - shared)
+            if similarity >= ARTIST_SIMILARITY:
+                result.append((other, similarity))
+        return result
+
+    def blocks_for(self, key):
+        """
+        Return [(artist_key, similarity)] for the blocks a given artist key maps to:
+        its own block if it is indexed, otherwise every similar one.
+        """
+        if key not in self.cache:
+            self.cache[key] = [(key, 1.0)] if key in self.artist_trigrams else self.similar(key)
+        return self.cache[key]
+
+class BlockIndex:
+    """
+    Groups OwnTone records into blocks by artist key so each iTunes track is only
+    compared with tracks by the same (or a very similar) artist. Artist keys are
+    indexed by trigram to find similar artists (see ArtistIndex), and large blocks
+    are narrowed down by title trigram, so matching stays sub-quadratic.
+    """
+
+    def __init__(self, records):
+        self.blocks = defaultdict(list)
+        for record in records:
+            self.blocks[record['artist_key']].append(record)
+
+        self.artists = ArtistIndex(self.blocks)
+        self.title_indexes = {}
+
+    def similar_artists(self, key):
+        """
+        Return [(artist_key, similarity)] for the blocks a given artist key maps to.
+        """
+        return self.artists.blocks_for(key)
+
+    def title_index(self, key):
+        if key not in self.title_indexes:
+            index = defaultdict(list)
+            for record in self.blocks[key]:
+                for gram in record['trigrams']:
+                    index[gram].append(record)
+            self.title_indexes[key] = index
+        return self.title_indexes[key]
+
+    def candidates(self, record):
+        """
+        Yield (candidate, artist_similarity) pairs for an iTunes record.
+        """
+        for key, artist_similarity in self.similar_artists(record['artist_key']):
+            block = self.blocks[key]
+            if len(block) <= MAX_BLOCK_SCAN:
+                for candidate in block:
+                    yield candidate, artist_similarity
+                continue
+
+            # Large block: only consider tracks sharing enough title trigrams
+            shared = {}
+            index = self.title_index(key)
+            for gram in record['trigrams']:
+                for candidate in index.get(gram, ()):
+                    entry = shared.setdefault(candidate['id'], [candidate, 0])
+                    entry[1] += 1
+
+            needed = max(1, len(record['trigrams']) // 2)
+            for candidate, count in shared.values():
+                if count >= needed:
+                    yield candidate, artist_similarity
+
+def text_similarity(a, b):
+    if a == b:
+        return 1.0
+    if not a or not b:
+        return 0.0
+    return SequenceMatcher(None, a, b).ratio()
+
+def duration_similarity(a, b):
+    if not a or not b:
+        return 0.5
+    delta = abs(a - b)
+    if delta <= DURATION_TOLERANCE:
+        return 1.0
+    if delta >= DURATION_MAX_DELTA:
+        return 0.0
+    return 1.0 - (delta - DURATION_TOLERANCE) / (DURATION_MAX_DELTA - DURATION_TOLERANCE)
+
+def score_pair(itunes, owntone, artist_similarity=1.0):
+    """
+    Score how likely an iTunes record and an OwnTone record are the same track (0-1).
+    """
+    # Cheap trigram check first, so clearly different titles skip the full comparison
+    if itunes['title_key'] != owntone['title_key']:
+        a, b = itunes['trigrams'], owntone['trigrams']
+        if len(a & b) < MIN_TITLE_OVERLAP * len(a | b):
+            return 0.0
+
+    title = text_similarity(itunes['title_key'], owntone['title_key'])
+    if title < 0.5:
+        return 0.0
+
+    if itunes['album_key'] and owntone['album_key']:
+        album = text_similarity(itunes['album_key'], owntone['album_key'])
+    else:
+        album = 0.5
+
+    if itunes['track_number'] and owntone['track_number']:
+        track_number = 1.0 if itunes['track_number'] == owntone['track_number'] else 0.0
+    else:
+        track_number = 0.5
+
+    score = (
+        WEIGHTS['title'] * title
+        + WEIGHTS['album'] * album
+        + WEIGHTS['duration'] * duration_similarity(itunes['duration'], owntone['duration'])
+        + WEIGHTS['track_number'] * track_number
+    )
+    return score * artist_similarity
+
+def rank_candidates(itunes_records, index, min_score=MIN_SCORE):
+    """
+    Score every iTunes record against its blocked candidates.
+
+    Returns:
+        dict: {itunes_id: [(owntone_id, score), ...]} sorted best first, keeping
+        only pairs scoring at least min_score.
+    """
+    ranked = {}
+    for record in itunes_records:
+        scored = []
+        for candidate, artist_similarity in index.candidates(record):
+            score = score_pair(record, candidate, artist_similarity)
+            if score >= min_score:
+                scored.append((candidate['id'], round(score, 4)))
+        if scored:
+            scored.sort(key=lambda pair: pair[1], reverse=True)
+            ranked[record['id']] = scored
+    return ranked
+
+def assign_links(ranked, taken_itunes=(), taken_owntone=()):
+    """
+    Pick one-to-one links from ranked candidates, best scores first.
+
+    Returns:
+        list: (itunes_id, owntone_id, score) tuples.
+    """
+    pairs = [
+        (score, itunes_id, owntone_id)
+        for itunes_id, candidates in ranked.items()
+        for owntone_id, score in candidates
+    ]
+    pairs.sort(key=lambda pair: pair[0], reverse=True)
+
+    used_itunes = set(taken_itunes)
+    used_owntone = set(taken_owntone)
+    links = []
+    for score, itunes_id, owntone_id in pairs:
+        if itunes_id in used_itunes or owntone_id in used_owntone:
+            continue
+        used_itunes.add(itunes_id)
+        used_owntone.add(owntone_id)
+        links.append((itunes_id, owntone_id, score))
+    return links
+
+def match_tracks(conn, min_score=MIN_SCORE):
+    """
+    Match every iTunes track against the OwnTone library.
+
+    Returns:
+        list: (itunes_id, owntone_id, score) links.
+    """
+    index = BlockIndex(load_owntone_records(conn))
+    ranked = rank_candidates(load_itunes_records(conn), index, min_score)
+    return assign_links(ranked)
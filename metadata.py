@@ -1,15 +1,28 @@
 import sqlite3
 import re
+import threading
 
 DATABASE = 'owntone.db'
 
+# Patterns used to parse paths and normalize strings, compiled once
+PATH_WITH_ALBUM = re.compile(r'^/music/Music/([^/]+)/([^/]+)/([^/]+)$')
+PATH_WITHOUT_ALBUM = re.compile(r'^/music/Music/([^/]+)/([^/]+)$')
+TRACK_NUMBER = re.compile(r'^\d{1,2}\s+(.*)$')
+DISC_AND_TRACK_NUMBER = re.compile(r'^\d{1,2}\-\d{1,2}\s+(.*)$')
+FILE_EXTENSION = re.compile(r'\.[^.]+$')
+WHITESPACE = re.compile(r'\s+')
+PUNCTUATION = re.compile(r'[^\w\s]')
+
 def get_db_connection():
     conn = sqlite3.connect(DATABASE)
     conn.row_factory = sqlite3.Row
     return conn
 
-def create_fixed_tracks_table():
-    conn = get_db_connection()
+# Function to create the 'fixed_tracks' table, using the given connection or a new one
+def create_fixed_tracks_table(conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS fixed_tracks (
@@ -17,7 +30,8 @@ def create_fixed_tracks_table():
         )
     ''')
     conn.commit()
-    conn.close()
+    if own_conn:
+        conn.close()
 
 def parse_path(path):
     """
@@ -29,10 +43,10 @@ def parse_path(path):
     Removes leading track number (if it exists) from the track title.
     """
     # Regex for pattern with album: /music/Music/{artist}/{album}/{track}
-    match_with_album = re.match(r'^/music/Music/([^/]+)/([^/]+)/([^/]+)$', path)
+    match_with_album = PATH_WITH_ALBUM.match(path)
     
     # Regex for pattern without album: /music/Music/{artist}/{track}
-    match_without_album = re.match(r'^/music/Music/([^/]+)/([^/]+)$', path)
+    match_without_album = PATH_WITHOUT_ALBUM.match(path)
 
     if match_with_album:
         artist, album, track = match_with_album.groups()
@@ -51,12 +65,12 @@ def remove_track_number(track):
     For example, '01 Track Title' becomes 'Track Title'.
     """
     # Regex to match track number at the start of the title
-    match = re.match(r'^\d{1,2}\s+(.*)$', track)
+    match = TRACK_NUMBER.match(track)
     if match:
         return match.group(1)  # Return the title without the track number
     
     # Regex to match disc and track number at the start of the title
-    match = re.match(r'^\d{1,2}\-\d{1,2}\s+(.*)$', track)
+    match = DISC_AND_TRACK_NUMBER.match(track)
     if match:
         return match.group(1)  # Return the title without the track number
     return track  # Return the original title if no match
@@ -65,77 +79,294 @@ def normalize_string(s):
     if s is None:
         return ''
     # Strip leading and trailing whitespace, convert to lowercase
-    normalized = re.sub(r'\s+', ' ', s.strip()).lower()
+    normalized = WHITESPACE.sub(' ', s.strip()).lower()
     # Remove punctuation
-    normalized = re.sub(r'[^\w\s]', '', normalized)
+    normalized = PUNCTUATION.sub('', normalized)
     return normalized
 
-def find_incorrect_tracks(db_file='owntone.db'):
-    conn = sqlite3.connect(db_file)
-    conn.row_factory = sqlite3.Row  # Access rows by column name
+def create_track_keys_table(conn):
+    """
+    Creates the 'track_keys' table, which holds the normalized tag values and the
+    values parsed from the path of every track, along with the checks of
+    validate.CHECKS it fails ('issues', comma-separated) and whether it fails any
+    ('mismatch').
+
+    Rows are removed by triggers whenever a track is inserted, deleted or has its
+    title, artist, album or path changed (not merely rewritten with the same
+    values), and recomputed by refresh_track_keys.
+    """
     cursor = conn.cursor()
-    
-    # Select all rows from the tracks table
-    cursor.execute("SELECT t.id, t.title, t.artist, t.album, t.path FROM tracks t WHERE NOT EXISTS (SELECT 1 FROM fixed_tracks f WHERE f.track_id = t.id)")
-    tracks = cursor.fetchall()
-    
-    conn.close()
-    
-    incorrect_tracks = []
-
-    for track in tracks:
-        # Parse the path to extract artist, album, and track name
-        parsed_artist, parsed_album, parsed_track = parse_path(track['path'])
-        
-        # Continue only if the path is successfully parsed
-        if parsed_artist and parsed_track:
-            # Remove file extension from the parsed track name if it exists
-            parsed_track = re.sub(r'\.[^.]+$', '', parsed_track)
-
-            # Normalize the parsed values and the track values from the database
-            normalized_parsed_artist = normalize_string(parsed_artist)
-            normalized_parsed_album = normalize_string(parsed_album) if parsed_album else None
-            normalized_parsed_track = normalize_string(parsed_track)
-
-            normalized_db_artist = normalize_string(track['artist'])
-            normalized_db_album = normalize_string(track['album'])
-            normalized_db_title = normalize_string(track['title'])
-
-            # Compare normalized values
-            is_incorrect = False
-            if normalized_parsed_artist != normalized_db_artist:
-                is_incorrect = True
-            if normalized_parsed_album and normalized_parsed_album != normalized_db_album:
-                is_incorrect = True
-            if normalized_parsed_track != normalized_db_title:
-                is_incorrect = True
-
-            # If any of the values don't match, add the row to incorrect_tracks
-            if is_incorrect:
-                incorrect_tracks.append({
-                    'id': track['id'],
-                    'title': track['title'],
-                    'artist': track['artist'],
-                    'album': track['album'],
-                    'path': track['path'],
-                    'parsed_title': parsed_track,
-                    'parsed_artist': parsed_artist,
-                    'parsed_album': parsed_album
-                })
-
-    conn.close()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_keys (
+            track_id INTEGER PRIMARY KEY,
+            title_key TEXT,
+            artist_key TEXT,
+            album_key TEXT,
+            path_title TEXT,
+            path_artist TEXT,
+            path_album TEXT,
+            path_title_key TEXT,
+            path_artist_key TEXT,
+            path_album_key TEXT,
+            issues TEXT,
+            mismatch INTEGER
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_track_keys_mismatch ON track_keys (mismatch)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_track_keys_title_artist ON track_keys (title_key, artist_key)')
+
+    # The names of the checks the stored results come from
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_keys_checks (
+            name TEXT PRIMARY KEY
+        )
+    ''')
+
+    # The triggers can only be created once the crawl has created the 'tracks' table
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tracks'")
+    if cursor.fetchone():
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS track_keys_after_insert AFTER INSERT ON tracks
+            BEGIN
+                DELETE FROM track_keys WHERE track_id = NEW.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS track_keys_after_update
+            AFTER UPDATE OF title, artist, album, path ON tracks
+            WHEN NEW.title IS NOT OLD.title OR NEW.artist IS NOT OLD.artist
+                OR NEW.album IS NOT OLD.album OR NEW.path IS NOT OLD.path
+            BEGIN
+                DELETE FROM track_keys WHERE track_id = OLD.id;
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS track_keys_after_delete AFTER DELETE ON tracks
+            BEGIN
+                DELETE FROM track_keys WHERE track_id = OLD.id;
+            END
+        ''')
+
+def refresh_track_keys(conn, workers=None):
+    """
+    Computes the 'track_keys' rows of every track that doesn't have one yet (new
+    tracks, and tracks whose tags or path changed since they were last computed).
+    Every row is recomputed if a check was added to or removed from
+    validate.CHECKS since.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        workers (int): Number of worker processes, see validate.validate_tracks.
+            Pass 1 from threads of a running server, which must not fork.
+
+    Returns:
+        int: The number of tracks that were (re)computed.
+    """
+    # Imported here because validate imports this module
+    from validate import CHECKS, iter_tracks, validate_tracks
+
+    create_track_keys_table(conn)
+
+    names = sorted(CHECKS)
+    if [row[0] for row in conn.execute('SELECT name FROM track_keys_checks ORDER BY name')] != names:
+        conn.execute('DELETE FROM track_keys')
+        conn.execute('DELETE FROM track_keys_checks')
+        conn.executemany('INSERT INTO track_keys_checks (name) VALUES (?)', [(name,) for name in names])
+
+    # The keys are computed by the validation engine, which spreads large inputs
+    # (e.g. the first run on a big library) over a process pool
+    missing = iter_tracks(conn, where='''
+        WHERE NOT EXISTS (SELECT 1 FROM track_keys k WHERE k.track_id = t.id)
+    ''')
+    rows = [
+        (keys['track_id'], keys['title_key'], keys['artist_key'], keys['album_key'],
+         keys['path_title'], keys['path_artist'], keys['path_album'],
+         keys['path_title_key'], keys['path_artist_key'], keys['path_album_key'],
+         ','.join(keys['issues']), int(bool(keys['issues'])))
+        for keys in validate_tracks(missing, workers=workers)
+    ]
+
+    conn.executemany('''
+        INSERT OR REPLACE INTO track_keys (
+            track_id, title_key, artist_key, album_key, path_title, path_artist, path_album,
+            path_title_key, path_artist_key, path_album_key, issues, mismatch
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    return len(rows)
+
+# Columns of 'tracks' whose changes are logged in 'track_changes': the ones the
+# metadata check, the linker and the library snapshot read
+TRACK_CHANGES_COLUMNS = ['title', 'artist', 'album', 'path', 'length_ms', 'track_number']
+
+def create_track_changes_table(conn):
+    """
+    Creates the 'track_changes' log, which triggers fill with the id of every track
+    inserted, updated or deleted in 'tracks', or marked/unmarked in 'fixed_tracks'.
+    Updates are only logged if one of TRACK_CHANGES_COLUMNS changed. The
+    incorrect-tracks cache, the linker and the library snapshot read it to
+    revisit only the tracks that changed.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            track_id INTEGER
+        )
+    ''')
+
+    changed = ' OR '.join([f'NEW.{column} IS NOT OLD.{column}' for column in TRACK_CHANGES_COLUMNS])
+    triggers = [
+        ('fixed_tracks', 'INSERT', 'NEW.track_id', ''),
+        ('fixed_tracks', 'DELETE', 'OLD.track_id', ''),
+        ('tracks', 'INSERT', 'NEW.id', ''),
+        ('tracks', 'UPDATE', 'NEW.id', f'WHEN {changed}'),
+        ('tracks', 'DELETE', 'OLD.id', ''),
+    ]
+
+    # The triggers of a table can only be created once it exists; the next call
+    # creates the missing ones
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('fixed_tracks', 'tracks')")
+    existing = {row[0] for row in cursor.fetchall()}
+
+    for table, event, track_id, when in triggers:
+        if table not in existing:
+            continue
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS track_changes_{table}_{event.lower()}
+            AFTER {event} ON {table} {when}
+            BEGIN
+                INSERT INTO track_changes (track_id) VALUES ({track_id});
+            END
+        ''')
+
+def create_itunes_track_changes_table(conn):
+    """
+    Creates the 'itunes_track_changes' log, which triggers fill with the id of every
+    iTunes track inserted (which includes rows replaced by the import), deleted, or
+    updated with a new name, artist, album, duration or track number. The linker
+    and the library snapshot read it to revisit only the tracks that changed.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS itunes_track_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            track_id INTEGER
+        )
+    ''')
+
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'itunes_tracks'")
+    if not cursor.fetchone():
+        return
+
+    columns = ['Name', 'Artist', 'Album', 'Total Time', 'Track Number']
+    column_list = ', '.join([f'"{column}"' for column in columns])
+    changed = ' OR '.join([f'NEW."{column}" IS NOT OLD."{column}"' for column in columns])
+    triggers = [
+        ('insert', 'AFTER INSERT ON itunes_tracks', 'NEW.track_id'),
+        ('update', f'AFTER UPDATE OF {column_list} ON itunes_tracks WHEN {changed}', 'NEW.track_id'),
+        ('delete', 'AFTER DELETE ON itunes_tracks', 'OLD.track_id'),
+    ]
+    for name, event, track_id in triggers:
+        cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS itunes_track_changes_{name}
+            {event}
+            BEGIN
+                INSERT INTO itunes_track_changes (track_id) VALUES ({track_id});
+            END
+        ''')
+
+# Query returning the tracks that fail one of the checks, and that haven't been
+# marked as fixed
+INCORRECT_TRACKS_QUERY = '''
+    SELECT t.id, t.title, t.artist, t.album, t.path,
+           k.path_title AS parsed_title, k.path_artist AS parsed_artist, k.path_album AS parsed_album,
+           k.issues
+    FROM track_keys k
+    JOIN tracks t ON t.id = k.track_id
+    WHERE k.mismatch = 1
+    AND NOT EXISTS (SELECT 1 FROM fixed_tracks f WHERE f.track_id = k.track_id)
+'''
+
+# Number of entries kept in 'track_changes'; older ones are pruned
+TRACK_CHANGES_KEPT = 100000
+
+# In-memory cache of incorrect tracks per database file:
+# {db_file: {'seq': last change applied, 'tracks': {track_id: track}}}
+_incorrect_tracks_cache = {}
+_incorrect_tracks_lock = threading.Lock()
+
+def _refresh_incorrect_tracks(conn, cached):
+    """
+    Brings a cache entry up to date. Only the tracks logged in 'track_changes' since
+    the entry was last refreshed are re-checked; the whole library is only scanned
+    the first time, or if the log was pruned past the entry.
+
+    This runs in the app's request threads, so the keys are computed in-process
+    rather than by forking a process pool.
+    """
+    cursor = conn.cursor()
+    last_seq, first_seq = cursor.execute('SELECT MAX(seq), MIN(seq) FROM track_changes').fetchone()
+    last_seq = last_seq or 0
+
+    if cached['seq'] is None or (first_seq is not None and first_seq > cached['seq'] + 1):
+        refresh_track_keys(conn, workers=1)
+        cursor.execute(INCORRECT_TRACKS_QUERY)
+        cached['tracks'] = {track['id']: dict(track) for track in cursor.fetchall()}
+    elif last_seq > cached['seq']:
+        cursor.execute('SELECT DISTINCT track_id FROM track_changes WHERE seq > ? AND seq <= ?',
+                       (cached['seq'], last_seq))
+        changed = [row[0] for row in cursor.fetchall()]
+
+        refresh_track_keys(conn, workers=1)
+        for track_id in changed:
+            cached['tracks'].pop(track_id, None)
+        for i in range(0, len(changed), 500):
+            chunk = changed[i:i + 500]
+            placeholders = ', '.join(['?' for _ in chunk])
+            cursor.execute(f'{INCORRECT_TRACKS_QUERY} AND k.track_id IN ({placeholders})', chunk)
+            for track in cursor.fetchall():
+                cached['tracks'][track['id']] = dict(track)
+
+    cached['seq'] = last_seq
+
+    # Keep the log bounded
+    cursor.execute('DELETE FROM track_changes WHERE seq <= ?', (last_seq - TRACK_CHANGES_KEPT,))
+    conn.commit()
+
+# Function to find the tracks whose tags disagree with their path. Uses the given
+# connection (which must return sqlite3.Row rows), or opens one to db_file.
+def find_incorrect_tracks(conn=None, db_file=DATABASE):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
+    else:
+        # The cache is per database file
+        db_file = conn.execute('PRAGMA database_list').fetchone()[2]
+    create_track_keys_table(conn)
+    create_track_changes_table(conn)
+
+    # Bring the cached result up to date with the tracks edited since the last check
+    with _incorrect_tracks_lock:
+        cached = _incorrect_tracks_cache.setdefault(db_file, {'seq': None, 'tracks': {}})
+        _refresh_incorrect_tracks(conn, cached)
+        incorrect_tracks = [cached['tracks'][track_id] for track_id in sorted(cached['tracks'])]
+
+    if own_conn:
+        conn.close()
     
     return incorrect_tracks
 
-def mark_track_as_fixed(track_id):
-    conn = get_db_connection()
+# Function to mark a track as fixed, using the given connection or a new one
+def mark_track_as_fixed(track_id, conn=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_db_connection()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT OR IGNORE INTO fixed_tracks (track_id)
         VALUES (?)
     ''', (track_id,))
     conn.commit()
-    conn.close()
-
-# Call create_fixed_tracks_table() at the start of your script
-create_fixed_tracks_table()
+    if own_conn:
+        conn.close()
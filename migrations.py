@@ -0,0 +1,303 @@
+import argparse
+import re
+import sqlite3
+import sys
+import time
+
+# Function to give 'track_links' the columns added when links started being scored,
+# and make each pair unique so links can be upserted
+def migrate_track_links_pairs(cursor):
+    cursor.execute("PRAGMA table_info(track_links)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'score' not in columns:
+        cursor.execute('ALTER TABLE track_links ADD COLUMN score REAL')
+    if 'manual' not in columns:
+        cursor.execute('ALTER TABLE track_links ADD COLUMN manual INTEGER DEFAULT 0')
+
+    cursor.execute('''
+        DELETE FROM track_links
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM track_links GROUP BY itunes_track_id, owntone_track_id
+        )
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_track_links_pair
+        ON track_links (itunes_track_id, owntone_track_id)
+    ''')
+
+# Function to index both sides of 'track_links'. Lookups by iTunes track are served
+# by the unique pair index, which starts with itunes_track_id.
+def migrate_track_links_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_track_links_owntone ON track_links (owntone_track_id)')
+
+# Function to index the 'tracks' columns the views join and filter on
+def migrate_tracks_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracks_album_id ON tracks (album_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracks_rating ON tracks (rating)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracks_path ON tracks (path)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracks_title ON tracks (title)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tracks_artist ON tracks (artist)')
+
+# Function to index the normalized keys the unmatched-track candidates are joined on
+def migrate_candidate_key_indexes(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_track_keys_title_artist ON track_keys (title_key, artist_key)')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_itunes_track_keys_title_artist
+        ON itunes_track_keys (title_key, artist_key)
+    ''')
+
+# Function to convert an 'itunes_tracks' table imported before it was typed (every
+# column TEXT, no 'extra' column) to the typed layout, converting its values the way
+# the import does. Its triggers are recreated on the new table.
+def migrate_itunes_tracks_typed(cursor):
+    # Imported here because parse imports this module
+    from parse import build_insert_statement, create_itunes_tracks_table, track_row
+    from metadata import create_itunes_track_changes_table
+
+    cursor.execute("PRAGMA table_info(itunes_tracks)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if 'extra' in columns:
+        return
+
+    # The triggers are dropped while the rows are copied, so the keys, search index
+    # and change log they maintain (the text columns don't change) stay as they are
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'itunes_tracks'")
+    triggers = cursor.fetchall()
+    drop_triggers(cursor, 'itunes_tracks')
+    cursor.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'index' AND tbl_name = 'itunes_tracks' AND sql IS NOT NULL
+    ''')
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP INDEX "{name}"')
+
+    cursor.execute('ALTER TABLE itunes_tracks RENAME TO itunes_tracks_legacy')
+    create_itunes_tracks_table(cursor.connection)
+    drop_triggers(cursor, 'itunes_tracks')
+
+    keys = [column for column in columns if column != 'track_id']
+    selected = ', '.join([f'"{key}"' for key in keys])
+    cursor.execute(f'SELECT track_id, {selected} FROM itunes_tracks_legacy')
+    rows = [
+        track_row(row[0], {key: value for key, value in zip(keys, row[1:]) if value is not None})
+        for row in cursor.fetchall()
+    ]
+    cursor.executemany(build_insert_statement(), rows)
+    cursor.execute('DROP TABLE itunes_tracks_legacy')
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+    existing = {row[0] for row in cursor.fetchall()}
+    for name, sql in triggers:
+        if name not in existing:
+            cursor.execute(sql)
+    create_itunes_track_changes_table(cursor.connection)
+
+def drop_triggers(cursor, table):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ?", (table,))
+    for (name,) in cursor.fetchall():
+        cursor.execute(f'DROP TRIGGER "{name}"')
+
+# Versioned migrations, in order: (version, name, tables it needs, function).
+# A migration runs once all the tables it needs exist (most are created by the
+# crawl or the import), and is recorded in 'schema_migrations' so it never runs
+# again. Append new migrations; never change or renumber applied ones.
+MIGRATIONS = [
+    (1, 'track_links_pairs', ('track_links',), migrate_track_links_pairs),
+    (2, 'track_links_indexes', ('track_links',), migrate_track_links_indexes),
+    (3, 'tracks_indexes', ('tracks',), migrate_tracks_indexes),
+    (4, 'candidate_key_indexes', ('track_keys', 'itunes_track_keys'), migrate_candidate_key_indexes),
+    (5, 'itunes_tracks_typed', ('itunes_tracks',), migrate_itunes_tracks_typed),
+]
+
+# Queries the app runs all the time, with sample parameters. None of them may
+# scan a whole table; see check_query_plans.
+HOT_QUERIES = {
+    'links_by_itunes_track': ('SELECT owntone_track_id FROM track_links WHERE itunes_track_id = ?', (1,)),
+    'links_by_owntone_track': ('SELECT itunes_track_id FROM track_links WHERE owntone_track_id = ?', (1,)),
+    'link_pair_upsert': ('''
+        SELECT id FROM track_links WHERE itunes_track_id = ? AND owntone_track_id = ?
+    ''', (1, 1)),
+    'matches_page': ('''
+        SELECT tl.id, it.Name, ot.title
+        FROM track_links tl
+        JOIN itunes_tracks it ON it.track_id = tl.itunes_track_id
+        JOIN tracks ot ON ot.id = tl.owntone_track_id
+        WHERE tl.id > ?
+        ORDER BY tl.id LIMIT 101
+    ''', (0,)),
+    'album_tracks': ('SELECT id FROM tracks WHERE album_id = ?', ('1',)),
+    'mark_album_fixed': ('''
+        SELECT id
+        FROM tracks
+        WHERE album_id = (
+            SELECT album_id
+            FROM tracks
+            WHERE id = ?
+        ) AND id NOT IN (SELECT track_id FROM fixed_tracks)
+    ''', (1,)),
+    'unrated_tracks': ('SELECT id, title, artist, album FROM tracks WHERE rating = 0', ()),
+    'track_by_path': ('SELECT id FROM tracks WHERE path = ?', ('/music/Music/a/b.mp3',)),
+    'tracks_by_title_and_artist': ('SELECT id FROM tracks WHERE title = ? AND artist = ?', ('a', 'b')),
+    'candidates_by_key': ('''
+        SELECT track_id FROM track_keys WHERE title_key = ? AND artist_key = ?
+    ''', ('a', 'b')),
+}
+
+# A plan step reading every row of a table: 'SCAN tracks', but not
+# 'SCAN tracks USING INDEX ...'
+FULL_SCAN = re.compile(r'^SCAN (\S+)$')
+
+def table_exists(cursor, name):
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
+def create_schema_migrations_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at INTEGER
+        )
+    ''')
+
+def applied_versions(cursor):
+    create_schema_migrations_table(cursor)
+    cursor.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cursor.fetchall()}
+
+def apply_migration(conn, version, name, function):
+    """
+    Applies one migration and records it, in a single transaction: if it fails
+    halfway, every change it made (DDL included) is rolled back.
+
+    The sqlite3 module only opens transactions before DML, so CREATE, ALTER and
+    DROP would otherwise be committed one by one. The transaction is opened
+    explicitly instead, on a connection switched to autocommit meanwhile.
+    """
+    conn.commit()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    try:
+        cursor.execute('BEGIN')
+        try:
+            function(cursor)
+            cursor.execute('INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                           (version, name, int(time.time())))
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+    finally:
+        conn.isolation_level = isolation_level
+
+def apply_named_migration(conn, name):
+    """
+    Applies the migration of MIGRATIONS with the given name now, unless it was
+    applied already, for code that can't wait for the next migrate().
+
+    Returns:
+        bool: Whether it was applied.
+    """
+    applied = applied_versions(conn.cursor())
+    for version, migration_name, _, function in MIGRATIONS:
+        if migration_name == name and version not in applied:
+            apply_migration(conn, version, name, function)
+            return True
+    return False
+
+def migrate(conn, analyze=True, migrations=MIGRATIONS):
+    """
+    Applies every pending migration whose tables exist, each in its own transaction
+    (see apply_migration).
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        analyze (bool): Refresh the query planner statistics afterwards (ANALYZE
+            if anything was applied, otherwise the much cheaper PRAGMA optimize).
+        migrations (list): The migrations to apply, see MIGRATIONS.
+
+    Returns:
+        list: The names of the migrations applied.
+    """
+    cursor = conn.cursor()
+    applied = applied_versions(cursor)
+    conn.commit()
+
+    names = []
+    for version, name, tables, function in migrations:
+        if version in applied:
+            continue
+        if not all(table_exists(cursor, table) for table in tables):
+            continue
+
+        apply_migration(conn, version, name, function)
+        names.append(name)
+
+    if analyze:
+        cursor.execute('ANALYZE' if names else 'PRAGMA optimize')
+        conn.commit()
+
+    return names
+
+def run_migrations(db_path='owntone.db'):
+    """
+    Opens the database, applies the pending migrations and closes it again.
+    """
+    conn = sqlite3.connect(db_path)
+    names = migrate(conn)
+    conn.close()
+    return names
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    """
+    Runs EXPLAIN QUERY PLAN on the hot queries whose tables exist.
+
+    Returns:
+        dict: {query name: [plan steps scanning a whole table]}, only for the
+        queries that do.
+    """
+    cursor = conn.cursor()
+    regressions = {}
+    for name, (query, params) in queries.items():
+        try:
+            cursor.execute(f'EXPLAIN QUERY PLAN {query}', params)
+        except sqlite3.OperationalError:
+            # One of the tables doesn't exist yet
+            continue
+
+        scans = [row[3] for row in cursor.fetchall() if FULL_SCAN.match(row[3])]
+        if scans:
+            regressions[name] = scans
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bring the database schema up to date.')
+    parser.add_argument('--db', default='owntone.db', help='Path to the SQLite database file')
+    parser.add_argument('--status', action='store_true', help='List the migrations and whether they are applied')
+    parser.add_argument('--check', action='store_true',
+                        help='Fail if any hot query would scan a whole table')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+
+    names = migrate(conn)
+    for name in names:
+        print(f"Applied migration {name}.")
+
+    if args.status:
+        applied = applied_versions(conn.cursor())
+        for version, name, _, _ in MIGRATIONS:
+            print(f"{version:4d} {name}: {'applied' if version in applied else 'pending'}")
+
+    if args.check:
+        regressions = check_query_plans(conn)
+        for name, scans in regressions.items():
+            print(f"{name}: {'; '.join(scans)}")
+        conn.close()
+        if regressions:
+            print(f"{len(regressions)} hot queries scan a whole table.")
+            sys.exit(1)
+        print("No hot query scans a whole table.")
+    else:
+        conn.close()
@@ -0,0 +1,218 @@
+import argparse
+import sqlite3
+import threading
+import time
+import requests
+from crawler import OWNTONE_URL, create_session
+from migrations import run_migrations
+
+# Maximum number of ratings sent in one PUT
+DEFAULT_BATCH_SIZE = 200
+
+# Seconds between checks for ratings that are due, when nothing wakes the worker
+DEFAULT_INTERVAL = 5.0
+
+# A failed push is retried after RETRY_BACKOFF * 2^attempts seconds, at most MAX_BACKOFF
+RETRY_BACKOFF = 2.0
+MAX_BACKOFF = 300.0
+
+# Seconds to wait for OwnTone to answer a push
+PUSH_TIMEOUT = 10
+
+# Function to create the 'rating_outbox' table, which holds the ratings saved locally
+# that still have to be pushed to OwnTone. There is one row per track, so saving a
+# track again before it was pushed replaces its pending rating.
+def create_rating_outbox_table(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS rating_outbox (
+            track_id INTEGER PRIMARY KEY,
+            rating INTEGER,
+            queued_at REAL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            last_error TEXT
+        )
+    ''')
+
+def queue_ratings(conn, ratings):
+    """
+    Saves ratings locally and queues them to be pushed to OwnTone, all in one
+    transaction. The rated tracks are marked as fixed.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        ratings (list): (track_id, rating) tuples.
+    """
+    now = time.time()
+    with conn:
+        conn.executemany('UPDATE tracks SET rating = ? WHERE id = ?',
+                         [(rating, track_id) for track_id, rating in ratings])
+        conn.executemany('INSERT OR IGNORE INTO fixed_tracks (track_id) VALUES (?)',
+                         [(track_id,) for track_id, _ in ratings])
+        conn.executemany('''
+            INSERT INTO rating_outbox (track_id, rating, queued_at, attempts, next_attempt_at, last_error)
+            VALUES (?, ?, ?, 0, ?, NULL)
+            ON CONFLICT(track_id) DO UPDATE SET
+                rating = excluded.rating, queued_at = excluded.queued_at, attempts = 0,
+                next_attempt_at = excluded.next_attempt_at, last_error = NULL
+        ''', [(track_id, rating, now, now) for track_id, rating in ratings])
+
+def outbox_status(conn):
+    """
+    Returns:
+        dict: 'pending' (ratings not pushed yet), 'failing' (of which at least one
+        push failed), 'oldest_queued_at' and the most recent 'last_error'.
+    """
+    pending, failing, oldest = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(attempts > 0), 0), MIN(queued_at) FROM rating_outbox
+    ''').fetchone()
+    row = conn.execute('''
+        SELECT last_error FROM rating_outbox
+        WHERE last_error IS NOT NULL
+        ORDER BY next_attempt_at DESC LIMIT 1
+    ''').fetchone()
+    return {
+        'pending': pending,
+        'failing': failing,
+        'oldest_queued_at': oldest,
+        'last_error': row[0] if row else None,
+    }
+
+class RatingOutbox:
+    """
+    Pushes queued ratings to OwnTone from a background thread.
+
+    Due ratings are sent in batches of up to batch_size per PUT to
+    /api/library/tracks. A failed batch is retried with exponential backoff; the
+    retry schedule is stored with the ratings, so it survives restarts. A rating
+    is only removed from the outbox if it wasn't changed again while it was being
+    pushed. on_push, if given, is called with the track ids of every batch pushed.
+    """
+
+    def __init__(self, db_path='owntone.db', base_url=OWNTONE_URL, batch_size=DEFAULT_BATCH_SIZE,
+                 interval=DEFAULT_INTERVAL, timeout=PUSH_TIMEOUT, on_push=None):
+        self.db_path = db_path
+        self.on_push = on_push
+        self.base_url = base_url.rstrip('/')
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        # Failed pushes are retried by the outbox itself, on its own schedule
+        self.session = create_session(pool_size=1, retries=0)
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.last_push_at = None
+
+        conn = sqlite3.connect(db_path)
+        create_rating_outbox_table(conn)
+        conn.commit()
+        conn.close()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def wake(self):
+        """
+        Asks the worker to push now rather than at its next check.
+        """
+        self.wake_event.set()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    self.push_due(conn)
+                except sqlite3.Error as e:
+                    print(f"Rating outbox: database error: {e}")
+                self.wake_event.wait(self.interval)
+                self.wake_event.clear()
+        finally:
+            conn.close()
+
+    def push_due(self, conn):
+        """
+        Pushes every rating that is due, one batch at a time, stopping at the first
+        batch that fails.
+
+        Returns:
+            int: The number of ratings pushed.
+        """
+        pushed = 0
+        while True:
+            batch = conn.execute('''
+                SELECT track_id, rating, queued_at, attempts FROM rating_outbox
+                WHERE next_attempt_at <= ?
+                ORDER BY queued_at
+                LIMIT ?
+            ''', (time.time(), self.batch_size)).fetchall()
+            if not batch:
+                return pushed
+
+            if not self.push_batch(conn, batch):
+                return pushed
+            pushed += len(batch)
+
+    def push_batch(self, conn, batch):
+        payload = {'tracks': [{'id': track_id, 'rating': rating} for track_id, rating, _, _ in batch]}
+        try:
+            response = self.session.put(f'{self.base_url}/api/library/tracks', json=payload,
+                                        timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            now = time.time()
+            with conn:
+                conn.executemany('''
+                    UPDATE rating_outbox
+                    SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?
+                    WHERE track_id = ? AND queued_at = ?
+                ''', [
+                    (now + min(RETRY_BACKOFF * 2 ** attempts, MAX_BACKOFF), str(e), track_id, queued_at)
+                    for track_id, _, queued_at, attempts in batch
+                ])
+            print(f"Rating outbox: push of {len(batch)} ratings failed: {e}")
+            return False
+
+        with conn:
+            conn.executemany('DELETE FROM rating_outbox WHERE track_id = ? AND queued_at = ?',
+                             [(track_id, queued_at) for track_id, _, queued_at, _ in batch])
+        self.last_push_at = time.time()
+        if self.on_push is not None:
+            self.on_push([track_id for track_id, _, _, _ in batch])
+        return True
+
+    def status(self, conn):
+        status = outbox_status(conn)
+        status['last_push_at'] = self.last_push_at
+        return status
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Push the queued ratings to OwnTone.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--all', action='store_true', help='Also push ratings still waiting to be retried')
+    args = parser.parse_args()
+
+    run_migrations()
+    outbox = RatingOutbox('owntone.db', args.url)
+    conn = sqlite3.connect('owntone.db')
+    if args.all:
+        with conn:
+            conn.execute('UPDATE rating_outbox SET next_attempt_at = 0')
+
+    pushed = outbox.push_due(conn)
+    status = outbox_status(conn)
+    conn.close()
+
+    print(f"Pushed {pushed} ratings, {status['pending']} still pending.")
+    if status['last_error']:
+        print(f"Last error: {status['last_error']}")
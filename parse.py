@@ -1,6 +1,92 @@
 import xml.etree.ElementTree as ET
+import calendar
+import json
 import os
 import sqlite3
+import time
+from itertools import islice
+from migrations import apply_named_migration, run_migrations
+from search import create_search_indexes
+from candidates import refresh_itunes_track_keys
+from metadata import create_itunes_track_changes_table
+
+# Known iTunes track keys and their declared types. DATE columns are stored as
+# INTEGER Unix timestamps and booleans as 0/1. Keys not listed here are kept in
+# the JSON 'extra' column.
+ITUNES_COLUMNS = {
+    'Track ID': 'INTEGER',
+    'Name': 'TEXT',
+    'Artist': 'TEXT',
+    'Album Artist': 'TEXT',
+    'Composer': 'TEXT',
+    'Album': 'TEXT',
+    'Grouping': 'TEXT',
+    'Work': 'TEXT',
+    'Genre': 'TEXT',
+    'Kind': 'TEXT',
+    'Size': 'INTEGER',
+    'Total Time': 'INTEGER',
+    'Disc Number': 'INTEGER',
+    'Disc Count': 'INTEGER',
+    'Track Number': 'INTEGER',
+    'Track Count': 'INTEGER',
+    'Year': 'INTEGER',
+    'BPM': 'INTEGER',
+    'Date Modified': 'DATE',
+    'Date Added': 'DATE',
+    'Bit Rate': 'INTEGER',
+    'Sample Rate': 'INTEGER',
+    'Volume Adjustment': 'INTEGER',
+    'Play Count': 'INTEGER',
+    'Play Date': 'INTEGER',
+    'Play Date UTC': 'DATE',
+    'Skip Count': 'INTEGER',
+    'Skip Date': 'DATE',
+    'Release Date': 'DATE',
+    'Rating': 'INTEGER',
+    'Rating Computed': 'INTEGER',
+    'Album Rating': 'INTEGER',
+    'Album Rating Computed': 'INTEGER',
+    'Artwork Count': 'INTEGER',
+    'Compilation': 'INTEGER',
+    'Part Of Gapless Album': 'INTEGER',
+    'Purchased': 'INTEGER',
+    'Disabled': 'INTEGER',
+    'Explicit': 'INTEGER',
+    'Clean': 'INTEGER',
+    'Podcast': 'INTEGER',
+    'Unplayed': 'INTEGER',
+    'Equalizer': 'TEXT',
+    'Comments': 'TEXT',
+    'Sort Name': 'TEXT',
+    'Sort Artist': 'TEXT',
+    'Sort Album Artist': 'TEXT',
+    'Sort Album': 'TEXT',
+    'Sort Composer': 'TEXT',
+    'Persistent ID': 'TEXT',
+    'Track Type': 'TEXT',
+    'Location': 'TEXT',
+    'File Folder Count': 'INTEGER',
+    'Library Folder Count': 'INTEGER',
+}
+
+# Columns of itunes_tracks that get an index
+ITUNES_INDEXED_COLUMNS = ['Name', 'Artist', 'Album', 'Persistent ID']
+
+def parse_itunes_date(date_str):
+    """
+    Convert an iTunes ISO 8601 date (e.g. '2009-03-27T15:37:39Z') to a Unix timestamp.
+    """
+    return calendar.timegm(time.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ'))
+
+# Convert the text of a plist value element to a Python value, by element tag
+PLIST_CONVERTERS = {
+    'integer': int,
+    'real': float,
+    'date': parse_itunes_date,
+    'true': lambda text: 1,
+    'false': lambda text: 0,
+}
 
 def parse_itunes_xml(file_path):
     """
@@ -38,79 +124,274 @@ def parse_itunes_xml(file_path):
 
     return tracks
 
-def create_dynamic_database(db_path, all_keys):
+def iter_itunes_tracks(file_path):
     """
-    Create a SQLite database dynamically based on all possible keys from the iTunes XML file.
-    
+    Incrementally parse an iTunes XML file, yielding one track at a time.
+
+    Unlike parse_itunes_xml, the whole tree is never built: each track dict is
+    cleared from the document as soon as it has been read, so memory use stays
+    flat regardless of the size of the library.
+
     Args:
-        db_path (str): Path to the SQLite database file.
-        all_keys (set): A set of all keys (fields) across all tracks to define table columns.
+        file_path (str): Path to the iTunes XML file.
+
+    Yields:
+        tuple: (track_id, track_info) for every track in the library. Values are
+        converted according to their plist type (integers, dates as Unix
+        timestamps, booleans as 0/1).
+    """
+    # Stack of currently open elements, and the key most recently seen at each level
+    stack = []
+    keys = []
+    tracks_container = None
+
+    for event, elem in ET.iterparse(file_path, events=('start', 'end')):
+        if event == 'start':
+            # The 'Tracks' dict is the dict that follows the top-level 'Tracks' key
+            if elem.tag == 'dict' and len(stack) == 2 and keys[1] == 'Tracks':
+                tracks_container = elem
+            stack.append(elem)
+            keys.append(None)
+            continue
+
+        stack.pop()
+        keys.pop()
+
+        if elem.tag == 'key' and keys:
+            keys[-1] = elem.text
+        elif keys:
+            keys[-1] = None
+
+        if elem is tracks_container:
+            tracks_container = None
+            elem.clear()
+        elif tracks_container is not None and elem.tag == 'dict' and len(stack) == 3:
+            # A complete track dict: read its key/value pairs
+            track_info = {}
+            current_key = None
+            for child in elem:
+                if child.tag == 'key':
+                    current_key = child.text
+                elif current_key:
+                    converter = PLIST_CONVERTERS.get(child.tag)
+                    track_info[current_key] = converter(child.text) if converter else child.text
+                    current_key = None
+
+            # Drop everything read so far from the 'Tracks' dict
+            tracks_container.clear()
+
+            if 'Track ID' in track_info:
+                yield track_info['Track ID'], track_info
+        elif tracks_container is None:
+            # Anything outside the 'Tracks' dict (e.g. the 'Playlists' array) is not needed
+            elem.clear()
+
+def create_itunes_tracks_table(conn):
+    """
+    Create the typed itunes_tracks table and its indexes if they don't already exist.
+
+    A table left over from the old all-TEXT layout (no 'extra' column) is converted
+    first, by the 'itunes_tracks_typed' migration.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
     """
-    conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
 
-    # Dynamically create table columns based on the keys collected from all tracks
-    columns = ', '.join([f"'{key}' TEXT" for key in all_keys])
+    cursor.execute("PRAGMA table_info(itunes_tracks)")
+    existing = [row[1] for row in cursor.fetchall()]
+    if existing and 'extra' not in existing:
+        apply_named_migration(conn, 'itunes_tracks_typed')
+
+    columns = ', '.join([f'"{key}" {sql_type(key)}' for key in ITUNES_COLUMNS])
     cursor.execute(f'''
         CREATE TABLE IF NOT EXISTS itunes_tracks (
             track_id INTEGER PRIMARY KEY,
-            {columns}
+            {columns},
+            extra TEXT
         )
     ''')
 
-    conn.commit()
-    conn.close()
+    for key in ITUNES_INDEXED_COLUMNS:
+        index_name = 'idx_itunes_tracks_' + key.lower().replace(' ', '_')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON itunes_tracks ("{key}")')
+
+    # Log the changed tracks from the start, so the linker never misses any
+    create_itunes_track_changes_table(conn)
+
+def sql_type(key):
+    """
+    Return the SQLite column type used to store the given iTunes key.
+    """
+    declared = ITUNES_COLUMNS[key]
+    return 'INTEGER' if declared == 'DATE' else declared
+
+def coerce_value(key, value):
+    """
+    Convert a value to the type declared for its key in ITUNES_COLUMNS.
+
+    Values coming from iter_itunes_tracks are already typed; this mainly handles the
+    plain-text values produced by parse_itunes_xml.
+    """
+    if not isinstance(value, str):
+        return value
+
+    declared = ITUNES_COLUMNS[key]
+    try:
+        if declared == 'DATE':
+            return parse_itunes_date(value)
+        if declared == 'INTEGER':
+            return int(value)
+        if declared == 'REAL':
+            return float(value)
+    except ValueError:
+        pass
+    return value
+
+def track_row(track_id, track_info):
+    """
+    Build the itunes_tracks row for a track: track_id, every known column in
+    ITUNES_COLUMNS order, then the unknown keys as a JSON object (or None).
+    """
+    row = [int(track_id)]
+    row.extend(coerce_value(key, track_info.get(key)) for key in ITUNES_COLUMNS)
 
-def insert_tracks_into_db(db_path, tracks, all_keys):
+    extra = {key: value for key, value in track_info.items() if key not in ITUNES_COLUMNS}
+    row.append(json.dumps(extra) if extra else None)
+    return row
+
+# Pragmas applied to the import connection when fast bulk loading is requested
+IMPORT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'OFF',
+    'cache_size': -64000,  # Negative values are in KiB, so roughly 64 MB
+}
+
+def set_import_pragmas(conn, pragmas):
+    """
+    Apply import-time pragmas (journal mode, synchronous, cache size) to a connection.
+
+    Args:
+        conn (sqlite3.Connection): Connection used for the import.
+        pragmas (dict): Mapping of pragma name to value.
+    """
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+
+def build_insert_statement():
+    """
+    Build the INSERT statement matching the rows produced by track_row.
+
+    Returns:
+        str: The parameterised INSERT OR REPLACE statement.
+    """
+    keys = ', '.join([f'"{key}"' for key in ITUNES_COLUMNS])
+    placeholders = ', '.join(['?' for _ in ITUNES_COLUMNS])
+    return f"INSERT OR REPLACE INTO itunes_tracks (track_id, {keys}, extra) VALUES (?, {placeholders}, ?)"
+
+def bulk_insert_tracks(conn, tracks, chunk_size=1000):
+    """
+    Insert tracks in chunks with executemany, using one prepared column layout.
+
+    Nothing is committed here; the caller owns the transaction.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        tracks (iterable): (track_id, track_info) pairs.
+        chunk_size (int): Number of rows passed to each executemany call.
+
+    Returns:
+        int: The number of tracks inserted.
+    """
+    statement = build_insert_statement()
+    tracks = iter(tracks)
+    inserted = 0
+
+    while True:
+        chunk = list(islice(tracks, chunk_size))
+        if not chunk:
+            break
+
+        conn.executemany(statement, [track_row(track_id, track_info) for track_id, track_info in chunk])
+        inserted += len(chunk)
+
+    return inserted
+
+def insert_tracks_into_db(db_path, tracks, all_keys=None, chunk_size=1000, pragmas=None):
     """
-    Insert track information into the SQLite database dynamically.
+    Insert track information into the SQLite database in a single transaction.
     
     Args:
         db_path (str): Path to the SQLite database file.
         tracks (dict): A dictionary containing track information.
-        all_keys (set): A set of all keys (fields) across all tracks.
+        all_keys (set): Ignored. The columns are fixed by ITUNES_COLUMNS now, and
+            unknown keys go to the 'extra' column; kept for existing callers.
+        chunk_size (int): Number of rows passed to each executemany call.
+        pragmas (dict): Optional import-time pragmas, e.g. IMPORT_PRAGMAS.
     """
     conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+    if pragmas:
+        set_import_pragmas(conn, pragmas)
+
+    create_itunes_tracks_table(conn)
+    bulk_insert_tracks(conn, tracks.items(), chunk_size)
+    create_search_indexes(conn, rebuild=['itunes_tracks_fts'])
+
+    conn.commit()
+    conn.close()
+
+def stream_tracks_into_db(xml_path, db_path, chunk_size=1000, pragmas=None, search_index=True):
+    """
+    Stream tracks from an iTunes XML file into the SQLite database in bounded chunks.
 
-    for track_id, track_info in tracks.items():
-        # Ensure that all keys exist in the track info (fill missing fields with None)
-        for key in all_keys:
-            if key not in track_info:
-                track_info[key] = None
+    At most chunk_size tracks are held in memory at any time, and the whole import
+    runs in one transaction.
 
-        # Dynamically construct the INSERT statement based on track_info keys
-        keys = ', '.join([f"'{key}'" for key in track_info.keys()])
-        placeholders = ', '.join(['?' for _ in track_info.keys()])
-        values = list(track_info.values())
+    Args:
+        xml_path (str): Path to the iTunes XML file.
+        db_path (str): Path to the SQLite database file.
+        chunk_size (int): Number of tracks inserted per executemany call.
+        pragmas (dict): Optional import-time pragmas, e.g. IMPORT_PRAGMAS.
+        search_index (bool): Whether to rebuild the full-text search index afterwards.
+
+    Returns:
+        tuple: (number of tracks inserted, elapsed seconds).
+    """
+    start = time.perf_counter()
 
-        cursor.execute(f'''
-            INSERT OR REPLACE INTO itunes_tracks (
-                track_id, {keys}
-            ) VALUES (?, {placeholders})
-        ''', [track_id] + values)
+    conn = sqlite3.connect(db_path)
+    if pragmas:
+        set_import_pragmas(conn, pragmas)
+
+    create_itunes_tracks_table(conn)
+    inserted = bulk_insert_tracks(conn, iter_itunes_tracks(xml_path), chunk_size)
+
+    # Rebuild the search index once, rather than updating it row by row
+    if search_index:
+        create_search_indexes(conn, rebuild=['itunes_tracks_fts'])
 
     conn.commit()
     conn.close()
 
+    return inserted, time.perf_counter() - start
+
 if __name__ == "__main__":
     # Get the path of the current directory and the itunes.xml file
     current_directory = os.path.dirname(os.path.abspath(__file__))
     xml_file_path = os.path.join(current_directory, 'itunes.xml')
     db_file_path = os.path.join(current_directory, 'owntone.db')
 
-    # Parse the iTunes XML and extract tracks
-    tracks = parse_itunes_xml(xml_file_path)
+    # Stream the tracks from the iTunes XML straight into the database
+    inserted, elapsed = stream_tracks_into_db(xml_file_path, db_file_path, pragmas=IMPORT_PRAGMAS)
 
-    # Collect all unique keys (fields) across all tracks
-    all_keys = set()
-    for track_info in tracks.values():
-        all_keys.update(track_info.keys())
-    print(f"Captured {len(all_keys)} keys")
+    # Precompute the keys the unmatched-track candidates are found with
+    conn = sqlite3.connect(db_file_path)
+    refresh_itunes_track_keys(conn, full=True)
+    conn.close()
 
-    # Create the database and insert the tracks using the collected keys
-    if tracks:
-        create_dynamic_database(db_file_path, all_keys)
-        insert_tracks_into_db(db_file_path, tracks, all_keys)
+    # Bring the schema up to date and refresh the planner statistics for the new rows
+    run_migrations(db_file_path)
 
-    print(f"Inserted {len(tracks)} tracks into the database: {db_file_path}")
+    print(f"Inserted {inserted} tracks into the database: {db_file_path}")
+    if elapsed > 0:
+        print(f"Import took {elapsed:.2f}s ({inserted / elapsed:.0f} rows/s)")
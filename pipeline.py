@@ -0,0 +1,359 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from crawler import OwnToneCrawler, OWNTONE_URL, DEFAULT_CONCURRENCY
+from migrations import run_migrations
+
+# Fields of OwnTone's /api/library that change when its library does. While
+# OwnTone is rescanning ('updating') the crawl always runs. Ratings and play counts
+# edited in OwnTone change none of them, so they are only crawled along with the
+# next library change, or with --force.
+LIBRARY_FINGERPRINT_FIELDS = ('artists', 'albums', 'songs', 'db_playtime', 'updated_at')
+
+# The iTunes XML is parsed into this database first, so parsing doesn't hold
+# owntone.db's write lock while the crawl is writing
+STAGING_DB = 'itunes_import.db'
+STAGING_PRAGMAS = {
+    'journal_mode': 'OFF',
+    'synchronous': 'OFF',
+    'cache_size': -64000,
+}
+
+# Function to create the 'pipeline_state' table, holding the fingerprint of the
+# inputs every stage last completed with
+def create_pipeline_state_table():
+    conn = sqlite3.connect('owntone.db')
+    cursor = conn.cursor()
+
+    # Create the 'pipeline_state' table if it doesn't already exist
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pipeline_state (
+            stage TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            finished_at REAL,
+            seconds REAL,
+            summary TEXT
+        )
+    ''')
+
+    # Commit and close the connection
+    conn.commit()
+    conn.close()
+
+def load_pipeline_state():
+    conn = sqlite3.connect('owntone.db')
+    state = {stage: fingerprint for stage, fingerprint in conn.execute('SELECT stage, fingerprint FROM pipeline_state')}
+    conn.close()
+    return state
+
+def save_pipeline_state(stage, fingerprint, seconds, summary):
+    conn = sqlite3.connect('owntone.db')
+    with conn:
+        conn.execute('''
+            INSERT OR REPLACE INTO pipeline_state (stage, fingerprint, finished_at, seconds, summary)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (stage, fingerprint, time.time(), seconds, summary))
+    conn.close()
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    run(context) does the work and returns a one-line summary. fingerprint(context)
+    describes the stage's own inputs (None if they can't be known, which makes the
+    stage always run). A stage runs after the stages in 'after', and by default its
+    inputs include theirs, so it reruns whenever one of them had new inputs. With
+    chained=False only its own fingerprint counts, for stages that fingerprint the
+    actual data they read.
+    """
+
+    def __init__(self, name, run, after=(), fingerprint=None, chained=True, description=''):
+        self.name = name
+        self.run = run
+        self.after = tuple(after)
+        self.fingerprint = fingerprint or (lambda context: '')
+        self.chained = chained
+        self.description = description
+
+    def key(self, context, upstream_keys):
+        own = self.fingerprint(context)
+        if own is None:
+            # Unknown inputs: this stage runs, and so do the ones after it
+            own = f'unknown {time.time()}'
+        parts = [self.name, own]
+        if self.chained:
+            parts.append({name: upstream_keys.get(name) for name in self.after})
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Function to parse the iTunes XML into the staging database, then copy it into
+# owntone.db in one transaction
+def run_import(context):
+    from parse import create_itunes_tracks_table, stream_tracks_into_db
+    from search import create_search_indexes
+    from candidates import refresh_itunes_track_keys
+
+    if os.path.exists(STAGING_DB):
+        os.remove(STAGING_DB)
+    inserted, _ = stream_tracks_into_db(context['xml'], STAGING_DB, pragmas=STAGING_PRAGMAS, search_index=False)
+
+    with context['write_lock']:
+        conn = sqlite3.connect('owntone.db')
+        create_itunes_tracks_table(conn)
+        conn.execute('ATTACH DATABASE ? AS staging', (STAGING_DB,))
+        columns = ', '.join(f'"{row[1]}"' for row in conn.execute('PRAGMA staging.table_info(itunes_tracks)'))
+        with conn:
+            conn.execute(f'INSERT OR REPLACE INTO itunes_tracks ({columns}) '
+                         f'SELECT {columns} FROM staging.itunes_tracks')
+        conn.execute('DETACH DATABASE staging')
+
+        # Same follow-up as parse.py: the search index is rebuilt once, and the
+        # candidate keys recomputed
+        create_search_indexes(conn, rebuild=['itunes_tracks_fts'])
+        refresh_itunes_track_keys(conn, full=True)
+        conn.commit()
+        conn.close()
+
+    os.remove(STAGING_DB)
+    return f'{inserted} iTunes tracks imported'
+
+def fingerprint_itunes_xml(context):
+    return file_digest(context['xml'])
+
+# Function to bring the tables holding the OwnTone library up to date, like sync.py
+def run_crawl(context):
+    from artists import create_database
+    from albums import create_albums_table
+    from tracks import create_tracks_table
+    from sync import create_sync_state_table, sync_library
+    from search import create_search_indexes
+
+    with context['write_lock']:
+        create_database()
+        create_albums_table()
+        create_tracks_table()
+        create_sync_state_table()
+        run_migrations()
+
+        with OwnToneCrawler(context['url'], context['concurrency']) as crawler:
+            sync_library(crawler, context['full'])
+
+        conn = sqlite3.connect('owntone.db')
+        create_search_indexes(conn)
+        conn.commit()
+        tracks = conn.execute('SELECT COUNT(*) FROM tracks').fetchone()[0]
+        conn.close()
+    return f'{tracks} OwnTone tracks'
+
+def fingerprint_owntone_library(context):
+    """
+    Fingerprints OwnTone's library totals, so the crawl runs again once tracks were
+    added, removed or rescanned. Rating and play-count edits are not seen.
+    """
+    with OwnToneCrawler(context['url'], 1) as crawler:
+        library = crawler.fetch_json('/api/library')
+    if library.get('updating'):
+        return None
+    return json.dumps({field: library.get(field) for field in LIBRARY_FINGERPRINT_FIELDS}, sort_keys=True)
+
+# Function to link the iTunes tracks to the OwnTone tracks, like link.py
+def run_link(context):
+    from link import create_links_for_matching_tracks
+
+    with context['write_lock']:
+        create_links_for_matching_tracks(context['full'])
+        conn = sqlite3.connect('owntone.db')
+        links = conn.execute('SELECT COUNT(*) FROM track_links').fetchone()[0]
+        conn.close()
+    return f'{links} links'
+
+# Function to check the tags of the new and changed tracks against their paths
+def run_validate(context):
+    from metadata import refresh_track_keys
+
+    with context['write_lock']:
+        conn = sqlite3.connect('owntone.db')
+        checked = refresh_track_keys(conn)
+        incorrect = conn.execute('SELECT COUNT(*) FROM track_keys WHERE mismatch = 1').fetchone()[0]
+        conn.close()
+    return f'{checked} tracks checked, {incorrect} incorrect in total'
+
+# Function to apply the iTunes metadata to songs3.db, like update.py. The
+# migrations run first, as the update refuses an iTunes table of the old layout.
+def run_update(context):
+    from update import update_files_table
+
+    with context['write_lock']:
+        run_migrations()
+        staged, updated, _ = update_files_table('owntone.db', context['songs_db'])
+    return f'{updated} files updated from {staged} linked tracks'
+
+def fingerprint_linked_rows(context):
+    """
+    Fingerprints the rows update.py would apply. The update adds the iTunes counts
+    to songs3.db's, so it must only run again when they changed.
+    """
+    from update import LINKED_ITUNES_ROWS
+
+    if not os.path.exists(context['songs_db']):
+        raise FileNotFoundError(f"{context['songs_db']} not found")
+
+    digest = hashlib.sha256(context['songs_db'].encode('utf-8'))
+    conn = sqlite3.connect('owntone.db')
+    for row in conn.execute(f"{LINKED_ITUNES_ROWS.format(schema='main')} ORDER BY tl.owntone_track_id"):
+        digest.update(repr(row).encode('utf-8'))
+    conn.close()
+    return digest.hexdigest()
+
+STAGES = [
+    Stage('import', run_import, fingerprint=fingerprint_itunes_xml,
+          description='Import the iTunes XML'),
+    Stage('crawl', run_crawl, fingerprint=fingerprint_owntone_library,
+          description='Crawl the OwnTone library'),
+    Stage('link', run_link, after=('import', 'crawl'),
+          description='Link iTunes tracks to OwnTone tracks'),
+    Stage('validate', run_validate, after=('crawl',),
+          description='Check track tags against their paths'),
+    Stage('update', run_update, after=('link',), fingerprint=fingerprint_linked_rows, chained=False,
+          description='Apply the iTunes metadata to songs3.db'),
+]
+
+# Stages run unless others are asked for
+DEFAULT_STAGES = ['import', 'crawl', 'link', 'validate']
+
+class Pipeline:
+    """
+    Runs stages in dependency order, as many at once as jobs allows.
+
+    A stage whose inputs have the same fingerprint as when it last completed is
+    skipped. A stage that fails blocks the stages after it, but not the others.
+    Stages that share owntone.db take context['write_lock'] around their writes.
+    """
+
+    def __init__(self, stages, jobs=2, force=False):
+        self.stages = stages
+        self.jobs = jobs
+        self.force = force
+
+    def run(self, context):
+        """
+        Returns:
+            dict: For every stage, its 'status' ('ran', 'skipped', 'failed' or
+            'blocked'), 'seconds' and 'summary'.
+        """
+        create_pipeline_state_table()
+        stored = load_pipeline_state()
+        context.setdefault('write_lock', threading.Lock())
+
+        # Stages that aren't part of this run count with the inputs they last ran with
+        keys = dict(stored)
+        results = {}
+        pending = {stage.name: stage for stage in self.stages}
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(dep in pending or dep in running.values() for dep in stage.after):
+                        continue
+                    del pending[name]
+
+                    failed = [dep for dep in stage.after if results.get(dep, {}).get('status') in ('failed', 'blocked')]
+                    if failed:
+                        results[name] = {'status': 'blocked', 'seconds': 0.0, 'summary': f"{', '.join(failed)} failed"}
+                        print(f"[{name}] Blocked: {results[name]['summary']}")
+                        continue
+
+                    print(f"[{name}] {stage.description}")
+                    running[executor.submit(self.run_stage, stage, context, keys, stored)] = name
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], key = future.result()
+                    if key is not None:
+                        keys[name] = key
+                    print(f"[{name}] {results[name]['status'].capitalize()} in {results[name]['seconds']:.2f}s: "
+                          f"{results[name]['summary']}")
+
+        return results
+
+    def run_stage(self, stage, context, keys, stored):
+        start = time.perf_counter()
+        try:
+            key = stage.key(context, keys)
+            if not self.force and stored.get(stage.name) == key:
+                return {'status': 'skipped', 'seconds': time.perf_counter() - start,
+                        'summary': 'inputs unchanged'}, key
+
+            summary = stage.run(context)
+            seconds = time.perf_counter() - start
+            with context['write_lock']:
+                save_pipeline_state(stage.name, key, seconds, summary)
+            return {'status': 'ran', 'seconds': seconds, 'summary': summary}, key
+        except Exception as e:
+            # Reported with the other results; the stages after this one are blocked
+            return {'status': 'failed', 'seconds': time.perf_counter() - start,
+                    'summary': f'{type(e).__name__}: {e}'}, None
+
+def print_results(results, elapsed):
+    print(f"{'Stage':<10} {'Status':<8} {'Seconds':>8}  Summary")
+    for name, result in results.items():
+        print(f"{name:<10} {result['status']:<8} {result['seconds']:8.2f}  {result['summary']}")
+    total = sum(result['seconds'] for result in results.values())
+    print(f"Finished in {elapsed:.2f}s ({total:.2f}s of stage time).")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import, crawl, link and validate in one go, skipping the '
+                                                 'steps whose inputs have not changed.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight at once')
+    parser.add_argument('--xml', default='itunes.xml', help='Path to the iTunes Library XML file')
+    parser.add_argument('--songs-db', default='songs3.db', help="Path to OwnTone's songs3.db (update stage)")
+    parser.add_argument('--stages', default=','.join(DEFAULT_STAGES),
+                        help=f"Comma-separated stages to run, out of {', '.join(stage.name for stage in STAGES)}")
+    parser.add_argument('--jobs', type=int, default=2, help='Maximum number of stages running at once')
+    parser.add_argument('--force', action='store_true', help='Run the stages even if their inputs are unchanged')
+    parser.add_argument('--full', action='store_true',
+                        help='Recrawl and relink everything rather than only what changed (implies --force)')
+    args = parser.parse_args()
+
+    names = args.stages.split(',')
+    unknown = set(names) - {stage.name for stage in STAGES}
+    if unknown:
+        parser.error(f"Unknown stages: {', '.join(sorted(unknown))}")
+
+    context = {
+        'url': args.url,
+        'concurrency': args.concurrency,
+        'xml': args.xml,
+        'songs_db': args.songs_db,
+        'full': args.full,
+    }
+    pipeline = Pipeline([stage for stage in STAGES if stage.name in names], args.jobs, args.force or args.full)
+
+    start = time.perf_counter()
+    results = pipeline.run(context)
+
+    # Refresh the planner statistics once, after everything was written
+    run_migrations()
+    print_results(results, time.perf_counter() - start)
+
+    if any(result['status'] in ('failed', 'blocked') for result in results.values()):
+        sys.exit(1)
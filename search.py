@@ -0,0 +1,230 @@
+import argparse
+import re
+import sqlite3
+from migrations import migrate
+
+# Full-text indexes, by name: (content table, rowid column, indexed columns, kept in
+# sync by triggers). The indexes use external content, so they store only the
+# index itself and read the column values back from the content table.
+#
+# itunes_tracks is only ever written by the XML import, which replaces rows with
+# INSERT OR REPLACE. That doesn't fire delete triggers, so its index is rebuilt
+# after every import instead.
+SEARCH_INDEXES = {
+    'tracks_fts': ('tracks', 'id', ('title', 'artist', 'album', 'genre'), True),
+    'itunes_tracks_fts': ('itunes_tracks', 'track_id', ('Name', 'Artist', 'Album', 'Genre'), False),
+}
+
+# bm25 weights of the indexed columns, in order: title matches count the most
+COLUMN_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+
+# Case- and accent-insensitive tokenizer
+TOKENIZER = 'unicode61 remove_diacritics 2'
+
+# Words of a search, as the tokenizer sees them
+WORD_PATTERN = re.compile(r'\w+')
+
+# Default maximum number of results
+DEFAULT_LIMIT = 50
+
+def table_exists(conn, name):
+    cursor = conn.execute('SELECT 1 FROM sqlite_master WHERE name = ?', (name,))
+    return cursor.fetchone() is not None
+
+def create_search_indexes(conn, rebuild=()):
+    """
+    Create the full-text indexes (and their triggers) for the content tables that
+    exist. New indexes are filled from their table straight away.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the SQLite database.
+        rebuild (iterable): Names of existing indexes to rebuild too, e.g. after an import.
+    """
+    for name, (table, key, columns, triggers) in SEARCH_INDEXES.items():
+        if not table_exists(conn, table):
+            continue
+
+        created = not table_exists(conn, name)
+        conn.execute(f'''
+            CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5(
+                {', '.join([f'"{column}"' for column in columns])},
+                content='{table}', content_rowid='{key}', tokenize='{TOKENIZER}'
+            )
+        ''')
+        if triggers:
+            create_search_triggers(conn, name)
+        if created or name in rebuild:
+            rebuild_search_index(conn, name)
+
+def create_search_triggers(conn, name):
+    """
+    Create the triggers keeping an index in step with inserts, updates and deletes
+    on its content table. Updates that leave the indexed columns as they were
+    don't touch the index.
+    """
+    table, key, columns, _ = SEARCH_INDEXES[name]
+    column_list = ', '.join([f'"{column}"' for column in columns])
+    new_values = ', '.join([f'NEW."{column}"' for column in columns])
+    old_values = ', '.join([f'OLD."{column}"' for column in columns])
+
+    insert_new = f'INSERT INTO {name} (rowid, {column_list}) VALUES (NEW.{key}, {new_values});'
+    delete_old = (f"INSERT INTO {name} ({name}, rowid, {column_list}) "
+                  f"VALUES ('delete', OLD.{key}, {old_values});")
+    changed = ' OR '.join([f'NEW."{column}" IS NOT OLD."{column}"' for column in columns])
+
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_after_insert AFTER INSERT ON {table}
+        BEGIN
+            {insert_new}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_after_update
+        AFTER UPDATE OF {column_list} ON {table}
+        WHEN {changed}
+        BEGIN
+            {delete_old}
+            {insert_new}
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS {name}_after_delete AFTER DELETE ON {table}
+        BEGIN
+            {delete_old}
+        END
+    ''')
+
+def rebuild_search_index(conn, name):
+    """
+    Rebuild an index from scratch from its content table.
+    """
+    conn.execute(f"INSERT INTO {name} ({name}) VALUES ('rebuild')")
+
+def build_match_query(text=None, **fields):
+    """
+    Build an FTS5 MATCH expression from free text and per-column terms.
+
+    Every word is matched as a prefix ('beat' finds 'Beatles') and all words must
+    match. Punctuation is dropped, so user input can't break the expression.
+
+    Args:
+        text (str): Words matched against any indexed column.
+        **fields: Words matched against one column each, e.g. artist='beatles'.
+
+    Returns:
+        str: The MATCH expression, or None if there is nothing to search for.
+    """
+    terms = [f'"{word}"*' for word in WORD_PATTERN.findall(text or '')]
+    for column, value in fields.items():
+        terms.extend(f'"{column}" : "{word}"*' for word in WORD_PATTERN.findall(value or ''))
+    return ' AND '.join(terms) or None
+
+def rank_expression(name):
+    """
+    The bm25() call ranking results of an index (lower is better).
+    """
+    columns = SEARCH_INDEXES[name][2]
+    weights = ', '.join([str(weight) for weight in COLUMN_WEIGHTS[:len(columns)]])
+    return f'bm25({name}, {weights})'
+
+def search(conn, name, text=None, limit=DEFAULT_LIMIT, **fields):
+    """
+    Search an index.
+
+    Returns:
+        list: The matching rowids (ids of the content table), best match first.
+    """
+    match = build_match_query(text, **fields)
+    if match is None:
+        return []
+
+    cursor = conn.execute(f'''
+        SELECT rowid FROM {name}
+        WHERE {name} MATCH ?
+        ORDER BY {rank_expression(name)}
+        LIMIT ?
+    ''', (match, limit))
+    return [row[0] for row in cursor.fetchall()]
+
+def match_filter(name, key_column, text=None, **fields):
+    """
+    Build a WHERE condition restricting a query on an index's content table to the
+    rows matching a search, so it can be combined with other filters, sorting and
+    pagination.
+
+    Returns:
+        tuple: (condition, params), or (None, []) if there is nothing to search for.
+    """
+    match = build_match_query(text, **fields)
+    if match is None:
+        return None, []
+    return f'{key_column} IN (SELECT rowid FROM {name} WHERE {name} MATCH ?)', [match]
+
+def search_tracks(conn, text=None, title=None, artist=None, album=None, limit=DEFAULT_LIMIT):
+    """
+    Search the OwnTone tracks, best match first.
+
+    Returns:
+        list: (id, title, artist, album) tuples.
+    """
+    fields = {'title': title, 'artist': artist, 'album': album}
+    match = build_match_query(text, **fields)
+    if match is None:
+        return []
+
+    cursor = conn.execute(f'''
+        SELECT t.id, t.title, t.artist, t.album
+        FROM tracks_fts
+        JOIN tracks t ON t.id = tracks_fts.rowid
+        WHERE tracks_fts MATCH ?
+        ORDER BY {rank_expression('tracks_fts')}
+        LIMIT ?
+    ''', (match, limit))
+    return cursor.fetchall()
+
+def search_itunes_tracks(conn, text=None, name=None, artist=None, album=None, limit=DEFAULT_LIMIT):
+    """
+    Search the iTunes tracks, best match first.
+
+    Returns:
+        list: (track_id, Name, Artist, Album) tuples.
+    """
+    fields = {'Name': name, 'Artist': artist, 'Album': album}
+    match = build_match_query(text, **fields)
+    if match is None:
+        return []
+
+    cursor = conn.execute(f'''
+        SELECT it.track_id, it.Name, it.Artist, it.Album
+        FROM itunes_tracks_fts
+        JOIN itunes_tracks it ON it.track_id = itunes_tracks_fts.rowid
+        WHERE itunes_tracks_fts MATCH ?
+        ORDER BY {rank_expression('itunes_tracks_fts')}
+        LIMIT ?
+    ''', (match, limit))
+    return cursor.fetchall()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search the OwnTone and iTunes tracks.')
+    parser.add_argument('text', nargs='?', help='Words to search for in any column')
+    parser.add_argument('--title', help='Words to search for in the title')
+    parser.add_argument('--artist', help='Words to search for in the artist')
+    parser.add_argument('--album', help='Words to search for in the album')
+    parser.add_argument('--itunes', action='store_true', help='Search the iTunes tracks instead')
+    parser.add_argument('--limit', type=int, default=DEFAULT_LIMIT, help='Maximum number of results')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the indexes before searching')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect('owntone.db')
+    migrate(conn)
+    create_search_indexes(conn, SEARCH_INDEXES if args.rebuild else ())
+    conn.commit()
+
+    if args.itunes:
+        results = search_itunes_tracks(conn, args.text, args.title, args.artist, args.album, args.limit)
+    else:
+        results = search_tracks(conn, args.text, args.title, args.artist, args.album, args.limit)
+    conn.close()
+
+    for row in results:
+        print(' | '.join([str(value) for value in row]))
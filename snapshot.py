@@ -0,0 +1,400 @@
+import sqlite3
+import sys
+import threading
+from array import array
+from itertools import chain
+from metadata import create_itunes_track_changes_table, create_track_changes_table, normalize_string
+from matcher import DURATION_TOLERANCE, artist_key, to_int
+
+# NumPy is optional: with it, comparisons run as whole-column array operations,
+# without it as loops over the same columns
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Code stored for a value that is missing (e.g. a path that couldn't be parsed)
+MISSING = -1
+
+class StringPool:
+    """
+    Dictionary-encodes strings: every distinct string is interned once and
+    stored by its integer code, shared by all the columns of a snapshot, so equal
+    keys have equal codes across tables. Raw values are normalized once per
+    distinct value, not once per row.
+    """
+
+    def __init__(self):
+        self.codes = {}
+        self.values = []
+        self.normalized = {}
+        self.artist_keys = {}
+        self.empty = self.code('')
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(sys.intern(value))
+        return code
+
+    def normalized_code(self, raw):
+        code = self.normalized.get(raw)
+        if code is None:
+            code = self.normalized[raw] = self.code(normalize_string(raw))
+        return code
+
+    def artist_code(self, raw):
+        code = self.artist_keys.get(raw)
+        if code is None:
+            code = self.artist_keys[raw] = self.code(artist_key(raw))
+        return code
+
+class ColumnTable:
+    """
+    Rows of one table stored column by column in int64 arrays, with a position
+    per id. Removed rows are only flagged until the table is compacted.
+    """
+
+    def __init__(self, columns):
+        self.names = columns
+        self.ids = array('q')
+        self.alive = array('b')
+        self.columns = {name: array('q') for name in columns}
+        self.positions = {}
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def upsert(self, id, values):
+        position = self.positions.get(id)
+        if position is None:
+            self.positions[id] = len(self.ids)
+            self.ids.append(id)
+            self.alive.append(1)
+            for name, value in zip(self.names, values):
+                self.columns[name].append(value)
+        else:
+            for name, value in zip(self.names, values):
+                self.columns[name][position] = value
+
+    def remove(self, id):
+        position = self.positions.pop(id, None)
+        if position is not None:
+            self.alive[position] = 0
+            self.removed += 1
+
+    def compact(self):
+        if self.removed * 2 <= len(self.ids):
+            return
+        keep = [position for position, alive in enumerate(self.alive) if alive]
+        self.ids = array('q', [self.ids[position] for position in keep])
+        self.alive = array('b', [1] * len(keep))
+        for name in self.names:
+            column = self.columns[name]
+            self.columns[name] = array('q', [column[position] for position in keep])
+        self.positions = {id: position for position, id in enumerate(self.ids)}
+        self.removed = 0
+
+    def select(self, ids=None):
+        """
+        Returns the positions of the given ids (or of every row), skipping unknown ids.
+        """
+        if ids is None:
+            return [position for position in self.positions.values()]
+        return [self.positions[id] for id in ids if id in self.positions]
+
+    def gather(self, name, positions):
+        """
+        Returns a column's values at the given positions, as a NumPy array if
+        NumPy is available, as a list otherwise.
+        """
+        column = self.ids if name == 'id' else self.columns[name]
+        if np is not None:
+            return np.frombuffer(column, dtype=np.int64)[np.asarray(positions, dtype=np.int64)]
+        return [column[position] for position in positions]
+
+class LibrarySnapshot:
+    """
+    An in-memory, columnar copy of the fields of 'tracks' and 'itunes_tracks' that
+    matching and validation compare, with every string normalized and
+    dictionary-encoded (see StringPool).
+
+    The first refresh() loads everything; later ones only reload the tracks
+    logged in 'track_changes' and 'itunes_track_changes' since.
+    """
+
+    TRACK_COLUMNS = ('title', 'artist', 'album', 'artist_block', 'duration', 'track_number',
+                     'path_title', 'path_artist', 'path_album')
+    ITUNES_COLUMNS = ('title', 'album', 'artist_block', 'duration', 'track_number')
+
+    TRACKS_QUERY = 'SELECT id, title, artist, album, length_ms, track_number, path FROM tracks'
+    ITUNES_QUERY = 'SELECT track_id, Name, Artist, Album, "Total Time", "Track Number" FROM itunes_tracks'
+
+    def __init__(self, db_path='owntone.db'):
+        self.db_path = db_path
+        self.pool = StringPool()
+        self.tracks = ColumnTable(self.TRACK_COLUMNS)
+        self.itunes = ColumnTable(self.ITUNES_COLUMNS)
+        self.tracks_seq = None
+        self.itunes_seq = None
+        self.lock = threading.Lock()
+
+    def refresh(self, conn=None):
+        """
+        Brings the snapshot up to date with the database.
+
+        Returns:
+            tuple: (number of tracks reloaded, number of iTunes tracks reloaded).
+        """
+        own_conn = conn is None
+        if own_conn:
+            conn = sqlite3.connect(self.db_path)
+        create_track_changes_table(conn)
+        create_itunes_track_changes_table(conn)
+        conn.commit()
+
+        with self.lock:
+            tracks = self._refresh_tracks(conn)
+            itunes = self._refresh_itunes(conn)
+
+        if own_conn:
+            conn.close()
+        return tracks, itunes
+
+    def _refresh_tracks(self, conn):
+        changed, last_seq = self._changed_since(conn, 'track_changes', self.tracks_seq)
+        if changed is None:
+            self.tracks = ColumnTable(self.TRACK_COLUMNS)
+            loaded = self._load_tracks(conn.execute(self.TRACKS_QUERY))
+        else:
+            for track_id in changed:
+                self.tracks.remove(track_id)
+            loaded = 0
+            for chunk in _id_chunks(changed):
+                placeholders = ', '.join(['?' for _ in chunk])
+                loaded += self._load_tracks(conn.execute(f'{self.TRACKS_QUERY} WHERE id IN ({placeholders})', chunk))
+            self.tracks.compact()
+
+        self.tracks_seq = last_seq
+        return loaded
+
+    def _changed_since(self, conn, log, seq):
+        """
+        Reads the ids logged in a change log after seq.
+
+        Returns:
+            tuple: (the distinct ids, or None if everything must be reloaded: the
+            first time, or if the log was pruned past seq; the last seq logged).
+        """
+        last_seq, first_seq = conn.execute(f'SELECT MAX(seq), MIN(seq) FROM {log}').fetchone()
+        last_seq = last_seq or 0
+        if seq is None or (first_seq is not None and first_seq > seq + 1):
+            return None, last_seq
+        changed = [row[0] for row in conn.execute(
+            f'SELECT DISTINCT track_id FROM {log} WHERE seq > ? AND seq <= ?', (seq, last_seq))]
+        return changed, last_seq
+
+    def _load_tracks(self, rows):
+        # Imported here because validate imports metadata, like this module
+        from validate import parse_track_path
+
+        pool = self.pool
+        loaded = 0
+        for track_id, title, artist, album, length_ms, track_number, path in rows:
+            path_artist, path_album, path_title = parse_track_path(path)
+            if path_artist and path_title:
+                path_codes = (pool.normalized_code(path_title), pool.normalized_code(path_artist),
+                              pool.normalized_code(path_album) if path_album else MISSING)
+                if path_codes[2] == pool.empty:
+                    path_codes = path_codes[:2] + (MISSING,)
+            else:
+                path_codes = (MISSING, MISSING, MISSING)
+
+            self.tracks.upsert(track_id, (
+                pool.normalized_code(title), pool.normalized_code(artist), pool.normalized_code(album),
+                pool.artist_code(artist), to_int(length_ms) or 0, to_int(track_number) or 0,
+            ) + path_codes)
+            loaded += 1
+        return loaded
+
+    def _refresh_itunes(self, conn):
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'itunes_tracks'").fetchone():
+            # No iTunes import yet
+            return 0
+
+        changed, last_seq = self._changed_since(conn, 'itunes_track_changes', self.itunes_seq)
+        if changed is None:
+            self.itunes = ColumnTable(self.ITUNES_COLUMNS)
+            loaded = self._load_itunes(conn.execute(self.ITUNES_QUERY))
+        else:
+            for track_id in changed:
+                self.itunes.remove(track_id)
+            loaded = 0
+            for chunk in _id_chunks(changed):
+                placeholders = ', '.join(['?' for _ in chunk])
+                loaded += self._load_itunes(
+                    conn.execute(f'{self.ITUNES_QUERY} WHERE track_id IN ({placeholders})', chunk))
+            self.itunes.compact()
+
+        self.itunes_seq = last_seq
+        return loaded
+
+    def _load_itunes(self, rows):
+        pool = self.pool
+        loaded = 0
+        for track_id, name, artist, album, duration, track_number in rows:
+            self.itunes.upsert(track_id, (
+                pool.normalized_code(name), pool.normalized_code(album), pool.artist_code(artist),
+                to_int(duration) or 0, to_int(track_number) or 0,
+            ))
+            loaded += 1
+        return loaded
+
+    def issues(self, track_ids=None, workers=None):
+        """
+        Runs the checks of validate.CHECKS. The built-in ones (check_artist,
+        check_album and check_title) run over whole columns: a track fails one if
+        its path could be parsed and the normalized value from its path differs
+        from its tag. Any other check runs track by track through
+        validate.analyze_track, on the tracks as stored in the database.
+
+        Args:
+            track_ids (list): Tracks to check (default: all of them).
+            workers (int): Number of worker processes for the other checks, see
+                validate.validate_tracks.
+
+        Returns:
+            dict: For every check, the ids of the tracks failing it.
+        """
+        # Imported here because validate imports metadata, like this module
+        from validate import CHECKS, check_album, check_artist, check_title
+
+        with self.lock:
+            table = self.tracks
+            positions = table.select(track_ids)
+            ids = table.gather('id', positions)
+            column = {name: table.gather(name, positions) for name in self.TRACK_COLUMNS}
+
+        if np is not None:
+            parsed = column['path_artist'] != MISSING
+            failed = {
+                check_artist: parsed & (column['path_artist'] != column['artist']),
+                check_album: parsed & (column['path_album'] != MISSING) & (column['path_album'] != column['album']),
+                check_title: parsed & (column['path_title'] != column['title']),
+            }
+            vectorized = {check: ids[mask].tolist() for check, mask in failed.items()}
+            ids = ids.tolist()
+        else:
+            vectorized = {check_artist: [], check_album: [], check_title: []}
+            for i, track_id in enumerate(ids):
+                path_artist = column['path_artist'][i]
+                if path_artist == MISSING:
+                    continue
+                if path_artist != column['artist'][i]:
+                    vectorized[check_artist].append(track_id)
+                path_album = column['path_album'][i]
+                if path_album != MISSING and path_album != column['album'][i]:
+                    vectorized[check_album].append(track_id)
+                if column['path_title'][i] != column['title'][i]:
+                    vectorized[check_title].append(track_id)
+
+        issues = {name: vectorized[check] for name, check in CHECKS.items() if check in vectorized}
+        others = {name: check for name, check in CHECKS.items() if check not in vectorized}
+        if others:
+            issues.update(self._run_checks(others, None if track_ids is None else ids, workers))
+        return {name: issues[name] for name in CHECKS}
+
+    def _run_checks(self, checks, track_ids, workers):
+        # Imported here, see _load_tracks
+        from validate import iter_tracks, validate_tracks
+
+        conn = sqlite3.connect(self.db_path)
+        if track_ids is None:
+            tracks = iter_tracks(conn)
+        else:
+            tracks = chain.from_iterable(
+                iter_tracks(conn, where=f"WHERE t.id IN ({', '.join(str(int(id)) for id in chunk)})")
+                for chunk in _id_chunks(track_ids)
+            )
+
+        issues = {name: [] for name in checks}
+        for result in validate_tracks(tracks, checks, workers=workers):
+            for name in result['issues']:
+                issues[name].append(result['track_id'])
+        conn.close()
+        return issues
+
+    def perfect_pairs(self, itunes_ids=None, owntone_ids=None):
+        """
+        Finds the pairs matcher.score_pair would give a perfect 1.0: same artist
+        block and title, same non-empty album, same track number and durations
+        within DURATION_TOLERANCE. Only pairs whose tracks have no other perfect
+        match are returned, since the linker would always pick those.
+
+        Returns:
+            list: (itunes_id, owntone_id) tuples.
+        """
+        with self.lock:
+            it_positions = self.itunes.select(itunes_ids)
+            ot_positions = self.tracks.select(owntone_ids)
+            it = {name: self.itunes.gather(name, it_positions)
+                  for name in ('id', 'title', 'album', 'artist_block', 'duration', 'track_number')}
+            ot = {name: self.tracks.gather(name, ot_positions)
+                  for name in ('id', 'title', 'album', 'artist_block', 'duration', 'track_number')}
+            empty = self.pool.empty
+            size = len(self.pool.values)
+
+        if np is not None:
+            return _perfect_pairs_numpy(it, ot, empty, size)
+
+        # Group the OwnTone tracks by (artist block, title), then compare within groups
+        groups = {}
+        for j, key in enumerate(zip(ot['artist_block'], ot['title'])):
+            groups.setdefault(key, []).append(j)
+
+        pairs = []
+        for i, key in enumerate(zip(it['artist_block'], it['title'])):
+            for j in groups.get(key, ()):
+                if (it['album'][i] == ot['album'][j] != empty
+                        and it['track_number'][i] == ot['track_number'][j] != 0
+                        and it['duration'][i] and ot['duration'][j]
+                        and abs(it['duration'][i] - ot['duration'][j]) <= DURATION_TOLERANCE):
+                    pairs.append((i, j))
+
+        it_counts = {}
+        ot_counts = {}
+        for i, j in pairs:
+            it_counts[i] = it_counts.get(i, 0) + 1
+            ot_counts[j] = ot_counts.get(j, 0) + 1
+        return [(it['id'][i], ot['id'][j]) for i, j in pairs if it_counts[i] == 1 and ot_counts[j] == 1]
+
+def _id_chunks(ids, size=500):
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+def _perfect_pairs_numpy(it, ot, empty, size):
+    # One int64 key per (artist block, title), so the join is a sort and a search
+    it_keys = it['artist_block'] * size + it['title']
+    ot_keys = ot['artist_block'] * size + ot['title']
+    order = np.argsort(ot_keys, kind='stable')
+    sorted_keys = ot_keys[order]
+    start = np.searchsorted(sorted_keys, it_keys, 'left')
+    counts = np.searchsorted(sorted_keys, it_keys, 'right') - start
+
+    # Every iTunes track against every OwnTone track with the same key
+    i = np.repeat(np.arange(len(it_keys)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    j = order[np.repeat(start, counts) + offsets]
+
+    perfect = (
+        (it['album'][i] == ot['album'][j]) & (it['album'][i] != empty)
+        & (it['track_number'][i] == ot['track_number'][j]) & (it['track_number'][i] != 0)
+        & (it['duration'][i] != 0) & (ot['duration'][j] != 0)
+        & (np.abs(it['duration'][i] - ot['duration'][j]) <= DURATION_TOLERANCE)
+    )
+    i, j = i[perfect], j[perfect]
+
+    unique = (np.bincount(i, minlength=len(it_keys))[i] == 1) & (np.bincount(j, minlength=len(ot_keys))[j] == 1)
+    return list(zip(it['id'][i[unique]].tolist(), ot['id'][j[unique]].tolist()))
@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+from crawler import OwnToneCrawler, DEFAULT_CONCURRENCY
+
+# Directory the canned responses are read from and recorded to
+CANNED_DIR = 'canned'
+
+class StubOwnToneHandler(BaseHTTPRequestHandler):
+    """
+    Answers GET requests with canned JSON, looked up by path (with its query
+    string first, then without). Unknown paths get a 404.
+
+    A path listed in server.failures gets an error (server.failure_status, 503 by
+    default) that many times before it is answered, to exercise the crawler's
+    retries.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        with self.server.lock:
+            self.server.requests += 1
+            if self.server.failures.get(url.path, 0) > 0:
+                self.server.failures[url.path] -= 1
+                return self.send_json({}, self.server.failure_status)
+
+        routes = self.server.routes
+        key = f'{url.path}?{url.query}' if url.query else url.path
+        if key in routes:
+            return self.send_json(routes[key])
+        if url.path in routes:
+            return self.send_json(routes[url.path])
+        self.send_json({}, 404)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_stub_server(routes=None, handler=StubOwnToneHandler, port=0, failures=None, failure_status=503):
+    """
+    Serves canned responses from a background thread.
+
+    Args:
+        routes (dict): Mapping of path (e.g. '/api/library/artists') to the JSON
+            returned for it.
+        handler (class): Request handler, StubOwnToneHandler or a subclass.
+        port (int): Port to listen on; 0 picks a free one.
+        failures (dict): Mapping of path to the number of errors answered first.
+        failure_status (int): Status code of those errors.
+
+    Returns:
+        tuple: (server, base URL). Stop the server with server.shutdown().
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.routes = routes or {}
+    server.failures = dict(failures or {})
+    server.failure_status = failure_status
+    server.lock = threading.Lock()
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def canned_file(directory, path):
+    return os.path.join(directory, *path.strip('/').split('/')) + '.json'
+
+def load_canned(directory=CANNED_DIR):
+    """
+    Reads the canned responses of a directory: the file api/library/artists.json
+    answers /api/library/artists.
+
+    Returns:
+        dict: Mapping of path to JSON response.
+    """
+    routes = {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith('.json'):
+                continue
+            file_path = os.path.join(root, name)
+            path = '/' + os.path.relpath(file_path, directory)[:-len('.json')].replace(os.sep, '/')
+            with open(file_path, encoding='utf-8') as f:
+                routes[path] = json.load(f)
+    return routes
+
+def record_canned(crawler, directory=CANNED_DIR):
+    """
+    Saves the responses of a real OwnTone server to every request the crawl
+    scripts make, so they can be served again by the stub.
+
+    Returns:
+        int: The number of responses saved.
+    """
+    responses = {
+        '/api/library': crawler.fetch_json('/api/library'),
+        '/api/library/artists': crawler.fetch_json('/api/library/artists'),
+        '/api/library/albums': crawler.fetch_json('/api/library/albums'),
+    }
+    paths = [f"/api/library/artists/{artist['id']}/albums" for artist in responses['/api/library/artists']['items']]
+    paths += [f"/api/library/albums/{album['id']}/tracks" for album in responses['/api/library/albums']['items']]
+    for path, items, error in crawler.fetch_all({path: path for path in paths}):
+        if error:
+            print(f"Failed to fetch {path}: {error}")
+            continue
+        responses[path] = {'items': items}
+
+    for path, data in responses.items():
+        file_path = canned_file(directory, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+    return len(responses)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve canned OwnTone API responses, e.g. to run the crawl '
+                                                 'scripts against with --url.')
+    parser.add_argument('--dir', default=CANNED_DIR, help='Directory holding the canned responses')
+    parser.add_argument('--port', type=int, default=3689, help='Port to listen on')
+    parser.add_argument('--record', metavar='URL',
+                        help='Save the responses of the OwnTone server at URL instead of serving')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight at once while recording')
+    args = parser.parse_args()
+
+    if args.record:
+        with OwnToneCrawler(args.record, args.concurrency) as crawler:
+            saved = record_canned(crawler, args.dir)
+        print(f"Saved {saved} responses to {args.dir}.")
+    else:
+        routes = load_canned(args.dir)
+        server, url = start_stub_server(routes, port=args.port)
+        print(f"Serving {len(routes)} canned responses on {url}.")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
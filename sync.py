@@ -0,0 +1,187 @@
+import argparse
+import hashlib
+import json
+import sqlite3
+from artists import create_database, create_artist_writer
+from albums import create_albums_table, create_album_writer
+from tracks import create_tracks_table, create_track_writer, TRACK_COLUMNS
+from crawler import OwnToneCrawler, OWNTONE_URL, DEFAULT_CONCURRENCY
+from metadata import refresh_track_keys
+from search import create_search_indexes
+from migrations import run_migrations
+from db_writer import DbWriter
+
+# Fields that make up the watermark of an artist or album. If none of them change,
+# the entity (and everything below it) is assumed unchanged. OwnTone reports no
+# modification time for artists or albums, so tags edited on existing tracks
+# (same count, same length) don't change any of them: sync with --full after
+# retagging files.
+ARTIST_MARKER_FIELDS = ('time_added', 'album_count', 'track_count', 'length_ms')
+ALBUM_MARKER_FIELDS = ('time_added', 'track_count', 'length_ms')
+
+# Function to create the 'sync_state' table holding the per-entity watermarks
+def create_sync_state_table():
+    conn = sqlite3.connect('owntone.db')
+    cursor = conn.cursor()
+
+    # Create the 'sync_state' table if it doesn't already exist
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            entity TEXT,
+            id TEXT,
+            marker TEXT,
+            PRIMARY KEY (entity, id)
+        )
+    ''')
+
+    # Commit and close the connection
+    conn.commit()
+    conn.close()
+
+# Function to compute the watermark of an item from the given fields
+def compute_marker(item, fields):
+    values = [item.get(field) for field in fields]
+    return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+# Function to load the stored watermarks for an entity type as {id: marker}
+def load_markers(conn, entity):
+    cursor = conn.execute('SELECT id, marker FROM sync_state WHERE entity = ?', (entity,))
+    return dict(cursor.fetchall())
+
+# Function to store watermarks for an entity type
+def save_markers(conn, entity, markers):
+    conn.executemany('''
+        INSERT INTO sync_state (entity, id, marker) VALUES (?, ?, ?)
+        ON CONFLICT(entity, id) DO UPDATE SET marker = excluded.marker
+    ''', [(entity, id, marker) for id, marker in markers.items()])
+
+# Function to remove the watermarks of deleted entities
+def delete_markers(conn, entity, ids):
+    conn.executemany('DELETE FROM sync_state WHERE entity = ? AND id = ?', [(entity, id) for id in ids])
+
+# Function to compare fetched items with the stored watermarks.
+# Returns the changed items, their new markers, and the ids that no longer exist.
+def diff_items(items, stored, fields, full=False):
+    changed = []
+    markers = {}
+    for item in items:
+        id = str(item['id'])
+        marker = compute_marker(item, fields)
+        if full or stored.get(id) != marker:
+            changed.append(item)
+            markers[id] = marker
+
+    seen = {str(item['id']) for item in items}
+    removed = [id for id in stored if id not in seen]
+    return changed, markers, removed
+
+# Main function to bring the local copy of the library up to date.
+# In incremental mode only new or changed artists, albums and tracks are written,
+# and tracks are only fetched for albums whose watermark changed. Tag-only edits
+# are missed in that mode; see ALBUM_MARKER_FIELDS.
+def sync_library(crawler=None, full=False):
+    crawler = crawler or OwnToneCrawler()
+    requests_made = 0
+
+    writer = DbWriter('owntone.db')
+    create_artist_writer(writer)
+    create_album_writer(writer)
+    create_track_writer(writer)
+    conn = writer.conn
+
+    # Artists: one request for the whole list
+    artists = crawler.fetch_items('/api/library/artists')
+    requests_made += 1
+    changed_artists, artist_markers, removed_artists = diff_items(
+        artists, load_markers(conn, 'artist'), ARTIST_MARKER_FIELDS, full)
+    for artist in changed_artists:
+        writer.write('artists', artist)
+
+    # Albums: one request for the whole list, then compare watermarks
+    albums = crawler.fetch_items('/api/library/albums')
+    requests_made += 1
+    changed_albums, album_markers, removed_albums = diff_items(
+        albums, load_markers(conn, 'album'), ALBUM_MARKER_FIELDS, full)
+    for album in changed_albums:
+        writer.write('albums', album)
+
+    # Tracks: only fetched for albums whose watermark changed
+    stored_tracks = load_markers(conn, 'track')
+    track_markers = {}
+    removed_tracks = []
+    tracks_written = 0
+    paths = {str(album['id']): f"/api/library/albums/{album['id']}/tracks" for album in changed_albums}
+
+    for album_id, tracks, error in crawler.fetch_all(paths):
+        requests_made += 1
+        if error is not None:
+            # Leave the old watermark in place so the album is retried next time
+            print(f"An error occurred while fetching tracks for album {album_id}: {error}")
+            del album_markers[album_id]
+            continue
+
+        album_stored = {
+            str(row[0]): stored_tracks.get(str(row[0]))
+            for row in conn.execute('SELECT id FROM tracks WHERE album_id = ?', (album_id,))
+        }
+        changed_tracks, markers, removed = diff_items(tracks, album_stored, TRACK_COLUMNS, full)
+        for track in changed_tracks:
+            writer.write('tracks', track)
+        tracks_written += len(changed_tracks)
+        track_markers.update(markers)
+        removed_tracks.extend(removed)
+
+    writer.flush()
+
+    # Tracks of albums that disappeared go with them
+    for album_id in removed_albums:
+        cursor = conn.execute('SELECT id FROM tracks WHERE album_id = ?', (album_id,))
+        removed_tracks.extend(str(row[0]) for row in cursor.fetchall())
+
+    # Remove whatever disappeared from the library, then record the new watermarks
+    with conn:
+        conn.executemany('DELETE FROM tracks WHERE id = ?', [(int(id),) for id in removed_tracks])
+        conn.executemany('DELETE FROM albums WHERE id = ?', [(id,) for id in removed_albums])
+        conn.executemany('DELETE FROM artists WHERE id = ?', [(id,) for id in removed_artists])
+
+        save_markers(conn, 'artist', artist_markers)
+        save_markers(conn, 'album', album_markers)
+        save_markers(conn, 'track', track_markers)
+        delete_markers(conn, 'artist', removed_artists)
+        delete_markers(conn, 'album', removed_albums)
+        delete_markers(conn, 'track', removed_tracks)
+
+    writer.close()
+
+    print(f"Synced {len(changed_artists)} artists, {len(changed_albums)} albums and "
+          f"{tracks_written} tracks using {requests_made} requests.")
+    print(f"Removed {len(removed_artists)} artists, {len(removed_albums)} albums and "
+          f"{len(removed_tracks)} tracks.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bring the local copy of the OwnTone library up to date.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight at once')
+    parser.add_argument('--full', action='store_true',
+                        help='Re-fetch and rewrite everything, ignoring the stored watermarks '
+                             '(needed to pick up tags edited on existing tracks)')
+    args = parser.parse_args()
+
+    # Create the tables if they don't exist
+    create_database()
+    create_albums_table()
+    create_tracks_table()
+    create_sync_state_table()
+    run_migrations()
+
+    with OwnToneCrawler(args.url, args.concurrency) as crawler:
+        sync_library(crawler, args.full)
+
+    # Precompute the metadata-check keys of the tracks that were added or changed,
+    # and build the search index if this is the first crawl
+    conn = sqlite3.connect('owntone.db')
+    refresh_track_keys(conn)
+    create_search_indexes(conn)
+    conn.commit()
+    conn.close()
@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_importing_the_app_has_no_side_effects(tmp_path):
+    script = 'import os, threading, app; print(os.listdir("."), threading.active_count())'
+    result = subprocess.run([sys.executable, '-c', script], cwd=tmp_path, capture_output=True, text=True,
+                            env={**os.environ, 'PYTHONPATH': ROOT})
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.split() == ['[]', '1']
+
+@pytest.fixture
+def client(tmp_path):
+    import app
+    client = app.create_app(str(tmp_path / 'owntone.db'), 'http://127.0.0.1:9').test_client()
+    yield client
+    app.app.extensions['rating_outbox'].stop()
+    app.app.extensions['db_pool'].close()
+
+def test_create_app_sets_up_the_database(client, tmp_path):
+    assert client.get('/sync-status').status_code == 200
+    assert (tmp_path / 'owntone.db').exists()
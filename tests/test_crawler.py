@@ -0,0 +1,116 @@
+import sqlite3
+import time
+from urllib.parse import parse_qs, urlsplit
+import pytest
+import requests
+from crawler import OwnToneCrawler
+from stub_owntone import StubOwnToneHandler, start_stub_server
+
+ARTISTS = {'items': [{'id': '1', 'name': 'Beatles'}, {'id': '2', 'name': 'Abba'}]}
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def start(*args, **kwargs):
+        server, url = start_stub_server(*args, **kwargs)
+        servers.append(server)
+        return server, url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_transient_errors_are_retried(stub, status):
+    server, url = stub({'/api/library/artists': ARTISTS}, failures={'/api/library/artists': 2},
+                       failure_status=status)
+    with OwnToneCrawler(url, retries=3, backoff_factor=0) as crawler:
+        assert crawler.fetch_items('/api/library/artists') == ARTISTS['items']
+    assert server.requests == 3
+
+def test_gives_up_after_the_last_retry(stub):
+    server, url = stub({'/api/library/artists': ARTISTS}, failures={'/api/library/artists': 5})
+    with OwnToneCrawler(url, retries=2, backoff_factor=0) as crawler:
+        with pytest.raises(requests.HTTPError):
+            crawler.fetch_items('/api/library/artists')
+    assert server.requests == 3
+
+def test_client_errors_are_not_retried(stub):
+    server, url = stub({})
+    with OwnToneCrawler(url, retries=3, backoff_factor=0) as crawler:
+        with pytest.raises(requests.HTTPError):
+            crawler.fetch_json('/api/library/albums')
+    assert server.requests == 1
+
+def test_listing_without_items_is_an_error(stub):
+    _, url = stub({'/api/library': {'songs': 3}})
+    with OwnToneCrawler(url) as crawler:
+        with pytest.raises(KeyError):
+            crawler.fetch_items('/api/library')
+
+class SlowHandler(StubOwnToneHandler):
+    """
+    Answers after a short delay, recording how many requests were in flight at once.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(self.server.max_in_flight, self.server.in_flight)
+        time.sleep(0.05)
+        try:
+            super().do_GET()
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+def test_fetch_all_fans_out_within_the_concurrency(stub):
+    routes = {f'/api/library/albums/{i}/tracks': {'items': [{'id': i}]} for i in range(12)}
+    server, url = stub(routes, handler=SlowHandler, failures={'/api/library/albums/3/tracks': 1})
+    server.in_flight = server.max_in_flight = 0
+
+    paths = {i: f'/api/library/albums/{i}/tracks' for i in range(12)}
+    paths['missing'] = '/api/library/albums/missing/tracks'
+    with OwnToneCrawler(url, concurrency=4, backoff_factor=0) as crawler:
+        results = {key: (items, error) for key, items, error in crawler.fetch_all(paths)}
+
+    assert set(results) == set(paths)
+    for i in range(12):
+        assert results[i] == ([{'id': i}], None)
+    items, error = results['missing']
+    assert items is None and isinstance(error, requests.HTTPError)
+    assert 1 < server.max_in_flight <= 4
+
+class PagedSearchHandler(StubOwnToneHandler):
+    """
+    Pages through server.tracks on /api/search by offset and limit, like OwnTone.
+    """
+
+    def do_GET(self):
+        params = parse_qs(urlsplit(self.path).query)
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.pages.append(int(params['offset'][0]))
+        offset, limit = int(params['offset'][0]), int(params['limit'][0])
+        tracks = self.server.tracks
+        self.send_json({'tracks': {'items': tracks[offset:offset + limit], 'total': len(tracks)}})
+
+@pytest.mark.parametrize('prefetch', [True, False])
+def test_flat_crawl_pages_through_every_track(stub, tmp_path, monkeypatch, prefetch):
+    from tracks import create_tracks_table, fetch_and_store_all_tracks
+
+    monkeypatch.chdir(tmp_path)
+    create_tracks_table()
+    server, url = stub(handler=PagedSearchHandler)
+    server.tracks = [{'id': i, 'title': f'Track {i}', 'album_id': '1'} for i in range(1, 26)]
+    server.pages = []
+
+    with OwnToneCrawler(url) as crawler:
+        assert fetch_and_store_all_tracks(crawler, page_size=10, prefetch=prefetch) == 25
+
+    assert sorted(server.pages) == [0, 10, 20]
+    conn = sqlite3.connect('owntone.db')
+    assert conn.execute('SELECT COUNT(*), MIN(id), MAX(id) FROM tracks').fetchone() == (25, 1, 25)
+    conn.close()
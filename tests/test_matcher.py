@@ -0,0 +1,30 @@
+from matcher import ARTIST_SIMILARITY, ArtistIndex, BlockIndex, make_record, trigrams
+
+KEYS = ['beatles', 'beatels', 'rolling stones', 'the rolling stones', 'stones', 'abba', 'abba band']
+
+def brute_force_similar(key, keys):
+    grams = trigrams(key)
+    result = set()
+    for other in keys:
+        shared = len(grams & trigrams(other))
+        if shared and shared / (len(grams) + len(trigrams(other)) - shared) >= ARTIST_SIMILARITY:
+            result.add(other)
+    return result
+
+def test_similar_finds_the_same_keys_as_a_full_scan():
+    index = ArtistIndex(KEYS)
+    for key in KEYS + ['beatle', 'rolling stone', 'nobody']:
+        assert {other for other, _ in index.similar(key)} == brute_force_similar(key, KEYS)
+
+def test_blocks_for_prefers_the_exact_block():
+    index = ArtistIndex(KEYS)
+    assert index.blocks_for('beatles') == [(KEYS[0], 1.0)]
+    assert {key for key, _ in index.blocks_for('beatle')} == {'beatles'}
+    assert index.blocks_for('nobody') == []
+
+def test_block_index_candidates_come_from_similar_artists():
+    records = [make_record(1, 'Help', 'Beatles', 'Help!', 138000, 1),
+               make_record(2, 'Angie', 'Rolling Stones', 'Goats Head Soup', 271000, 3)]
+    index = BlockIndex(records)
+    itunes = make_record(10, 'Help!', 'Beatle', 'Help', 139000, 1)
+    assert [candidate['id'] for candidate, _ in index.candidates(itunes)] == [1]
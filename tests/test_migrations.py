@@ -0,0 +1,111 @@
+import sqlite3
+import subprocess
+import sys
+import pytest
+import migrations
+from migrations import applied_versions, check_query_plans, migrate
+
+def create_tables(conn):
+    conn.execute('''
+        CREATE TABLE tracks (
+            id INTEGER PRIMARY KEY, title TEXT, artist TEXT, album_id TEXT, rating INTEGER, path TEXT
+        )
+    ''')
+    conn.execute('CREATE TABLE track_links (id INTEGER PRIMARY KEY, itunes_track_id INTEGER, owntone_track_id INTEGER)')
+    conn.commit()
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'owntone.db')
+    create_tables(conn)
+    yield conn
+    conn.close()
+
+def test_migrate_applies_pending_migrations_once(conn):
+    names = migrate(conn)
+    assert 'track_links_pairs' in names
+    assert 'tracks_indexes' in names
+    assert migrate(conn) == []
+
+def test_failed_migration_is_rolled_back(conn):
+    def broken(cursor):
+        cursor.execute('CREATE TABLE half_done (id INTEGER)')
+        cursor.execute('ALTER TABLE tracks ADD COLUMN half_done TEXT')
+        cursor.execute('DROP INDEX no_such_index')
+
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(conn, analyze=False, migrations=[(100, 'broken', ('tracks',), broken)])
+
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+    assert 'half_done' not in [row[1] for row in conn.execute('PRAGMA table_info(tracks)')]
+    assert 100 not in applied_versions(conn.cursor())
+
+def test_migration_waits_for_its_tables(conn):
+    applied = []
+    migrate(conn, analyze=False, migrations=[(100, 'later', ('no_such_table',), applied.append)])
+    assert applied == []
+    assert 100 not in applied_versions(conn.cursor())
+
+def test_check_query_plans_reports_full_scans(conn):
+    regressions = check_query_plans(conn)
+    assert 'links_by_owntone_track' in regressions
+    assert 'album_tracks' in regressions
+
+    migrate(conn)
+    assert check_query_plans(conn) == {}
+
+def test_check_command_passes_once_migrated(tmp_path, conn):
+    result = subprocess.run([sys.executable, migrations.__file__, '--db', str(tmp_path / 'owntone.db'), '--check'],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'No hot query scans a whole table.' in result.stdout
+
+def create_legacy_itunes_tracks(conn):
+    conn.execute('''
+        CREATE TABLE itunes_tracks (
+            track_id INTEGER PRIMARY KEY, "Name" TEXT, "Artist" TEXT, "Album" TEXT,
+            "Total Time" TEXT, "Track Number" TEXT, "Date Added" TEXT
+        )
+    ''')
+    conn.executemany('INSERT INTO itunes_tracks VALUES (?, ?, ?, ?, ?, ?, ?)', [
+        (1, 'Song', 'Artist', 'Album', '215000', '3', '2010-05-01T12:00:00Z'),
+        (2, 'Other', 'Artist', 'Album', '180000', None, None),
+    ])
+    conn.commit()
+
+def test_legacy_itunes_tracks_are_converted_with_their_triggers(conn):
+    from metadata import create_itunes_track_changes_table
+
+    create_legacy_itunes_tracks(conn)
+    create_itunes_track_changes_table(conn)
+    conn.commit()
+
+    assert 'itunes_tracks_typed' in migrate(conn)
+    rows = conn.execute('SELECT track_id, "Total Time", "Track Number", "Date Added" FROM itunes_tracks').fetchall()
+    assert rows == [(1, 215000, 3, 1272715200), (2, 180000, None, None)]
+    triggers = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+    assert {'itunes_track_changes_insert', 'itunes_track_changes_update', 'itunes_track_changes_delete'} <= triggers
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'itunes_tracks_legacy'").fetchone() is None
+
+def test_failed_itunes_tracks_conversion_keeps_the_legacy_table(conn, monkeypatch):
+    import parse
+
+    create_legacy_itunes_tracks(conn)
+    def broken_row(track_id, track_info):
+        raise ValueError('bad row')
+    monkeypatch.setattr(parse, 'track_row', broken_row)
+
+    with pytest.raises(ValueError):
+        migrate(conn)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(itunes_tracks)')]
+    assert 'extra' not in columns
+    assert conn.execute('SELECT COUNT(*) FROM itunes_tracks').fetchone()[0] == 2
+    assert conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'itunes_tracks_legacy'").fetchone() is None
+
+def test_create_itunes_tracks_table_converts_a_legacy_table(conn):
+    from parse import create_itunes_tracks_table
+
+    create_legacy_itunes_tracks(conn)
+    create_itunes_tracks_table(conn)
+    assert conn.execute('SELECT "Total Time" FROM itunes_tracks WHERE track_id = 1').fetchone() == (215000,)
+    assert 5 in applied_versions(conn.cursor())
@@ -1,9 +1,23 @@
+import argparse
 import requests
-import sqlite3
+from crawler import OwnToneCrawler, OWNTONE_URL, DEFAULT_CONCURRENCY
+from metadata import refresh_track_keys
+from search import create_search_indexes
+from migrations import run_migrations
+from instrument import connect, print_report
+from db_writer import DbWriter, QueueWriter
+from checkpoints import CrawlCheckpoint
+from concurrent.futures import ThreadPoolExecutor
+
+# Default number of tracks requested per page in flat mode
+DEFAULT_PAGE_SIZE = 500
+
+# Search expression matching every track in flat mode
+ALL_TRACKS_EXPRESSION = 'media_kind is music'
 
 # Function to create the 'tracks' table in the SQLite database
 def create_tracks_table():
-    conn = sqlite3.connect('owntone.db')
+    conn = connect('owntone.db')
     cursor = conn.cursor()
     
     # Create the 'tracks' table if it doesn't already exist
@@ -51,157 +65,39 @@ def create_tracks_table():
     conn.commit()
     conn.close()
 
-# Function to insert track data dynamically into the 'tracks' table
-def insert_track(track):
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
-    
-    # Track fields to insert into the database
-    fields = []
-    values = []
-    
-    # Add each available field to the fields and values lists
-    if 'id' in track:
-        fields.append('id')
-        values.append(track['id'])
-    if 'title' in track:
-        fields.append('title')
-        values.append(track['title'])
-    if 'title_sort' in track:
-        fields.append('title_sort')
-        values.append(track['title_sort'])
-    if 'artist' in track:
-        fields.append('artist')
-        values.append(track['artist'])
-    if 'artist_sort' in track:
-        fields.append('artist_sort')
-        values.append(track['artist_sort'])
-    if 'album' in track:
-        fields.append('album')
-        values.append(track['album'])
-    if 'album_sort' in track:
-        fields.append('album_sort')
-        values.append(track['album_sort'])
-    if 'album_id' in track:
-        fields.append('album_id')
-        values.append(track['album_id'])
-    if 'album_artist' in track:
-        fields.append('album_artist')
-        values.append(track['album_artist'])
-    if 'album_artist_sort' in track:
-        fields.append('album_artist_sort')
-        values.append(track['album_artist_sort'])
-    if 'album_artist_id' in track:
-        fields.append('album_artist_id')
-        values.append(track['album_artist_id'])
-    if 'genre' in track:
-        fields.append('genre')
-        values.append(track['genre'])
-    if 'comment' in track:
-        fields.append('comment')
-        values.append(track['comment'])
-    if 'year' in track:
-        fields.append('year')
-        values.append(track['year'])
-    if 'track_number' in track:
-        fields.append('track_number')
-        values.append(track['track_number'])
-    if 'disc_number' in track:
-        fields.append('disc_number')
-        values.append(track['disc_number'])
-    if 'length_ms' in track:
-        fields.append('length_ms')
-        values.append(track['length_ms'])
-    if 'rating' in track:
-        fields.append('rating')
-        values.append(track['rating'])
-    if 'play_count' in track:
-        fields.append('play_count')
-        values.append(track['play_count'])
-    if 'skip_count' in track:
-        fields.append('skip_count')
-        values.append(track['skip_count'])
-    if 'time_added' in track:
-        fields.append('time_added')
-        values.append(track['time_added'])
-    if 'date_released' in track:
-        fields.append('date_released')
-        values.append(track['date_released'])
-    if 'seek_ms' in track:
-        fields.append('seek_ms')
-        values.append(track['seek_ms'])
-    if 'type' in track:
-        fields.append('type')
-        values.append(track['type'])
-    if 'samplerate' in track:
-        fields.append('samplerate')
-        values.append(track['samplerate'])
-    if 'bitrate' in track:
-        fields.append('bitrate')
-        values.append(track['bitrate'])
-    if 'channels' in track:
-        fields.append('channels')
-        values.append(track['channels'])
-    if 'usermark' in track:
-        fields.append('usermark')
-        values.append(track['usermark'])
-    if 'media_kind' in track:
-        fields.append('media_kind')
-        values.append(track['media_kind'])
-    if 'data_kind' in track:
-        fields.append('data_kind')
-        values.append(track['data_kind'])
-    if 'path' in track:
-        fields.append('path')
-        values.append(track['path'])
-    if 'uri' in track:
-        fields.append('uri')
-        values.append(track['uri'])
-    if 'artwork_url' in track:
-        fields.append('artwork_url')
-        values.append(track['artwork_url'])
-    
-    # Construct the SQL query dynamically
-    query = f"INSERT OR REPLACE INTO tracks ({', '.join(fields)}) VALUES ({', '.join(['?' for _ in values])})"
-    
-    # Execute the query with the values
-    cursor.execute(query, values)
-    
-    # Commit and close the connection
-    conn.commit()
-    conn.close()
+# Columns of the tracks table, in the order they are written
+TRACK_COLUMNS = (
+    'id', 'title', 'title_sort', 'artist', 'artist_sort', 'album', 'album_sort', 'album_id',
+    'album_artist', 'album_artist_sort', 'album_artist_id', 'genre', 'comment', 'year',
+    'track_number', 'disc_number', 'length_ms', 'rating', 'play_count', 'skip_count',
+    'time_added', 'date_released', 'seek_ms', 'type', 'samplerate', 'bitrate', 'channels',
+    'usermark', 'media_kind', 'data_kind', 'path', 'uri', 'artwork_url'
+)
+
+# Function to create a batched writer for the tracks table
+def create_track_writer(writer=None):
+    writer = writer or QueueWriter('owntone.db')
+    writer.add_table('tracks', TRACK_COLUMNS)
+    return writer
 
 # Function to fetch tracks for a specific album
-def fetch_tracks_for_album(album_id):
-    # The URL for fetching tracks for a specific album by its ID
-    url = f'http://192.168.1.13:3689/api/library/albums/{album_id}/tracks'
+def fetch_tracks_for_album(album_id, crawler=None):
+    crawler = crawler or OwnToneCrawler()
     
     try:
-        # Make a GET request to the URL
-        response = requests.get(url)
-        
-        # Check if the request was successful
-        if response.status_code == 200:
-            # Parse the JSON response
-            data = response.json()
-            
-            # Iterate through the 'items' array
-            if 'items' in data:
-                for track in data['items']:
-                    # Insert each track into the database
-                    insert_track(track)
-                print(f"Inserted {len(data['items'])} tracks for album {album_id} into the database.")
-            else:
-                print(f"No 'items' found in the response for album {album_id}")
-        else:
-            print(f"Failed to fetch tracks for album {album_id}. Status code: {response.status_code}")
+        # Fetch the tracks for the album and write them into the database
+        tracks = crawler.fetch_items(f'/api/library/albums/{album_id}/tracks')
+        with create_track_writer(DbWriter('owntone.db')) as writer:
+            for track in tracks:
+                writer.write('tracks', track)
+        print(f"Inserted {len(tracks)} tracks for album {album_id} into the database.")
     
-    except requests.RequestException as e:
+    except (requests.RequestException, KeyError, ValueError) as e:
         print(f"An error occurred while fetching tracks for album {album_id}: {e}")
 
 # Function to fetch all albums from the database
 def fetch_all_albums():
-    conn = sqlite3.connect('owntone.db')
+    conn = connect('owntone.db')
     cursor = conn.cursor()
     
     # Fetch all albums from the albums table
@@ -211,19 +107,122 @@ def fetch_all_albums():
     conn.close()
     return albums
 
-# Main function to fetch tracks for all albums and insert them into the database
-def fetch_and_store_tracks():
-    # Fetch all albums from the database
-    albums = fetch_all_albums()
+# Main function to fetch tracks for all albums and insert them into the database.
+# Every album is checkpointed, so with resume only the albums not done yet are
+# fetched, and with retry_failed only the ones that failed.
+def fetch_and_store_tracks(crawler=None, resume=False, retry_failed=False):
+    crawler = crawler or OwnToneCrawler()
+
+    # Fetch all albums from the database, leaving out the ones already done
+    checkpoint = CrawlCheckpoint('tracks', 'albums')
+    albums = checkpoint.start([album[0] for album in fetch_all_albums()], resume, retry_failed)
+    paths = {album_id: f'/api/library/albums/{album_id}/tracks' for album_id in albums}
     
-    # Fetch tracks for each album
-    for album in albums:
-        album_id = album[0]  # Extract the album ID from the tuple
-        fetch_tracks_for_album(album_id)
+    # Fetch tracks for all albums concurrently, queueing them for the writer thread
+    # as each response arrives
+    with create_track_writer() as writer:
+        checkpoint.attach(writer)
+        for album_id, tracks, error in crawler.fetch_all(paths):
+            if error is not None:
+                print(f"An error occurred while fetching tracks for album {album_id}: {error}")
+                checkpoint.mark_failed(album_id, error)
+                continue
+            for track in tracks:
+                writer.write('tracks', track)
+            checkpoint.mark_done(album_id)
+            print(f"Inserted {len(tracks)} tracks for album {album_id} into the database.")
+
+    checkpoint.report()
+
+# Function to fetch one page of the flat track list.
+# Returns the tracks on the page and the total number of tracks in the library.
+def fetch_tracks_page(crawler, offset, limit, expression=ALL_TRACKS_EXPRESSION):
+    data = crawler.fetch_json('/api/search', params={
+        'type': 'tracks',
+        'expression': expression,
+        'offset': offset,
+        'limit': limit,
+    })
+    page = data.get('tracks', {})
+    return page.get('items', []), page.get('total', 0)
+
+# Main function to fetch every track by paging through the flat track list,
+# so the number of requests depends on the number of tracks, not albums.
+# With prefetch, the next page is requested while the current one is written.
+def fetch_and_store_all_tracks(crawler=None, page_size=DEFAULT_PAGE_SIZE, prefetch=True,
+                               expression=ALL_TRACKS_EXPRESSION):
+    crawler = crawler or OwnToneCrawler()
+    stored = 0
+
+    try:
+        with create_track_writer() as writer, ThreadPoolExecutor(max_workers=1) as executor:
+            offset = 0
+            page = executor.submit(fetch_tracks_page, crawler, offset, page_size, expression)
+
+            while True:
+                tracks, total = page.result()
+                offset += page_size
+                has_more = bool(tracks) and offset < total
+
+                # Start fetching the next page before writing this one
+                if has_more and prefetch:
+                    page = executor.submit(fetch_tracks_page, crawler, offset, page_size, expression)
+
+                for track in tracks:
+                    writer.write('tracks', track)
+                stored += len(tracks)
+                print(f"Inserted {stored} of {total} tracks into the database.")
+
+                if not has_more:
+                    break
+                if not prefetch:
+                    page = executor.submit(fetch_tracks_page, crawler, offset, page_size, expression)
+
+    except (requests.RequestException, ValueError) as e:
+        print(f"An error occurred while fetching tracks at offset {offset}: {e}")
+
+    return stored
 
 if __name__ == "__main__":
-    # Create the tracks table if it doesn't exist
+    parser = argparse.ArgumentParser(description='Fetch every track from OwnTone.')
+    parser.add_argument('--url', default=OWNTONE_URL, help='Base URL of the OwnTone server')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Maximum number of requests in flight at once (album mode)')
+    parser.add_argument('--mode', choices=['album', 'flat'], default='album',
+                        help="'album' fetches tracks per album, 'flat' pages through the whole track list")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help='Number of tracks per page (flat mode)')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help="Don't request the next page while the current one is written (flat mode)")
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last crawl, skipping the albums already done')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='Only retry the albums that failed in the last crawl')
+    parser.add_argument('--timings', action='store_true',
+                        help='Print the queries and requests that took the most time')
+    args = parser.parse_args()
+    if args.mode == 'flat' and (args.resume or args.retry_failed):
+        parser.error('--resume and --retry-failed only apply to album mode')
+
+    # Create the tracks table if it doesn't exist, and bring the schema up to date
     create_tracks_table()
+    run_migrations()
     
-    # Fetch and store tracks for all albums in the database
-    fetch_and_store_tracks()
+    with OwnToneCrawler(args.url, args.concurrency) as crawler:
+        if args.mode == 'flat':
+            # Page through the flat track list
+            fetch_and_store_all_tracks(crawler, args.page_size, not args.no_prefetch)
+        else:
+            # Fetch and store tracks for all albums in the database
+            fetch_and_store_tracks(crawler, args.resume, args.retry_failed)
+
+    # Precompute the metadata-check keys of the tracks that were added or changed,
+    # and build the search index if this is the first crawl
+    conn = connect('owntone.db')
+    refresh_track_keys(conn)
+    create_search_indexes(conn)
+    conn.commit()
+    conn.close()
+
+    if args.timings:
+        print_report()
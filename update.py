@@ -1,77 +1,89 @@
 import sqlite3
-from datetime import datetime
+import time
+from migrations import run_migrations
 
-def parse_date(date_str):
-    if date_str:
-        # Handle the ISO 8601 format
-        return int(datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ').timestamp())
-    return 0
+# Query selecting one row per linked OwnTone track from owntone.db, formatted with
+# the schema it is attached as. Counts, ratings and dates are stored as integers
+# (dates as Unix timestamps), so missing values become 0. An OwnTone track linked
+# to several iTunes tracks gets their counts added up, the latest skip/play dates,
+# the earliest date added and the highest rating.
+LINKED_ITUNES_ROWS = '''
+    SELECT tl.owntone_track_id,
+           SUM(COALESCE(it.`Skip Count`, 0)), SUM(COALESCE(it.`Play Count`, 0)),
+           MAX(COALESCE(it.`Rating`, 0)), MIN(COALESCE(it.`Date Added`, 0)),
+           MAX(COALESCE(it.`Skip Date`, 0)), MAX(COALESCE(it.`Play Date`, 0))
+    FROM {schema}.itunes_tracks it
+    INNER JOIN {schema}.track_links tl ON it.track_id = tl.itunes_track_id
+    GROUP BY tl.owntone_track_id
+'''
 
-# Function to find and insert matching tracks into the 'track_links' table
-def retrieve_itunes_metadata():
-    conn = sqlite3.connect('owntone.db')
-    cursor = conn.cursor()
-    
-    # Join the itunes_tracks and track_links tables
-    cursor.execute('''
-        SELECT tl.owntone_track_id, it.Name, it.Artist, it.`Skip Count`, it.`Skip Date`, it.`Rating`, 
-               it.`Date Added`, it.`Play Count`, it.`Play Date` 
-        FROM itunes_tracks it
-        INNER JOIN track_links tl ON it.track_id = tl.itunes_track_id
-    ''')
-    
-    # Fetch all rows from the query result
-    itunes_rows = cursor.fetchall()
-
-    # Close the database connection
-    conn.close()
+# Statement staging those rows, with owntone.db attached as 'owntone'
+STAGE_ITUNES_ROWS = '''
+    INSERT INTO temp.itunes_updates (id, skip_count, play_count, rating, time_added, time_skipped, time_played)
+''' + LINKED_ITUNES_ROWS.format(schema='owntone')
 
-    return itunes_rows
+# Statement applying the staged rows to the 'files' table in one pass. Counts are
+# added to the current ones, and the skip/play timestamps only move forward.
+APPLY_ITUNES_ROWS = '''
+    UPDATE files
+    SET
+        skip_count = files.skip_count + u.skip_count,
+        play_count = files.play_count + u.play_count,
+        rating = u.rating,
+        time_added = u.time_added,
+        time_skipped = MAX(COALESCE(files.time_skipped, 0), u.time_skipped),
+        time_played = MAX(COALESCE(files.time_played, 0), u.time_played)
+    FROM temp.itunes_updates u
+    WHERE files.id = u.id
+'''
 
+# Function to update the 'files' table in songs3.db with the iTunes metadata of
+# every linked track in owntone.db, in a single transaction.
+# Returns the number of linked tracks, the number of files updated and the time taken.
+def update_files_table(owntone_db='owntone.db', songs_db='songs3.db'):
+    start = time.perf_counter()
 
-# Function to update the 'files' table in songs3.db with the retrieved data
-def update_files_table(itunes_rows):
-    conn = sqlite3.connect('songs3.db')
+    conn = sqlite3.connect(songs_db)
+    conn.execute('ATTACH DATABASE ? AS owntone', (owntone_db,))
     cursor = conn.cursor()
 
-    for row in itunes_rows:
-        owntone_track_id = row[0]
-        skip_count = int(row[3]) if row[3] else 0  # Ensure this is an integer
-        play_count = int(row[7]) if row[7] else 0  # Ensure this is an integer
-        rating = int(row[5]) if row[5] else 0  # Ensure this is an integer
-        play_date = int(row[8]) if row[8] else 0
-        date_added = parse_date(row[6])
-        skip_date = parse_date(row[4])  # Convert to integer timestamp or 0
-        
-        # Get current values from files table
-        cursor.execute("SELECT time_skipped, time_played FROM files WHERE id = ?", (owntone_track_id,))
-        current_values = cursor.fetchone()
-        
-        if current_values:
-            current_time_skipped, current_time_played = current_values
-            
-            # Prepare the time_skipped value
-            time_skipped = skip_date if skip_date > current_time_skipped else current_time_skipped
-            time_played = play_date if play_date > current_time_played else current_time_played
+    # An itunes_tracks table imported before it was typed holds dates as text,
+    # which would be written into songs3.db as they are
+    columns = [row[1] for row in cursor.execute('PRAGMA owntone.table_info(itunes_tracks)')]
+    if 'extra' not in columns:
+        conn.close()
+        raise ValueError(f"itunes_tracks in {owntone_db} has the old untyped layout; "
+                         f"run migrations.py (or parse.py) first")
 
-            cursor.execute('''
-                UPDATE files
-                SET
-                    skip_count = skip_count + ?,
-                    play_count = play_count + ?,
-                    rating = ? COLLATE BINARY,
-                    time_added = ?,
-                    time_skipped = ?,
-                    time_played = ?
-                WHERE id = ?
-            ''', (skip_count, play_count, rating, date_added, time_skipped, time_played, owntone_track_id))
+    # Stage the converted iTunes rows, then apply them all with one UPDATE ... FROM
+    cursor.execute('''
+        CREATE TEMP TABLE IF NOT EXISTS itunes_updates (
+            id INTEGER PRIMARY KEY,
+            skip_count INTEGER,
+            play_count INTEGER,
+            rating INTEGER,
+            time_added INTEGER,
+            time_skipped INTEGER,
+            time_played INTEGER
+        )
+    ''')
+    with conn:
+        cursor.execute('DELETE FROM temp.itunes_updates')
+        cursor.execute(STAGE_ITUNES_ROWS)
+        staged = cursor.rowcount
+        cursor.execute(APPLY_ITUNES_ROWS)
+        updated = cursor.rowcount
 
-    conn.commit()
+    conn.execute('DETACH DATABASE owntone')
     conn.close()
 
+    return staged, updated, time.perf_counter() - start
+
 if __name__ == "__main__":
-    # Retrieve iTunes metadata from owntone.db
-    itunes_rows = retrieve_itunes_metadata()
+    # Bring the owntone.db schema up to date
+    run_migrations()
+
+    # Update the files table in songs3.db with the iTunes metadata from owntone.db
+    staged, updated, elapsed = update_files_table()
 
-    # Update the files table in songs3.db with the retrieved data
-    update_files_table(itunes_rows)
+    print(f"Updated {updated} files from {staged} linked tracks in {elapsed:.2f}s.")
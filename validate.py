@@ -0,0 +1,216 @@
+import argparse
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+from migrations import migrate
+from metadata import (
+    PATH_WITH_ALBUM, PATH_WITHOUT_ALBUM, FILE_EXTENSION, normalize_string, remove_track_number,
+)
+
+# Default number of tracks handed to a worker at a time
+DEFAULT_CHUNK_SIZE = 2000
+
+# Inputs with fewer tracks than this are validated in-process; starting a pool
+# costs more than it saves
+SERIAL_THRESHOLD = 20000
+
+def strip_extension(title):
+    """
+    Removes the file extension from a title parsed from a path.
+    """
+    return FILE_EXTENSION.sub('', title)
+
+# Rules applied, in order, to the track title parsed from a path
+TITLE_RULES = [remove_track_number, strip_extension]
+
+def check_artist(keys):
+    return keys['path_artist_key'] != keys['artist_key']
+
+def check_album(keys):
+    return keys['path_album_key'] is not None and keys['path_album_key'] != keys['album_key']
+
+def check_title(keys):
+    return keys['path_title_key'] != keys['title_key']
+
+# Checks run against every track whose path could be parsed, by name. A check
+# receives the track's keys (see analyze_track) and returns True if the track
+# fails it. Checks must be module-level functions so they can be sent to the
+# worker processes.
+CHECKS = {
+    'artist_mismatch': check_artist,
+    'album_mismatch': check_album,
+    'title_mismatch': check_title,
+}
+
+def parse_track_path(path, title_rules=TITLE_RULES):
+    """
+    Parses a path of the form /music/Music/{artist}/{album}/{track} or
+    /music/Music/{artist}/{track}, applying title_rules to the track name.
+
+    Returns:
+        tuple: (artist, album, title), all None if the path doesn't match.
+    """
+    if not path:
+        return None, None, None
+
+    match = PATH_WITH_ALBUM.match(path)
+    if match:
+        artist, album, title = match.groups()
+    else:
+        match = PATH_WITHOUT_ALBUM.match(path)
+        if not match:
+            return None, None, None
+        artist, title = match.groups()
+        album = None
+
+    for rule in title_rules:
+        title = rule(title)
+    return artist, album, title
+
+def analyze_track(track, checks=CHECKS, title_rules=TITLE_RULES):
+    """
+    Computes the normalized keys of a track and runs the checks against them.
+
+    Args:
+        track (tuple): (id, title, artist, album, path).
+
+    Returns:
+        dict: The track id, its normalized tag keys, the values parsed from its
+        path (raw and normalized) and 'issues', the names of the failed checks.
+    """
+    track_id, title, artist, album, path = track
+    path_artist, path_album, path_title = parse_track_path(path, title_rules)
+
+    keys = {
+        'track_id': track_id,
+        'title_key': normalize_string(title),
+        'artist_key': normalize_string(artist),
+        'album_key': normalize_string(album),
+        'path_title': None,
+        'path_artist': None,
+        'path_album': None,
+        'path_title_key': None,
+        'path_artist_key': None,
+        'path_album_key': None,
+        'issues': [],
+    }
+
+    # Only tracks whose path could be parsed are checked
+    if path_artist and path_title:
+        keys.update({
+            'path_title': path_title,
+            'path_artist': path_artist,
+            'path_album': path_album,
+            'path_title_key': normalize_string(path_title),
+            'path_artist_key': normalize_string(path_artist),
+            'path_album_key': normalize_string(path_album) or None,
+        })
+        keys['issues'] = [name for name, check in checks.items() if check(keys)]
+
+    return keys
+
+def analyze_chunk(tracks, checks=CHECKS, title_rules=TITLE_RULES):
+    return [analyze_track(track, checks, title_rules) for track in tracks]
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def validate_tracks(tracks, checks=CHECKS, title_rules=TITLE_RULES, workers=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, serial_threshold=SERIAL_THRESHOLD):
+    """
+    Analyzes tracks, spreading chunks over a process pool for large inputs.
+
+    The input is consumed lazily and results are yielded in input order, with at
+    most a couple of chunks per worker in flight, so memory stays bounded.
+
+    Args:
+        tracks (iterable): (id, title, artist, album, path) tuples.
+        checks (dict): Checks to run, see CHECKS.
+        title_rules (list): Rules applied to titles parsed from paths, see TITLE_RULES.
+        workers (int): Number of worker processes (default: one per CPU). 1 runs serially.
+        chunk_size (int): Number of tracks per chunk.
+        serial_threshold (int): Inputs smaller than this are analyzed in-process.
+
+    Yields:
+        dict: The result of analyze_track for every track.
+    """
+    workers = workers or os.cpu_count() or 1
+    tracks = iter(tracks)
+    head = list(islice(tracks, serial_threshold))
+
+    if workers == 1 or len(head) < serial_threshold:
+        for track in chain(head, tracks):
+            yield analyze_track(track, checks, title_rules)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for chunk in _chunks(chain(head, tracks), chunk_size):
+            pending.append(executor.submit(analyze_chunk, chunk, checks, title_rules))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def iter_tracks(conn, chunk_size=DEFAULT_CHUNK_SIZE, where=''):
+    """
+    Reads (id, title, artist, album, path) rows from 'tracks' in chunks, in id order.
+    """
+    # Plain tuples, whatever the connection's row factory, so they can be sent to worker processes
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(f'SELECT t.id, t.title, t.artist, t.album, t.path FROM tracks t {where} ORDER BY t.id')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check every track\'s tags against its path.')
+    parser.add_argument('--db', default='owntone.db', help='Path to the SQLite database file')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Number of tracks per chunk')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='Run the checks over an in-memory columnar snapshot of the tracks')
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(args.db)
+    migrate(conn)
+    start = time.perf_counter()
+
+    checked = 0
+    counts = {name: 0 for name in CHECKS}
+    incorrect = 0
+    if args.snapshot:
+        from snapshot import LibrarySnapshot
+        snapshot = LibrarySnapshot(args.db)
+        snapshot.refresh(conn)
+        issues = snapshot.issues(workers=args.workers)
+        checked = len(snapshot.tracks)
+        counts = {name: len(ids) for name, ids in issues.items()}
+        incorrect = len(set().union(*issues.values()))
+    else:
+        for result in validate_tracks(iter_tracks(conn, args.chunk_size), workers=args.workers,
+                                      chunk_size=args.chunk_size):
+            checked += 1
+            if result['issues']:
+                incorrect += 1
+            for name in result['issues']:
+                counts[name] += 1
+
+    conn.close()
+    elapsed = time.perf_counter() - start
+
+    print(f"Checked {checked} tracks in {elapsed:.2f}s, {incorrect} incorrect.")
+    for name, count in counts.items():
+        print(f"  {name}: {count}")